@@ -0,0 +1,300 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Resource usage accounting of child processes."""
+from contextlib import contextmanager
+import errno
+import os
+import resource
+import subprocess
+import threading
+import time
+
+# Resource usage fields, in the order they are reported
+FIELDS = ['children', 'wall', 'user', 'sys', 'maxrss', 'read', 'write']
+
+# The Popen class, to tell real processes from substitutes
+_POPEN = subprocess.Popen
+# The accounting and category of the account() context of each thread
+_CONTEXT = threading.local()
+
+
+def get_usage(usage):
+    """
+    Convert a resource usage structure returned by getrusage() or wait4().
+
+    The bytes read and written are the storage I/O, the same counters
+    /proc/<pid>/io shows as read_bytes and write_bytes, but still available
+    once the process was waited for.
+
+    Args:
+        usage:  The resource usage structure.
+
+    Returns:
+        A dictionary with the "user" and "sys" CPU seconds, the "maxrss" in
+        bytes, and the bytes "read" and "write".
+    """
+    return {
+        'user': usage.ru_utime,
+        'sys': usage.ru_stime,
+        'maxrss': usage.ru_maxrss * 1024,
+        'read': usage.ru_inblock * 512,
+        'write': usage.ru_oublock * 512,
+    }
+
+
+def get_children_usage():
+    """
+    Get the resources used by the child processes waited for so far.
+
+    Returns:
+        A dictionary with the "user" and "sys" CPU seconds, the "maxrss" of
+        the largest child in bytes, and the bytes "read" and "write".
+    """
+    return get_usage(resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+class ResourceAccounting(object):
+    """
+    Resources used by child processes, added up by category, e.g. the tool
+    run. Each child process is reaped with wait4(), which returns the exact
+    usage of that process, so children run concurrently from several threads
+    are accounted separately.
+    """
+
+    def __init__(self):
+        """Start accounting from the current usage."""
+        self.__lock = threading.Lock()
+        self.__start = time.time()
+        self.__start_usage = get_children_usage()
+        self.categories = {}
+
+    def __get_category(self, category):
+        """
+        Get the totals of a category, creating them if missing. Must be
+        called with the lock held.
+
+        Args:
+            category:   The category.
+
+        Returns:
+            A dictionary of the FIELDS.
+        """
+        return self.categories.setdefault(category,
+                                          dict.fromkeys(FIELDS, 0))
+
+    @contextmanager
+    def account(self, category):
+        """
+        Account the resources used by the child processes started within the
+        context with popen() or the functions built on it.
+
+        Args:
+            category:   The category to add the usage to.
+        """
+        start = time.time()
+        outer = getattr(_CONTEXT, 'current', None)
+        _CONTEXT.current = (self, category)
+        try:
+            yield
+        finally:
+            _CONTEXT.current = outer
+            wall = time.time() - start
+            with self.__lock:
+                totals = self.__get_category(category)
+                totals['children'] += 1
+                totals['wall'] += wall
+
+    def add_usage(self, category, usage):
+        """
+        Add the resource usage of a reaped child process to a category.
+
+        Args:
+            category:   The category to add the usage to.
+            usage:      The resource usage structure returned by wait4().
+        """
+        usage = get_usage(usage)
+        with self.__lock:
+            totals = self.__get_category(category)
+            for field in ['user', 'sys', 'read', 'write']:
+                totals[field] += usage[field]
+            totals['maxrss'] = max(totals['maxrss'], usage['maxrss'])
+
+    def get_totals(self):
+        """
+        Get the resources used by all child processes since accounting
+        started.
+
+        Returns:
+            A dictionary of the FIELDS, where "wall" is the time accounted
+            for and "children" the number of accounted commands run.
+        """
+        usage = get_children_usage()
+        totals = {field: usage[field] - self.__start_usage[field]
+                  for field in ['user', 'sys', 'read', 'write']}
+        totals.update({
+            'children': sum(category['children']
+                            for category in self.categories.values()),
+            'wall': time.time() - self.__start,
+            'maxrss': usage['maxrss'],
+        })
+        return totals
+
+    def get_state(self, stage):
+        """
+        Get the resource usage as state.
+
+        Args:
+            stage:  The name of the skt stage the usage is for.
+
+        Returns:
+            A dictionary of state, with the totals in
+            resources_STAGE_FIELD keys and a summary of each category in
+            resources_STAGE_CATEGORY keys.
+        """
+        state = {}
+        for (field, value) in self.get_totals().iteritems():
+            state['resources_{}_{}'.format(stage, field)] = format_value(
+                field, value
+            )
+        for (category, usage) in self.categories.iteritems():
+            state['resources_{}_{}'.format(stage, category)] = ' '.join(
+                '{}={}'.format(field, format_value(field, usage[field]))
+                for field in FIELDS
+            )
+        return state
+
+
+def format_value(field, value):
+    """
+    Format a resource usage value for the state file.
+
+    Args:
+        field:  The field of the value, one of FIELDS.
+        value:  The value.
+
+    Returns:
+        The formatted value, seconds with one decimal place and counts as
+        integers.
+    """
+    if field in ('wall', 'user', 'sys'):
+        return '%.1f' % value
+    return '%d' % value
+
+
+# The accounting of this process
+ACCOUNTING = ResourceAccounting()
+
+
+def account(category):
+    """
+    Account the resources used by the child processes started within a
+    context, see ResourceAccounting.account().
+
+    Args:
+        category:   The category to add the usage to.
+    """
+    return ACCOUNTING.account(category)
+
+
+def _wait(process, accounting, category):
+    """
+    Wait for a process like Popen.wait() does, but reap it with wait4() and
+    add its resource usage to a category.
+
+    Args:
+        process:    The Popen object of the process.
+        accounting: The ResourceAccounting to add the usage to.
+        category:   The category to add the usage to.
+
+    Returns:
+        The exit status of the process.
+    """
+    # pylint: disable=protected-access
+    while process.returncode is None:
+        try:
+            (pid, status, usage) = os.wait4(process.pid, 0)
+        except OSError as exc:
+            if exc.errno == errno.EINTR:
+                continue
+            if exc.errno != errno.ECHILD:
+                raise
+            # Reaped by someone else, the usage is lost
+            (pid, status, usage) = (process.pid, 0, None)
+        if pid == process.pid:
+            process._handle_exitstatus(status)
+            if usage is not None:
+                accounting.add_usage(category, usage)
+
+    return process.returncode
+
+
+def popen(*args, **kwargs):
+    """
+    Start a process with subprocess.Popen. Processes started within an
+    account() context are accounted to its category once waited for.
+
+    Returns:
+        The Popen object.
+    """
+    process = subprocess.Popen(*args, **kwargs)
+    current = getattr(_CONTEXT, 'current', None)
+    if current is not None and isinstance(process, _POPEN):
+        process.wait = lambda: _wait(process, *current)
+    return process
+
+
+def call(*args, **kwargs):
+    """
+    Run a process like subprocess.call(), see popen().
+
+    Returns:
+        The exit status of the process.
+    """
+    return popen(*args, **kwargs).wait()
+
+
+def check_call(*args, **kwargs):
+    """
+    Run a process like subprocess.check_call(), see popen().
+
+    Returns:
+        Zero.
+
+    Raises:
+        CalledProcessError if the process exits with a non-zero status.
+    """
+    returncode = call(*args, **kwargs)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode,
+                                            kwargs.get('args', args[0]))
+    return 0
+
+
+def check_output(*args, **kwargs):
+    """
+    Run a process like subprocess.check_output(), see popen().
+
+    Returns:
+        The output of the process.
+
+    Raises:
+        CalledProcessError if the process exits with a non-zero status.
+    """
+    process = popen(stdout=subprocess.PIPE, *args, **kwargs)
+    (output, _) = process.communicate()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode,
+                                            kwargs.get('args', args[0]),
+                                            output=output)
+    return output
@@ -0,0 +1,164 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Class for caching kernel build results."""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from skt.misc import join_with_slash
+
+
+class BuildCache(object):
+    """
+    BuildCache - a size-bounded directory of kernel build results, keyed by
+    all the build inputs, so identical builds are restored instead of
+    compiled again. The least recently used results are evicted first.
+    """
+
+    def __init__(self, path, max_size=20 * 1024 ** 3):
+        """
+        Initialize a build cache.
+
+        Args:
+            path:       Path to the cache directory. Created if missing.
+            max_size:   Maximum total size of the cached results, in bytes.
+        """
+        self.path = path
+        self.max_size = max_size
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+
+    @classmethod
+    def get_key(cls, tree, config, make_target, arch, cross_compiler_prefix,
+                make_args):
+        """
+        Get the cache key of a build.
+
+        Args:
+            tree:                   Hash of the source tree object.
+            config:                 Content of the kernel configuration.
+            make_target:            The make target.
+            arch:                   The build architecture.
+            cross_compiler_prefix:  The cross compiler prefix, or None.
+            make_args:              A list of extra make arguments.
+
+        Returns:
+            The key, a SHA256 hex digest.
+        """
+        # pylint: disable=too-many-arguments
+        return hashlib.sha256(json.dumps([
+            tree, hashlib.sha256(config).hexdigest(), make_target, arch,
+            cross_compiler_prefix, make_args
+        ])).hexdigest()
+
+    def __get_entry_dir(self, key):
+        """Get the directory of a cache entry."""
+        return join_with_slash(self.path, key)
+
+    def lookup(self, key):
+        """
+        Look up a build result, marking it as recently used.
+
+        Args:
+            key:    The cache key.
+
+        Returns:
+            A dictionary with the cached "package" (tarball or RPM repository)
+            and "config" paths and the "krelease", or None if not cached.
+        """
+        entry_file = join_with_slash(self.__get_entry_dir(key), "entry.json")
+        try:
+            with open(entry_file, 'r') as fileh:
+                entry = json.load(fileh)
+            os.utime(entry_file, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        entry['package'] = join_with_slash(self.__get_entry_dir(key),
+                                           entry['package'])
+        entry['config'] = join_with_slash(self.__get_entry_dir(key),
+                                          "config")
+        return entry
+
+    def store(self, key, package_path, config_path, krelease):
+        """
+        Store a build result, then evict the least recently used results
+        until the cache fits its maximum size.
+
+        Args:
+            key:            The cache key.
+            package_path:   Path to the kernel tarball or RPM repository.
+            config_path:    Path to the kernel configuration.
+            krelease:       The kernel release.
+        """
+        package_name = os.path.basename(os.path.normpath(package_path))
+        tmp_dir = tempfile.mkdtemp(dir=self.path, prefix=".tmp-")
+        try:
+            if os.path.isdir(package_path):
+                shutil.copytree(package_path,
+                                join_with_slash(tmp_dir, package_name))
+            else:
+                shutil.copyfile(package_path,
+                                join_with_slash(tmp_dir, package_name))
+            shutil.copyfile(config_path, join_with_slash(tmp_dir, "config"))
+            with open(join_with_slash(tmp_dir, "entry.json"), 'w') as fileh:
+                json.dump({'package': package_name, 'krelease': krelease},
+                          fileh)
+
+            with open(join_with_slash(self.path, "cache.lock"), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entry_dir = self.__get_entry_dir(key)
+                if os.path.isdir(entry_dir):
+                    shutil.rmtree(entry_dir)
+                os.rename(tmp_dir, entry_dir)
+                self.__evict()
+        except (IOError, OSError) as exc:
+            logging.warning("failed to cache build: %s", exc)
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    @classmethod
+    def __get_size(cls, path):
+        """Get the total size of the files under a directory, in bytes."""
+        size = 0
+        for (dirpath, _, filenames) in os.walk(path):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+        return size
+
+    def __evict(self):
+        """Remove the least recently used results exceeding the size."""
+        entries = []
+        for name in os.listdir(self.path):
+            entry_file = join_with_slash(self.path, name, "entry.json")
+            if os.path.isfile(entry_file):
+                entries.append((os.path.getmtime(entry_file),
+                                self.__get_size(join_with_slash(self.path,
+                                                                name)),
+                                name))
+
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, name) in sorted(entries):
+            if total <= self.max_size:
+                break
+            logging.info("evicting cached build %s", name)
+            shutil.rmtree(join_with_slash(self.path, name))
+            total -= size
@@ -0,0 +1,288 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Class for indexing markers found in build logs."""
+import json
+import os
+import re
+import time
+
+from skt.outputtee import OutputTee
+
+
+class BuildLogIndex(object):
+    """
+    BuildLogIndex - markers found in a build log, such as the built tarball,
+    the written RPMs, compiler errors and warnings, and the commands run,
+    kept in a sidecar file next to the log. The index is updated as output is
+    written to the log, so the log doesn't have to be read again to find
+    them.
+    """
+    # Markers looked for at the start of each line
+    MARKER_REGEX = re.compile(
+        r"^(?:Tarball successfully created in (?P<tarball>.*)"
+        r"|Wrote: (?P<rpm>.*\.rpm)"
+        # kbuild linking vmlinux, checking modules and installing them for
+        # packaging, and rpmbuild packaging
+        r"|(?P<milestone>  LD      vmlinux|  MODPOST|  INSTALL |"
+        r"Processing files:).*"
+        # gcc and clang: "file:line[:column]: severity: message"
+        r"|(?P<cc_file>[^\s:]+):(?P<cc_line>\d+):(?:\d+:)? "
+        r"(?P<cc_severity>error|warning|fatal error): (?P<cc_message>.*)"
+        # ld, about an object: "file.o:(.section+0x10): message"
+        r"|(?P<ld_file>[^\s:]+):\([^)\s]+\): (?P<ld_message>.*)"
+        # ld itself, except the function context of the next line:
+        # "[prefix-]ld[.lld]: [severity: ]message"
+        r"|(?:\S+-)?ld(?:\.\w+)?: (?!.*: in function)"
+        r"(?:(?P<ldx_severity>error|warning): )?(?P<ldx_message>.*)"
+        # modpost: "SEVERITY: [modpost: ]message"
+        r"|(?P<modpost_severity>ERROR|WARNING): (?:modpost: )?"
+        r"(?P<modpost_message>.*)"
+        r")$",
+        re.MULTILINE
+    )
+    # Names of the milestones of a kernel build
+    MILESTONES = {
+        '  LD      vmlinux': 'vmlinux',
+        '  MODPOST': 'modpost',
+        '  INSTALL ': 'package',
+        'Processing files:': 'package',
+    }
+    # Path of the module a modpost message is about
+    MODULE_REGEX = re.compile(r"\[(\S+\.ko)\]")
+    # Version of the sidecar file format
+    VERSION = 3
+    # Maximum number of errors and warnings recorded, all are counted
+    MAX_DIAGNOSTICS = 1000
+    # Maximum length of the recorded messages
+    MAX_MESSAGE = 500
+
+    def __init__(self, buildlog):
+        """
+        Initialize an empty index of a build log.
+
+        Args:
+            buildlog:   The path to the build log.
+        """
+        self.buildlog = buildlog
+        self.path = buildlog + ".index"
+        # Bytes of the log indexed, up to the end of the last whole line
+        self.size = 0
+        self.tarballs = []
+        self.rpms = []
+        # Errors and warnings as dictionaries with the "tool" reporting them
+        # (cc, ld or modpost), the "severity" (error or warning), the "file"
+        # and "line" if known, the "message" and the "offset" of the line in
+        # the log
+        self.diagnostics = []
+        self.counts = {'error': 0, 'warning': 0}
+        # Commands run, as dictionaries with the "command", the "start" and
+        # "end" offsets of their output, their "returncode", the "seconds"
+        # they took and the seconds into the command of the "milestones" of
+        # kernel builds (the first time each one was reached)
+        self.phases = []
+        self.__partial = ""
+        self.__phase_start = None
+
+    @classmethod
+    def load(cls, buildlog):
+        """
+        Load the index of a build log, indexing whatever part of the log
+        isn't yet.
+
+        Args:
+            buildlog:   The path to the build log.
+
+        Returns:
+            The BuildLogIndex.
+        """
+        index = cls(buildlog)
+        try:
+            with open(index.path, 'r') as fileh:
+                data = json.load(fileh)
+            # Indexes of other formats are made again
+            if data['version'] != cls.VERSION:
+                raise ValueError("Unsupported index version")
+            for key in ['size', 'tarballs', 'rpms', 'diagnostics', 'counts',
+                        'phases']:
+                setattr(index, key, data[key])
+        except (IOError, ValueError, KeyError, TypeError):
+            index = cls(buildlog)
+
+        index.update()
+        return index
+
+    def update(self):
+        """Index the part of the log written by others since last time."""
+        try:
+            size = os.path.getsize(self.buildlog)
+        except OSError:
+            size = 0
+
+        # The log was truncated, start over
+        if size < self.size + len(self.__partial):
+            self.__init__(self.buildlog)
+
+        if size > self.size + len(self.__partial):
+            with open(self.buildlog, 'rb') as fileh:
+                fileh.seek(self.size + len(self.__partial))
+                for chunk in iter(lambda: fileh.read(OutputTee.CHUNK_SIZE),
+                                  ''):
+                    self.scan(chunk)
+
+    def scan(self, chunk):
+        """
+        Index a chunk of output appended to the log.
+
+        Args:
+            chunk:  The output.
+        """
+        data = self.__partial + chunk
+        end = data.rfind("\n") + 1
+        self.__partial = data[end:]
+        if not end:
+            return
+
+        for match in self.MARKER_REGEX.finditer(data, 0, end):
+            if match.group('tarball') is not None:
+                self.tarballs.append(match.group('tarball'))
+            elif match.group('rpm') is not None:
+                self.rpms.append(match.group('rpm'))
+            elif match.group('milestone') is not None:
+                self.__add_milestone(match.group('milestone'))
+            else:
+                diagnostic = self.__get_diagnostic(match)
+                self.counts[diagnostic['severity']] += 1
+                if len(self.diagnostics) < self.MAX_DIAGNOSTICS:
+                    diagnostic['offset'] = self.size + match.start()
+                    self.diagnostics.append(diagnostic)
+        self.size += end
+
+    def __get_diagnostic(self, match):
+        """
+        Get a diagnostic from a match of MARKER_REGEX.
+
+        Args:
+            match:  The match of an error or warning.
+
+        Returns:
+            A dictionary with the "tool", "severity", "file", "line" and
+            "message" of the diagnostic.
+        """
+        groups = match.groupdict()
+        diagnostic = {'file': None, 'line': None}
+        if groups['cc_message'] is not None:
+            diagnostic.update({
+                'tool': 'cc',
+                'severity': groups['cc_severity'].split()[-1],
+                'file': groups['cc_file'],
+                'line': int(groups['cc_line']),
+                'message': groups['cc_message']
+            })
+        elif groups['ld_message'] is not None:
+            diagnostic.update({
+                'tool': 'ld',
+                'severity': ('warning'
+                             if groups['ld_message'].startswith('warning:')
+                             else 'error'),
+                'file': groups['ld_file'],
+                'message': groups['ld_message']
+            })
+        elif groups['ldx_message'] is not None:
+            diagnostic.update({
+                'tool': 'ld',
+                'severity': groups['ldx_severity'] or 'error',
+                'message': groups['ldx_message']
+            })
+        else:
+            module = self.MODULE_REGEX.search(groups['modpost_message'])
+            diagnostic.update({
+                'tool': 'modpost',
+                'severity': groups['modpost_severity'].lower(),
+                'file': module.group(1) if module else None,
+                'message': groups['modpost_message']
+            })
+        diagnostic['message'] = diagnostic['message'][:self.MAX_MESSAGE]
+
+        return diagnostic
+
+    def get_diagnostics(self, severity=None):
+        """
+        Get the recorded errors and warnings.
+
+        Args:
+            severity:   The severity to get, "error" or "warning", or None
+                        for both.
+
+        Returns:
+            A list of diagnostics, see the diagnostics attribute.
+        """
+        return [diagnostic for diagnostic in self.diagnostics
+                if severity is None or diagnostic['severity'] == severity]
+
+    def start_phase(self, command):
+        """
+        Mark the start of the output of a command.
+
+        Args:
+            command:    The command.
+        """
+        self.phases.append({
+            'command': command,
+            'start': self.size + len(self.__partial),
+            'end': None,
+            'returncode': None,
+            'seconds': None,
+            'milestones': {}
+        })
+        self.__phase_start = time.time()
+
+    def __add_milestone(self, marker):
+        """
+        Record the time a milestone was reached by the running command.
+
+        Args:
+            marker: The output marking the milestone, see MILESTONES.
+        """
+        # Output indexed later has no meaningful time
+        if self.__phase_start is None:
+            return
+
+        self.phases[-1]['milestones'].setdefault(
+            self.MILESTONES[marker], time.time() - self.__phase_start
+        )
+
+    def end_phase(self, returncode):
+        """
+        Mark the end of the output of the last command started.
+
+        Args:
+            returncode: The return code of the command.
+        """
+        self.phases[-1].update({
+            'end': self.size + len(self.__partial),
+            'returncode': returncode,
+            'seconds': time.time() - self.__phase_start
+        })
+        self.__phase_start = None
+
+    def save(self):
+        """Write the index to its sidecar file."""
+        data = {key: getattr(self, key)
+                for key in ['size', 'tarballs', 'rpms', 'diagnostics',
+                            'counts', 'phases']}
+        data['version'] = self.VERSION
+        tmp_path = "{}.tmp{}".format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fileh:
+            json.dump(data, fileh)
+        os.rename(tmp_path, self.path)
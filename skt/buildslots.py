@@ -0,0 +1,258 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Build slots shared by the skt processes of a host."""
+import errno
+import fcntl
+import itertools
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+# Lease and ticket identifiers unique within the process
+_SEQUENCE = itertools.count()
+
+
+class BuildLease(object):
+    """
+    A lease of build slots, released when the lease is released or its
+    process exits.
+    """
+
+    def __init__(self, slot_files, lease_file, lease_path, wait):
+        """
+        Initialize a lease.
+
+        Args:
+            slot_files: The locked slot files.
+            lease_file: The locked file representing the lease.
+            lease_path: The path of the lease file.
+            wait:       Time in seconds spent waiting for the lease.
+        """
+        self.__slot_files = slot_files
+        self.__lease_file = lease_file
+        self.__lease_path = lease_path
+        self.jobs = len(slot_files)
+        self.wait = wait
+
+    def release(self):
+        """Release the lease and its slots."""
+        if self.__lease_file is None:
+            return
+
+        try:
+            os.unlink(self.__lease_path)
+        except OSError:
+            pass
+        self.__lease_file.close()
+        self.__lease_file = None
+
+        for fileh in self.__slot_files:
+            fileh.close()
+        self.__slot_files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class BuildSlots(object):
+    """
+    A pool of build slots, one per CPU by default, shared by all processes
+    using the same directory. Builds queue for slots in order of priority and
+    arrival, and each one gets at most an equal share of the slots among the
+    builds running and waiting when it starts.
+
+    A build keeps its slots until it finishes, as make can't change the
+    number of jobs it runs. So that builds arriving later don't wait for a
+    build which started alone, no build gets more than the slots minus the
+    reserved ones, and later builds start right away with the reserve.
+
+    Slots, leases and queue tickets are files locked by their owner, so the
+    kernel releases them if the owner crashes.
+    """
+    # Priorities range from 0 to MAX_PRIORITY, higher ones go first
+    MAX_PRIORITY = 99
+    # Seconds between attempts to get slots while waiting
+    POLL_INTERVAL = 1
+
+    def __init__(self, path, slots=None, reserve=None):
+        """
+        Initialize a build slot pool.
+
+        Args:
+            path:       The directory shared by the processes using the pool.
+            slots:      The number of slots, the number of CPUs by default.
+            reserve:    The number of slots no single build gets, kept for
+                        builds arriving later. A quarter of the slots by
+                        default.
+        """
+        self.path = path
+        self.slots = slots if slots else multiprocessing.cpu_count()
+        if reserve is None:
+            reserve = self.slots // 4
+        self.reserve = max(0, min(reserve, self.slots - 1))
+        self.__queue_dir = os.path.join(path, "queue")
+        self.__lease_dir = os.path.join(path, "leases")
+        for directory in [self.__queue_dir, self.__lease_dir]:
+            try:
+                os.makedirs(directory)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+
+    @staticmethod
+    def __create_locked(directory, name):
+        """
+        Create a file locked by this process, appearing only once locked.
+
+        Args:
+            directory:  The directory to create the file in.
+            name:       The file name.
+
+        Returns:
+            A tuple (file, path) of the open file holding the lock and the
+            path of the file.
+        """
+        (fd, tmp_path) = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        fileh = os.fdopen(fd, 'w')
+        fcntl.flock(fileh, fcntl.LOCK_EX)
+        path = os.path.join(directory, name)
+        os.rename(tmp_path, path)
+        return (fileh, path)
+
+    @staticmethod
+    def __get_live(directory):
+        """
+        Get the files in a directory still locked by their owners, removing
+        the ones left behind by crashed processes.
+
+        Args:
+            directory:  The directory of lease or ticket files.
+
+        Returns:
+            A sorted list of names of the live files.
+        """
+        live = []
+        for name in sorted(os.listdir(directory)):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                fileh = open(path, 'r')
+            except IOError:
+                continue
+            with fileh:
+                try:
+                    fcntl.flock(fileh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    live.append(name)
+                    continue
+                logging.info("removing stale build slot file %s", path)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+        return live
+
+    def __lock_slots(self, count):
+        """
+        Lock up to a number of free slots.
+
+        Args:
+            count:  The maximum number of slots to lock.
+
+        Returns:
+            A list of the open slot files holding the locks.
+        """
+        slot_files = []
+        for index in range(self.slots):
+            if len(slot_files) == count:
+                break
+            fileh = open(os.path.join(self.path, "slot-%d" % index), 'a')
+            try:
+                fcntl.flock(fileh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                fileh.close()
+                continue
+            slot_files.append(fileh)
+
+        return slot_files
+
+    def acquire(self, jobs, priority=50):
+        """
+        Wait for build slots.
+
+        Args:
+            jobs:       The number of slots wanted.
+            priority:   The priority of the build, from 0 to MAX_PRIORITY.
+
+        Returns:
+            A BuildLease of at least one and at most jobs slots.
+        """
+        start = time.time()
+        ident = "%d-%d" % (os.getpid(), next(_SEQUENCE))
+        # Tickets sort by priority, then arrival
+        (ticket, ticket_path) = self.__create_locked(
+            self.__queue_dir,
+            "%02d-%017.6f-%s" % (self.MAX_PRIORITY - priority, start, ident)
+        )
+        ticket_name = os.path.basename(ticket_path)
+        try:
+            while True:
+                lease = self.__try_acquire(jobs, ticket_name, ident, start)
+                if lease is not None:
+                    logging.info("got %d build slots after %.1fs",
+                                 lease.jobs, lease.wait)
+                    return lease
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            os.unlink(ticket_path)
+            ticket.close()
+
+    def __try_acquire(self, jobs, ticket_name, ident, start):
+        """
+        Try to get build slots for the build first in the queue.
+
+        Args:
+            jobs:           The number of slots wanted.
+            ticket_name:    The name of the queue ticket of the build.
+            ident:          The identifier of the lease.
+            start:          The time the build started waiting.
+
+        Returns:
+            A BuildLease, or None if the build has to wait.
+        """
+        with open(os.path.join(self.path, "sched.lock"), 'a') as lockh:
+            fcntl.flock(lockh, fcntl.LOCK_EX)
+
+            waiting = self.__get_live(self.__queue_dir)
+            if waiting and waiting[0] != ticket_name:
+                return None
+
+            holders = self.__get_live(self.__lease_dir)
+            share = max(1, min(self.slots - self.reserve,
+                               self.slots // (len(holders) + len(waiting))))
+            slot_files = self.__lock_slots(min(jobs, share))
+            if not slot_files:
+                return None
+
+            (lease_file, lease_path) = self.__create_locked(self.__lease_dir,
+                                                            ident)
+            return BuildLease(slot_files, lease_file, lease_path,
+                              time.time() - start)
@@ -0,0 +1,191 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""A simple content-addressed HTTP object cache server."""
+import argparse
+import BaseHTTPServer
+import logging
+import os
+import re
+import shutil
+import SocketServer
+import tempfile
+
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handle GET, HEAD, PUT and DELETE requests of objects keyed by their path,
+    as used by the ccache HTTP storage backend.
+    """
+    # Keys are made of hex digits, possibly split into subdirectories
+    KEY_REGEX = re.compile(r'^(/[0-9A-Za-z_.-]+)+$')
+    protocol_version = "HTTP/1.1"
+
+    def __get_path(self):
+        """
+        Get the file path of the requested object, and send an error if the
+        request path isn't a valid key.
+
+        Returns:
+            The object path, or None if the key is invalid.
+        """
+        path = self.path.split('?', 1)[0]
+        if not self.KEY_REGEX.match(path) or '/..' in path or '/./' in path:
+            self.send_error(400, "Invalid key")
+            return None
+
+        return os.path.join(self.server.root, path.lstrip('/'))
+
+    def __send_empty(self, code):
+        """Send a response without a body."""
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def __send_object(self, send_body):
+        """Send an object, or its headers only."""
+        path = self.__get_path()
+        if path is None:
+            return
+
+        try:
+            fileh = open(path, 'rb')
+        except IOError:
+            self.send_error(404, "Not found")
+            return
+
+        with fileh:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length",
+                             str(os.fstat(fileh.fileno()).st_size))
+            self.end_headers()
+            if send_body:
+                shutil.copyfileobj(fileh, self.wfile)
+
+    def do_GET(self):
+        """Send an object."""
+        # pylint: disable=invalid-name
+        self.__send_object(True)
+
+    def do_HEAD(self):
+        """Send the headers of an object."""
+        # pylint: disable=invalid-name
+        self.__send_object(False)
+
+    def do_PUT(self):
+        """Store an object. Objects appear atomically, once complete."""
+        # pylint: disable=invalid-name
+        path = self.__get_path()
+        if path is None:
+            return
+
+        try:
+            length = int(self.headers.getheader('Content-Length'))
+        except (TypeError, ValueError):
+            self.send_error(411, "Length required")
+            return
+
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+
+        (fd, tmp_path) = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as fileh:
+                while length > 0:
+                    chunk = self.rfile.read(min(length, 64 * 1024))
+                    if not chunk:
+                        raise IOError("Short request body")
+                    fileh.write(chunk)
+                    length -= len(chunk)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as exc:
+            logging.warning("failed to store %s: %s", self.path, exc)
+            os.unlink(tmp_path)
+            self.send_error(500, "Failed to store object")
+            return
+
+        self.__send_empty(201)
+
+    def do_DELETE(self):
+        """Remove an object."""
+        # pylint: disable=invalid-name
+        path = self.__get_path()
+        if path is None:
+            return
+
+        try:
+            os.unlink(path)
+        except OSError:
+            self.send_error(404, "Not found")
+            return
+
+        self.__send_empty(204)
+
+    def log_message(self, format, *args):
+        """Log requests with the logging module instead of to stderr."""
+        # pylint: disable=redefined-builtin
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server storing objects under a root directory."""
+    daemon_threads = True
+
+    def __init__(self, address, root):
+        """
+        Initialize a cache server.
+
+        Args:
+            address:    A (host, port) tuple to listen on. Port 0 selects a
+                        free port.
+            root:       The directory to store objects in.
+        """
+        self.root = root
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheRequestHandler)
+
+    def get_url(self):
+        """
+        Get the URL of the server.
+
+        Returns:
+            The server URL, without '/' on the end.
+        """
+        (host, port) = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+
+def main():
+    """Run a cache server until interrupted."""
+    parser = argparse.ArgumentParser(
+        description="Serve a directory as an HTTP object cache"
+    )
+    parser.add_argument("root", help="Directory to store objects in")
+    parser.add_argument("--host", default="0.0.0.0",
+                        help="Address to listen on (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="Port to listen on (default: 8080)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = CacheServer((args.host, args.port), os.path.abspath(args.root))
+    logging.info("serving %s at %s", args.root, server.get_url())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,35 @@
+#!/bin/sh
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Run a compiler command, and append the object file it wrote and the time it
+# took in nanoseconds to the file named by SKT_CC_TIMES.
+start=$(date +%s%N)
+"$@"
+status=$?
+if [ -n "$SKT_CC_TIMES" ]; then
+    end=$(date +%s%N)
+    output=
+    prev=
+    for arg in "$@"; do
+        if [ "$prev" = "-o" ]; then
+            output=$arg
+        fi
+        prev=$arg
+    done
+    case "$output" in
+        *.o) echo "$output $((end - start))" >> "$SKT_CC_TIMES" ;;
+    esac
+fi
+exit $status
@@ -20,7 +20,10 @@ import atexit
 import datetime
 import importlib
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import re
 import shutil
 import signal
 import subprocess
@@ -32,10 +35,19 @@ import skt.console
 import skt.publisher
 import skt.reporter
 import skt.runner
-from skt.kernelbuilder import KernelBuilder, CommandTimeoutError, ParsingError
+from skt.accounting import ACCOUNTING
+from skt.buildcache import BuildCache
+from skt.buildslots import BuildSlots
+from skt.kernelbuilder import KernelBuilder, CommandTimeoutError, \
+    ParsingError, TARBALL_COMPRESSIONS, TARBALL_SUFFIXES, get_build_jobs
 from skt.kerneltree import KernelTree, PatchApplicationError
 from skt.misc import join_with_slash, SKT_SUCCESS, SKT_FAIL
-from skt.state_file import get_state, update_state
+from skt.outputtee import OutputTee
+from skt.patchcache import PatchCache
+from skt.referencerepo import ReferenceRepository
+from skt.state_file import get_state, get_target_key, get_target_states, \
+    update_state
+from skt.worktreepool import WorktreePool
 
 DEFAULTRC = "~/.sktrc"
 LOGGER = logging.getLogger()
@@ -136,126 +148,234 @@ def cmd_merge(args):
     # idx[2]: counter of pw option.
     idx = [0, 0, 0]
 
+    # Use a host-wide shared object store, if one was configured.
+    reference = None
+    if args.get('reference_repo'):
+        reference = ReferenceRepository(
+            full_path(args.get('reference_repo')),
+            refresh_interval=args.get('reference_refresh')
+        )
+
+    # Lease a warm worktree from the pool and link it as our workdir, if a
+    # pool was configured.
+    worktree = None
+    if args.get('worktree_pool'):
+        pool = WorktreePool(full_path(args.get('worktree_pool')),
+                            max_trees=args.get('worktree_pool_size'),
+                            fetch_depth=args.get('fetch_depth'))
+        worktree = pool.lease(full_path(args.get('workdir')),
+                              args.get('baserepo'),
+                              args.get('ref') or 'master')
+
     # Clone the kernel tree and check out the proper ref.
     ktree = KernelTree(
         args.get('baserepo'),
         ref=args.get('ref'),
         wdir=full_path(args.get('workdir')),
-        fetch_depth=args.get('fetch_depth')
+        fetch_depth=args.get('fetch_depth'),
+        reference=reference,
+        patch_cache=(PatchCache(full_path(args.get('patch_cache')))
+                     if args.get('patch_cache') else None),
+        fetch_filter=args.get('fetch_filter'),
+        deepen=args.get('deepen'),
+        applied_patches=args.get('applied_patches') or 'apply'
     )
-    bhead = ktree.checkout()
-
-    # Gather the subject and date of the commit that is currently checked out.
-    bsubject = ktree.get_commit_subject(bhead)
-    commitdate = ktree.get_commit_date(bhead)
-
-    # Update the state file with what we know so far.
-    state = {
-        'baserepo': args.get('baserepo'),
-        'basehead': bhead,
-        'basesubject': bsubject,
-        'commitdate': commitdate,
-        'workdir': full_path(args.get('workdir')),
-    }
-    update_state(args['rc'], state)
-
-    # Loop over what we have been asked to merge (if applicable).
-    for thing_to_merge in args.get('merge_queue', []):
-        try:
-            if thing_to_merge[0] == 'merge_ref':
-                mbranch_ref = thing_to_merge[1].split()
-
-                # Update the state file with our merge_ref data.
-                state = {
-                    'mergerepo_%02d' % idx[0]: mbranch_ref[0],
-                    'mergehead_%02d' % idx[0]: bhead
-                }
-                update_state(args['rc'], state)
 
-                # Merge the git ref.
-                (retcode, bhead) = ktree.merge_git_ref(*mbranch_ref)
-
-                if retcode:
-                    return
-
-                # Increment the counter.
-                idx[0] += 1
-
-            else:
-                # Attempt to merge a local patch.
-                if thing_to_merge[0] == 'patch':
-                    # Get the full path to the patch to merge.
-                    patch = os.path.abspath(thing_to_merge[1])
+    # Fetch the base and all the git references to merge at once, the merges
+    # below then use the already fetched references in order.
+    ktree.prefetch([thing_to_merge[1].split()
+                    for thing_to_merge in args.get('merge_queue', [])
+                    if thing_to_merge[0] == 'merge_ref'],
+                   jobs=args.get('fetch_jobs'))
+    # The commit queries below start a "git cat-file" process, which must
+    # not outlive the merge, whichever way it ends.
+    try:
+        bhead = ktree.checkout()
+
+        # Gather the subject and date of the commit that is currently checked
+        # out.
+        bmetadata = ktree.get_commit_metadata(bhead)
+        bsubject = bmetadata['subject']
+        commitdate = bmetadata['date']
+
+        # Update the state file with what we know so far.
+        state = {
+            'baserepo': args.get('baserepo'),
+            'basehead': bhead,
+            'basesubject': bsubject,
+            'commitdate': commitdate,
+            'workdir': full_path(args.get('workdir')),
+        }
+        if worktree:
+            state['worktree'] = worktree
+            state['worktree_pool'] = full_path(args.get('worktree_pool'))
+            state['worktree_pool_size'] = args.get('worktree_pool_size')
+        update_state(args['rc'], state)
 
-                    # Update the state file with our local patch data.
-                    state = {'localpatch_%02d' % idx[1]: patch}
+        # Group consecutive patches into series applied with a single "git am",
+        # if requested.
+        merge_queue = args.get('merge_queue', [])
+        if args.get('patch_series'):
+            merge_queue = group_patch_series(merge_queue)
+
+        # Loop over what we have been asked to merge (if applicable).
+        for thing_to_merge in merge_queue:
+            try:
+                if thing_to_merge[0] == 'merge_ref':
+                    mbranch_ref = thing_to_merge[1].split()
+
+                    # Update the state file with our merge_ref data.
+                    state = {
+                        'mergerepo_%02d' % idx[0]: mbranch_ref[0],
+                        'mergehead_%02d' % idx[0]: bhead
+                    }
                     update_state(args['rc'], state)
 
-                    # Merge the patch.
-                    ktree.merge_patch_file(patch)
+                    # Merge the git ref.
+                    (retcode, bhead) = ktree.merge_git_ref(*mbranch_ref)
+
+                    if retcode:
+                        return
 
                     # Increment the counter.
-                    idx[1] += 1
+                    idx[0] += 1
+
+                else:
+                    # Attempt to merge a local patch.
+                    if thing_to_merge[0] == 'patch':
+                        # Get the full path to the patch to merge.
+                        patch = os.path.abspath(thing_to_merge[1])
+
+                        # Update the state file with our local patch data.
+                        state = {'localpatch_%02d' % idx[1]: patch}
+                        update_state(args['rc'], state)
+
+                        # Merge the patch.
+                        ktree.merge_patch_file(patch)
+
+                        # Increment the counter.
+                        idx[1] += 1
+
+                    # Attempt to merge a patch from patchwork.
+                    elif thing_to_merge[0] == 'pw':
+                        patch = thing_to_merge[1]
+
+                        # Update the state file with our patchwork patch data.
+                        state = {'patchwork_%02d' % idx[2]: patch}
+                        update_state(args['rc'], state)
+
+                        # Merge the patch. Retrieve the Patchwork session
+                        # cookie first.
+                        session_id = get_state(args['rc'],
+                                               'patchwork_session_cookie')
+                        ktree.merge_patchwork_patch(patch, session_id)
+
+                        # Increment the counter.
+                        idx[2] += 1
+
+                    # Attempt to merge a series of local and patchwork patches.
+                    elif thing_to_merge[0] == 'series':
+                        series = thing_to_merge[1]
+                        applied = series
+
+                        session_id = get_state(args['rc'],
+                                               'patchwork_session_cookie')
+                        try:
+                            ktree.merge_patch_series(series, session_id)
+                        except PatchApplicationError as patch_exc:
+                            # Don't record the patches after the failed one.
+                            if patch_exc.index is not None:
+                                applied = series[:patch_exc.index + 1]
+                            raise
+                        finally:
+                            # Update the state file with the patch data and
+                            # increment the counters.
+                            for (patch_type, patch) in applied:
+                                if patch_type == 'patch':
+                                    state = {'localpatch_%02d' % idx[1]: patch}
+                                    idx[1] += 1
+                                else:
+                                    state = {'patchwork_%02d' % idx[2]: patch}
+                                    idx[2] += 1
+                                update_state(args['rc'], state)
+
+            # If the patch application failed, we should set the return code,
+            # log an error, and update our state file.
+            except PatchApplicationError as patch_exc:
+                retcode = SKT_FAIL
+                logging.error(patch_exc)
+
+                # Update the state.
+                state = {'mergelog': ktree.mergelog}
+                update_state(args['rc'], state)
 
-                # Attempt to merge a patch from patchwork.
-                elif thing_to_merge[0] == 'pw':
-                    patch = thing_to_merge[1]
+                return
 
-                    # Update the state file with our patchwork patch data.
-                    state = {'patchwork_%02d' % idx[2]: patch}
-                    update_state(args['rc'], state)
+            # If something else unexpected happened, re-raise the exception.
+            except Exception:
+                (exc, exc_type, trace) = sys.exc_info()
+                raise exc, exc_type, trace
 
-                    # Merge the patch. Retrieve the Patchwork session cookie
-                    # first.
-                    session_id = get_state(args['rc'],
-                                           'patchwork_session_cookie')
-                    ktree.merge_patchwork_patch(patch, session_id)
-
-                    # Increment the counter.
-                    idx[2] += 1
+        # Get the SHA and subject of the repo after applying patches.
+        buildmetadata = ktree.get_commit_metadata()
+        buildhead = buildmetadata['hash']
+        buildsubject = buildmetadata['subject']
 
-        # If the patch application failed, we should set the return code,
-        # log an error, and update our state file.
-        except PatchApplicationError as patch_exc:
-            retcode = SKT_FAIL
-            logging.error(patch_exc)
+        # Update the state file with the data about the current repo commit.
+        state = {
+            'buildhead': buildhead,
+            'buildsubject': buildsubject
+        }
+        if ktree.skipped_patches:
+            state['skipped_patches'] = ' '.join(ktree.skipped_patches)
+        update_state(args['rc'], state)
+    finally:
+        ktree.close_query()
 
-            # Update the state.
-            state = {'mergelog': ktree.mergelog}
-            update_state(args['rc'], state)
 
-            return
+def group_patch_series(merge_queue):
+    """
+    Group consecutive patches in a merge queue into series.
 
-        # If something else unexpected happened, re-raise the exception.
-        except Exception:
-            (exc, exc_type, trace) = sys.exc_info()
-            raise exc, exc_type, trace
+    Args:
+        merge_queue:    A list of ("merge_ref", ref), ("patch", path) and
+                        ("pw", uri) tuples.
 
-    # Get the SHA and subject of the repo after applying patches.
-    buildhead = ktree.get_commit_hash()
-    buildsubject = ktree.get_commit_subject()
+    Returns:
+        The merge queue with each run of two or more consecutive patches
+        replaced by a ("series", patches) tuple, where patches is a list of
+        ("patch", absolute path) and ("pw", uri) tuples.
+    """
+    grouped = []
+    for (merge_type, value) in merge_queue:
+        if merge_type == 'patch':
+            value = os.path.abspath(value)
+
+        if merge_type not in ('patch', 'pw'):
+            grouped.append((merge_type, value))
+        elif grouped and grouped[-1][0] == 'series':
+            grouped[-1][1].append((merge_type, value))
+        elif grouped and grouped[-1][0] in ('patch', 'pw'):
+            grouped[-1] = ('series', [grouped[-1], (merge_type, value)])
+        else:
+            grouped.append((merge_type, value))
 
-    # Update the state file with the data about the current repo commit.
-    state = {
-        'buildhead': buildhead,
-        'buildsubject': buildsubject
-    }
-    update_state(args['rc'], state)
+    return grouped
 
 
-def cmd_build(args):
+def create_builder(args, **kwargs):
     """
-    Build the kernel with specified configuration and put it into a tarball.
+    Create a kernel builder from command line arguments.
 
     Args:
-        args:    Command line arguments
-    """
-    global retcode
-    tstamp = datetime.datetime.strftime(datetime.datetime.now(),
-                                        "%Y%m%d%H%M%S")
+        args:       Command line arguments
+        **kwargs:   Keyword arguments to KernelBuilder overriding the ones
+                    from the command line.
 
-    tgz = None
-    builder = KernelBuilder(
+    Returns:
+        The created KernelBuilder.
+    """
+    builder_args = dict(
         source_dir=args.get('workdir'),
         basecfg=args.get('baseconfig'),
         cfgtype=args.get('cfgtype'),
@@ -263,29 +383,101 @@ def cmd_build(args):
         enable_debuginfo=args.get('enable_debuginfo'),
         rh_configs_glob=args.get('rh_configs_glob'),
         make_target=args.get('make_target'),
-        localversion=args.get('localversion')
+        localversion=args.get('localversion'),
+        ccache_dir=(full_path(args.get('ccache_dir'))
+                    if args.get('ccache_dir') else None),
+        ccache_size=args.get('ccache_size'),
+        ccache_remote=args.get('ccache_remote'),
+        build_cache=(BuildCache(full_path(args.get('build_cache')),
+                                args.get('build_cache_size') * 1024 ** 3)
+                     if args.get('build_cache') else None),
+        build_dir_root=(full_path(args.get('build_dir'))
+                        if args.get('build_dir') else None),
+        load_limit=args.get('load_limit'),
+        build_slots=(BuildSlots(full_path(args.get('build_slots')),
+                                args.get('build_slots_count'),
+                                args.get('build_slots_reserve'))
+                     if args.get('build_slots') else None),
+        build_priority=args.get('build_priority'),
+        output=args.get('build_output'),
+        object_timing=args.get('object_timing'),
+        compression=args.get('compression')
     )
+    builder_args.update(kwargs)
+    return KernelBuilder(**builder_args)
 
-    # Clean the kernel source with 'make mrproper' if requested.
-    if args.get('wipe'):
-        builder.clean_kernel_source()
 
-    # Gather additional details about the build and save them to the state
-    # file.
-    kernel_arch = builder.build_arch
-    make_opts = builder.assemble_make_options()
+def get_make_jobs(args, targets=1):
+    """
+    Choose the number of make jobs for each of the concurrent builds.
+
+    Args:
+        args:       Command line arguments
+        targets:    The number of concurrent builds sharing the host.
+
+    Returns:
+        A tuple (jobs, state), where jobs is the number of make jobs for each
+        build and state is a dictionary of state describing the choice.
+    """
+    make_jobs = args.get('make_jobs')
+    if make_jobs == 'auto':
+        limits = get_build_jobs(args.get('memory_per_job') * 1024 ** 2)
+        state = {
+            'make_jobs_cpus': limits['cpus'],
+            'make_jobs_load': '%.2f' % limits['load']
+        }
+        if limits['memory'] is not None:
+            state['make_jobs_memory'] = limits['memory']
+        return (max(1, limits['jobs'] // targets), state)
+    elif make_jobs:
+        return (int(make_jobs), {})
+
+    return (max(1, multiprocessing.cpu_count() // targets), {})
+
+
+def get_build_details(builder):
+    """
+    Gather details about a build before it runs.
+
+    Args:
+        builder:    The KernelBuilder.
+
+    Returns:
+        A dictionary of state.
+    """
     state = {
-        'kernel_arch': kernel_arch,
-        'make_opts': ' '.join(make_opts)
+        'kernel_arch': builder.build_arch,
+        'make_opts': ' '.join(builder.assemble_make_options()),
+        'make_jobs': builder.jobs
     }
-    update_state(args['rc'], state)
+    if builder.load_limit is not None:
+        state['make_load_limit'] = builder.load_limit
+    if builder.output_dir != builder.source_dir:
+        state['build_dir'] = builder.output_dir
 
-    # Write the cross compiler prefix to the state file only if the
-    # environment variable is set:
-    cross_compiler_prefix = builder.cross_compiler_prefix
-    if cross_compiler_prefix:
-        state = {'cross_compiler_prefix': cross_compiler_prefix}
-        update_state(args['rc'], state)
+    # Save the cross compiler prefix only if one is used.
+    if builder.cross_compiler_prefix:
+        state['cross_compiler_prefix'] = builder.cross_compiler_prefix
+
+    return state
+
+
+def build_kernel(args, builder, prefix):
+    """
+    Build a kernel and name its tarball and configuration after the built
+    commit.
+
+    Args:
+        args:       Command line arguments
+        builder:    The KernelBuilder.
+        prefix:     The path prefix of the tarball and configuration files.
+
+    Returns:
+        A tuple (state, success), where state is a dictionary of state and
+        success is True if the build succeeded.
+    """
+    state = {}
+    success = True
 
     # Attempt to compile the kernel.
     package_path = None
@@ -297,89 +489,326 @@ def cmd_build(args):
             IOError) as exc:
         logging.error(exc)
 
-        # Update the state file with the path to the build log.
-        state = {'buildlog': builder.buildlog}
-        update_state(args['rc'], state)
-
-        # Set the return code.
-        retcode = SKT_FAIL
+        # Save the path to the build log.
+        state['buildlog'] = builder.buildlog
+        success = False
     # Re-raise any unexpected exceptions.
     except Exception:
         (exc, exc_type, trace) = sys.exc_info()
         raise exc, exc_type, trace
 
-    # Get the SHA of the commit from the repo that we just compiled.
-    buildhead = get_state(args['rc'], 'buildhead')
+    # Save whether the build was restored from the build cache.
+    if args.get('build_cache'):
+        state['build_cache'] = 'hit' if builder.build_cache_hit else 'miss'
+
+    # Save where the build spent its time.
+    if builder.timings:
+        state['build_timing'] = builder.timing_path
+        for (phase, seconds) in builder.timings:
+            state['time_{}'.format(phase)] = '%.1f' % seconds
+        for (milestone, seconds) in builder.milestones.iteritems():
+            state['time_to_{}'.format(milestone)] = '%.1f' % seconds
+        slowest = builder.get_object_timings()[:5]
+        if builder.object_timing and slowest:
+            state['slowest_objects'] = ' '.join(
+                '{}:{:.1f}'.format(obj, seconds) for (obj, seconds) in slowest
+            )
+
+    # Save the share of the host-wide build slots the build got.
+    if builder.build_lease:
+        (jobs, wait) = builder.build_lease
+        state['build_slots_jobs'] = jobs
+        state['build_slots_wait'] = '%.1f' % wait
+
+    # Save the compiler cache efficiency of this build.
+    if builder.ccache_stats:
+        (hits, misses, remote_hits) = builder.ccache_stats
+        state.update({
+            'ccache_hits': hits,
+            'ccache_misses': misses,
+            'ccache_remote_hits': remote_hits,
+            'ccache_hit_rate': '%.1f%%' % (
+                100.0 * hits / (hits + misses) if hits + misses else 0
+            )
+        })
 
     # Handle any built tarballs.
-    if package_path and package_path.endswith('tar.gz'):
-        if buildhead:
-            # Replace the filename with the SHA of the last commit in the repo.
-            ttgz = "{}.tar.gz".format(buildhead)
-        else:
-            # Add a timestamp to the path if we have no commit to reference.
-            ttgz = addtstamp(tgz, tstamp)
+    suffixes = [suffix for suffix in TARBALL_SUFFIXES
+                if package_path and package_path.endswith(suffix)]
+    if suffixes:
+        ttgz = "{}{}".format(prefix, suffixes[0])
 
         # Rename the kernel tarball.
         shutil.move(package_path, ttgz)
         logging.info("tarball path: %s", ttgz)
 
-        # Save our tarball path to the state file.
-        state = {'tarpkg': ttgz}
-        update_state(args['rc'], state)
+        # Save our tarball path.
+        state['tarpkg'] = ttgz
 
     # Handle any RPM repositories.
     if package_path and 'rpm_repo' in package_path:
-        state = {'rpm_repo': package_path}
-        update_state(args['rc'], state)
+        state['rpm_repo'] = package_path
 
-    # Set a filename for the kernel config file based on the SHA of the last
-    # commit in the repo.
-    tconfig = '{}.config'.format(buildhead)
+    # Set a filename for the kernel config file.
+    tconfig = '{}.config'.format(prefix)
 
     try:
-        # Rename the config file and save its location to our state file.
+        # Rename the config file and save its location.
         shutil.copyfile(builder.get_cfgpath(), tconfig)
-        state = {'buildconf': tconfig}
-        update_state(args['rc'], state)
+        state['buildconf'] = tconfig
 
         # Get the kernel version string.
-        krelease = builder.getrelease()
-        state = {'krelease': krelease}
-        update_state(args['rc'], state)
+        state['krelease'] = builder.getrelease()
 
     except IOError:  # Kernel config failed to build
         tconfig = ''
         logging.error('No config file to copy found!')
 
+    return (state, success)
+
+
+def parse_build_target(target):
+    """
+    Parse a build target specification.
+
+    Args:
+        target: A string in 'ARCH [key=value ...]' format. Supported keys are
+                "name", "cross_compile", "config", "cfgtype" and
+                "rh_configs_glob".
+
+    Returns:
+        A dictionary of the target's settings, with "arch" and "name" always
+        present. The name defaults to the architecture, and may only contain
+        lowercase letters, digits, "_" and "-".
+
+    Raises:
+        ValueError if the specification is invalid.
+    """
+    fields = target.split()
+    if not fields:
+        raise ValueError("Empty build target")
+
+    settings = {'arch': fields[0], 'name': fields[0]}
+    for field in fields[1:]:
+        (key, sep, value) = field.partition('=')
+        if not sep or key not in ('name', 'cross_compile', 'config',
+                                  'cfgtype', 'rh_configs_glob'):
+            raise ValueError("Invalid build target setting: %s" % field)
+        settings[key] = value
+
+    # Target names are part of state keys, which the state file lowercases
+    if not re.match(r'^[a-z0-9_-]+$', settings['name']):
+        raise ValueError("Invalid build target name: %s" % settings['name'])
+
+    return settings
+
+
+def cmd_build_targets(args, buildhead, tstamp):
+    """
+    Build the kernel for several targets concurrently, each out of the source
+    tree and with an equal share of the CPUs. The state of each target is
+    saved under keys namespaced with get_target_key().
+
+    Args:
+        args:       Command line arguments
+        buildhead:  The built commit, or None if unknown.
+        tstamp:     The time stamp to name files after, if the commit is
+                    unknown.
+    """
+    global retcode
+
+    targets = [parse_build_target(target) for target in args['target']]
+    (jobs, state) = get_make_jobs(args, len(targets))
+    # Each target needs its own output directory
+    build_dir = (full_path(args.get('build_dir')) if args.get('build_dir')
+                 else full_path(args.get('workdir')).rstrip('/') + '-builds')
+
+    builders = []
+    for target in targets:
+        builder = create_builder(
+            args,
+            basecfg=target.get('config', args.get('baseconfig')),
+            cfgtype=target.get('cfgtype', args.get('cfgtype')),
+            rh_configs_glob=target.get('rh_configs_glob',
+                                       args.get('rh_configs_glob')),
+            build_dir_root=build_dir,
+            build_arch=target['arch'],
+            cross_compiler_prefix=target.get('cross_compile', ''),
+            jobs=jobs,
+            buildlog=join_with_slash(args.get('workdir'),
+                                     "build-{}.log".format(target['name'])),
+            name=target['name']
+        )
+        if args.get('wipe'):
+            builder.clean_kernel_source()
+        builders.append(builder)
+
+    state['build_targets'] = ' '.join(target['name'] for target in targets)
+    for (target, builder) in zip(targets, builders):
+        for (key, val) in get_build_details(builder).iteritems():
+            state[get_target_key(target['name'], key)] = val
+    update_state(args['rc'], state)
+
+    def build(index):
+        """Build a single target."""
+        name = targets[index]['name']
+        prefix = ("{}-{}".format(buildhead, name) if buildhead
+                  else "{}-{}".format(tstamp, name))
+        return build_kernel(args, builders[index], prefix)
+
+    logging.info("building %d targets with %d jobs each", len(targets),
+                 jobs)
+    pool = ThreadPool(len(targets))
+    try:
+        results = pool.map(build, range(len(targets)))
+    finally:
+        pool.close()
+        pool.join()
+
+    state = {}
+    for (target, (target_state, success)) in zip(targets, results):
+        for (key, val) in target_state.iteritems():
+            state[get_target_key(target['name'], key)] = val
+        if not success:
+            retcode = SKT_FAIL
+    update_state(args['rc'], state)
+
+
+def cmd_build(args):
+    """
+    Build the kernel with specified configuration and put it into a tarball.
+
+    Args:
+        args:    Command line arguments
+    """
+    global retcode
+    tstamp = datetime.datetime.strftime(datetime.datetime.now(),
+                                        "%Y%m%d%H%M%S")
+
+    # Get the SHA of the commit from the repo that we are about to compile.
+    buildhead = get_state(args['rc'], 'buildhead')
+
+    if args.get('target'):
+        cmd_build_targets(args, buildhead, tstamp)
+        return
+
+    (jobs, state) = get_make_jobs(args)
+    builder = create_builder(args, jobs=jobs)
+
+    # Clean the kernel source with 'make mrproper' if requested.
+    if args.get('wipe'):
+        builder.clean_kernel_source()
+
+    # Gather additional details about the build and save them to the state
+    # file.
+    state.update(get_build_details(builder))
+    update_state(args['rc'], state)
+
+    # Name the files after the commit, or add a timestamp if we have no
+    # commit to reference.
+    (state, success) = build_kernel(args, builder, buildhead or tstamp)
+    update_state(args['rc'], state)
+    if not success:
+        retcode = SKT_FAIL
+
+
+def cmd_check_merge(args):
+    """
+    Check which of the git references and patches still apply to the base,
+    each one on its own, without checking anything out. Print a table of the
+    results and fail if any of them doesn't apply.
+
+    Args:
+        args:    Command line arguments
+    """
+    global retcode
+
+    ktree = KernelTree(
+        args.get('baserepo'),
+        ref=args.get('ref'),
+        wdir=full_path(args.get('workdir')),
+        fetch_depth=args.get('fetch_depth')
+    )
+
+    merge_queue = args.get('merge_queue', [])
+    session_id = get_state(args['rc'], 'patchwork_session_cookie')
+    results = ktree.check_mergeability(merge_queue, session_id=session_id,
+                                       jobs=args.get('jobs'))
+    ktree.close_query()
+
+    for ((_, value), (status, files)) in zip(merge_queue, results):
+        print("%-8s %s%s" % (status, value,
+                             " (%s)" % ", ".join(files) if files else ""))
+        if status != 'pass':
+            retcode = SKT_FAIL
+
+
+def cmd_maintain(args):
+    """
+    Optimize a long-lived kernel repository, preferably between pipelines, so
+    the git commands run by the following ones stay fast.
+
+    Args:
+        args:    Command line arguments
+    """
+    ktree = KernelTree(args.get('baserepo'),
+                       wdir=full_path(args.get('workdir')))
+
+    remote_max_age = args.get('remote_max_age')
+    if remote_max_age is not None:
+        remote_max_age *= 24 * 60 * 60
+
+    loose_before, packs_before = ktree.get_object_counts()
+    timings = ktree.maintain(remote_max_age=remote_max_age)
+    loose_after, packs_after = ktree.get_object_counts()
+
+    # Save how long each step took along with its effect.
+    state = {
+        'maintenance_loose_objects': '%d -> %d' % (loose_before, loose_after),
+        'maintenance_packs': '%d -> %d' % (packs_before, packs_after),
+    }
+    for step, duration in timings:
+        state['maintenance_%s_time' % step] = '%.2f' % duration
+    update_state(args['rc'], state)
+
 
 def cmd_publish(cfg):
     """
     Publish (copy) the kernel tarball and configuration to the specified
     location, generating their resulting URLs, using the specified "publisher".
-    Only "cp", "scp" and "sftp" publishers are supported at the moment.
+    Only "cp", "scp" and "sftp" publishers are supported at the moment. The
+    files of each target of a build of several targets are published, and
+    their URLs saved in the state of the target.
 
     Args:
         cfg:    A dictionary of skt configuration.
     """
     publisher = skt.publisher.getpublisher(*cfg.get('publisher'))
 
-    if cfg.get('buildconf'):
-        cfgurl = publisher.publish(cfg.get('buildconf'))
-        save_state(cfg, {'cfgurl': cfgurl})
+    names = (cfg.get('build_targets') or '').split() or [None]
+    for (name, target) in zip(names, get_target_states(cfg)):
+        state = {}
+        if target.get('buildconf'):
+            state['cfgurl'] = publisher.publish(target.get('buildconf'))
 
-    if cfg.get('tarpkg'):
-        url = publisher.publish(cfg.get('tarpkg'))
-        logging.info("published tarpkg url: %s", url)
-        save_state(cfg, {'buildurl': url})
-    else:
-        logging.debug('No kernel tarball to publish found!')
+        if target.get('tarpkg'):
+            url = publisher.publish(target.get('tarpkg'))
+            logging.info("published tarpkg url: %s", url)
+            state['buildurl'] = url
+        else:
+            logging.debug('No kernel tarball to publish found!')
+
+        if name:
+            state = {get_target_key(name, key): val
+                     for (key, val) in state.iteritems()}
+        save_state(cfg, state)
 
 
 def cmd_run(cfg):
     """
     Run tests on a built kernel using the specified "runner". Only "Beaker"
-    runner is currently supported.
+    runner is currently supported. The kernel of the first target of a build
+    of several targets is tested.
 
     Args:
         cfg:    A dictionary of skt configuration.
@@ -387,15 +816,16 @@ def cmd_run(cfg):
     global retcode
 
     runner = skt.runner.getrunner(*cfg.get('runner'))
+    target = get_target_states(cfg)[0]
 
     atexit.register(runner.cleanup_handler)
     signal.signal(signal.SIGINT, runner.signal_handler)
     signal.signal(signal.SIGTERM, runner.signal_handler)
-    retcode = runner.run(cfg.get('buildurl'),
+    retcode = runner.run(target.get('buildurl'),
                          cfg.get('max_aborted_count'),
-                         cfg.get('krelease'),
+                         target.get('krelease'),
                          cfg.get('wait'),
-                         arch=cfg.get("kernel_arch"),
+                         arch=target.get("kernel_arch"),
                          waiving=cfg.get('waiving'))
 
     recipe_set_index = 0
@@ -411,10 +841,45 @@ def cmd_run(cfg):
     save_state(cfg, {'retcode': retcode})
 
 
+def release_worktree(cfg):
+    """
+    Return the worktree leased by the merge stage to its pool, and remove the
+    workdir link to it. Does nothing if no worktree is leased.
+
+    Args:
+        cfg:    A dictionary of skt configuration.
+    """
+    workdir = cfg.get('workdir')
+    if not cfg.get('worktree_pool') or not workdir:
+        return
+
+    workdir = full_path(workdir)
+    if not os.path.islink(workdir):
+        return
+
+    pool = WorktreePool(full_path(cfg.get('worktree_pool')),
+                        max_trees=int(cfg.get('worktree_pool_size') or 4))
+    pool.release(workdir)
+
+
 def cmd_report(cfg):
     """
     Report build and/or test results using the specified "reporter". Currently
-    results can be reported by e-mail or printed to stdout.
+    results can be reported by e-mail or printed to stdout. Reporting ends the
+    pipeline, so the leased worktree, if any, is returned afterwards.
+
+    Args:
+        cfg:    A dictionary of skt configuration.
+    """
+    try:
+        report(cfg)
+    finally:
+        release_worktree(cfg)
+
+
+def report(cfg):
+    """
+    Report build and/or test results using the specified "reporter".
 
     Args:
         cfg:    A dictionary of skt configuration.
@@ -629,6 +1094,93 @@ def setup_parser():
         ),
         default=None
     )
+    parser_merge.add_argument(
+        "--fetch-filter",
+        type=str,
+        help=(
+            "Fetch a partial clone using the specified filter, e.g. "
+            "'blob:none' to fetch file contents only when needed"
+        ),
+        default=None
+    )
+    parser_merge.add_argument(
+        "--deepen",
+        action="store_true",
+        default=False,
+        help=(
+            "Fetch references to merge with --fetch-depth too, and add "
+            "history only until a merge base is found"
+        )
+    )
+    parser_merge.add_argument(
+        "--reference-repo",
+        type=str,
+        help=(
+            "Path to a shared bare repository used as an object cache for "
+            "all work directories on this host (created if missing)"
+        ),
+        default=None
+    )
+    parser_merge.add_argument(
+        "--reference-refresh",
+        type=int,
+        help=(
+            "Minimum number of seconds between two updates of the reference "
+            "repository (default: 3600)"
+        ),
+        default=3600
+    )
+    parser_merge.add_argument(
+        "--worktree-pool",
+        type=str,
+        help=(
+            "Path to a pool of worktrees sharing one repository; the workdir "
+            "becomes a link to a worktree leased from it"
+        ),
+        default=None
+    )
+    parser_merge.add_argument(
+        "--worktree-pool-size",
+        type=int,
+        help="Maximum number of worktrees in the pool (default: 4)",
+        default=4
+    )
+    parser_merge.add_argument(
+        "--fetch-jobs",
+        type=int,
+        help=(
+            "Maximum number of references to fetch concurrently before "
+            "merging (default: 4)"
+        ),
+        default=4
+    )
+    parser_merge.add_argument(
+        "--patch-cache",
+        type=str,
+        help=(
+            "Path to a directory remembering the results of applying patches "
+            "to base commits, to skip applying them again"
+        ),
+        default=None
+    )
+    parser_merge.add_argument(
+        "--patch-series",
+        action="store_true",
+        default=False,
+        help=(
+            "Apply consecutive patches as a series, with a single 'git am' "
+            "run"
+        )
+    )
+    parser_merge.add_argument(
+        "--applied-patches",
+        choices=["apply", "skip", "fail"],
+        default="apply",
+        help=(
+            "What to do with patches already present in the base history, "
+            "matched by patch-id (default: apply)"
+        )
+    )
 
     # These arguments apply to the 'build' skt command
     parser_build = subparsers.add_parser("build", add_help=False)
@@ -661,6 +1213,140 @@ def setup_parser():
         type=str,
         help="Additional options to pass to make"
     )
+    parser_build.add_argument(
+        "--ccache-dir",
+        type=str,
+        help=(
+            "Cache compiler output with ccache under this directory, in a "
+            "subdirectory for each architecture"
+        )
+    )
+    parser_build.add_argument(
+        "--ccache-size",
+        type=str,
+        help="Maximum size of each ccache directory, e.g. '10G'"
+    )
+    parser_build.add_argument(
+        "--ccache-remote",
+        type=str,
+        help=(
+            "URL of a remote storage shared by all builders, e.g. "
+            "'http://cache.example.com:8080/ccache' (requires --ccache-dir "
+            "and ccache 4.4 or later)"
+        )
+    )
+    parser_build.add_argument(
+        "--build-dir",
+        type=str,
+        help=(
+            "Build out of the source tree (O=), in a persistent subdirectory "
+            "of this directory matching the configuration and toolchain, "
+            "for incremental rebuilds"
+        )
+    )
+    parser_build.add_argument(
+        "--target",
+        type=str,
+        action="append",
+        help=(
+            "Build for several targets concurrently, format: 'ARCH "
+            "[name=NAME] [cross_compile=PREFIX] [config=CONFIG_FILE] "
+            "[cfgtype=CFGTYPE] [rh_configs_glob=GLOB]' (use multiple times "
+            "for multiple targets)"
+        )
+    )
+    parser_build.add_argument(
+        "--make-jobs",
+        type=str,
+        help=(
+            "Number of make jobs, or 'auto' to choose it from the cgroup CPU "
+            "and memory limits and the current load (default: number of "
+            "CPUs, shared between targets)"
+        )
+    )
+    parser_build.add_argument(
+        "--memory-per-job",
+        type=int,
+        default=1024,
+        help="Memory in MiB a single job needs with --make-jobs auto "
+             "(default: 1024)"
+    )
+    parser_build.add_argument(
+        "--load-limit",
+        type=float,
+        help="Don't start new make jobs while the load average is above "
+             "this limit"
+    )
+    parser_build.add_argument(
+        "--build-output",
+        choices=OutputTee.MODES,
+        default='full',
+        help=(
+            "How to show the build output on stdout, when verbose enough: "
+            "'full', 'throttle' to a progress line every {} seconds, or "
+            "'summary' of the last lines once done (default: full). The "
+            "build log always gets the full output.".format(
+                OutputTee.THROTTLE_INTERVAL
+            )
+        )
+    )
+    parser_build.add_argument(
+        "--compression",
+        choices=TARBALL_COMPRESSIONS,
+        default='gzip',
+        help=(
+            "How to compress targz-pkg tarballs: 'gzip' as the kernel does, "
+            "or 'pigz' or 'zstd' with as many threads as make jobs, making "
+            ".tar.gz or .tar.zst tarballs (default: gzip)"
+        )
+    )
+    parser_build.add_argument(
+        "--object-timing",
+        action="store_true",
+        help="Record the time taken to compile each object"
+    )
+    parser_build.add_argument(
+        "--build-slots",
+        type=str,
+        help=(
+            "Directory of build slots shared by the builds of the host, "
+            "which queue for slots and run as many make jobs as slots they "
+            "get"
+        )
+    )
+    parser_build.add_argument(
+        "--build-slots-count",
+        type=int,
+        help="Number of build slots of the host (default: number of CPUs)"
+    )
+    parser_build.add_argument(
+        "--build-slots-reserve",
+        type=int,
+        help="Number of build slots no single build gets, kept for builds "
+             "starting later (default: a quarter of the slots)"
+    )
+    parser_build.add_argument(
+        "--build-priority",
+        type=int,
+        default=50,
+        help="Priority of the build waiting for build slots, from 0 to 99, "
+             "higher ones go first (default: 50)"
+    )
+    parser_build.add_argument(
+        "--build-cache",
+        type=str,
+        help=(
+            "Directory to cache build results in, restored instead of "
+            "building again for identical sources, configuration and make "
+            "options"
+        )
+    )
+    parser_build.add_argument(
+        "--build-cache-size",
+        type=int,
+        default=20,
+        help="Maximum size of the build cache in GiB (default: 20)"
+    )
     parser_build.add_argument(
         "--make-target",
         dest="make_target",
@@ -830,6 +1516,70 @@ def setup_parser():
         + 'same krelease.'
     )
 
+    # These arguments apply to the 'check-merge' skt subcommand
+    parser_check_merge = subparsers.add_parser("check-merge", add_help=False)
+    parser_check_merge.add_argument(
+        "-b",
+        "--baserepo",
+        type=str,
+        required=True,
+        help="Base repo URL"
+    )
+    parser_check_merge.add_argument(
+        "--ref",
+        type=str,
+        help="Base repo ref to check against (default: master)"
+    )
+    parser_check_merge.add_argument(
+        "--patch",
+        type=str,
+        action=AppendMergeArgument,
+        help="Path to a local patch to check "
+        + "(use multiple times for multiple patches)"
+    )
+    parser_check_merge.add_argument(
+        "--pw",
+        type=str,
+        action=AppendMergeArgument,
+        help="URL to Patchwork patch to check "
+        + "(use multiple times for multiple patches)"
+    )
+    parser_check_merge.add_argument(
+        "-m",
+        "--merge-ref",
+        action=AppendMergeArgument,
+        help="Merge ref format: 'url [ref]' "
+        + "(use multiple times for multiple merge refs)"
+    )
+    parser_check_merge.add_argument(
+        "--fetch-depth",
+        type=str,
+        help="Create a shallow clone with a history truncated to the "
+        + "specified number of commits"
+    )
+    parser_check_merge.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help="Maximum number of concurrent checks (default: 4)"
+    )
+
+    # These arguments apply to the 'maintain' skt subcommand
+    parser_maintain = subparsers.add_parser("maintain", add_help=False)
+    parser_maintain.add_argument(
+        "-b",
+        "--baserepo",
+        type=str,
+        required=True,
+        help="Base repo URL"
+    )
+    parser_maintain.add_argument(
+        "--remote-max-age",
+        type=int,
+        help="Remove merge remotes not used for DAYS days",
+        metavar="DAYS"
+    )
+
     parser_all = subparsers.add_parser(
         "all",
         parents=[
@@ -877,6 +1627,18 @@ def setup_parser():
         help='Console sub-command help',
         action='help'
     )
+    parser_check_merge.add_argument(
+        "-h",
+        "--help",
+        help="Check-merge sub-command help",
+        action="help"
+    )
+    parser_maintain.add_argument(
+        "-h",
+        "--help",
+        help="Maintain sub-command help",
+        action="help"
+    )
 
     parser_merge.set_defaults(func=cmd_merge)
     parser_merge.set_defaults(_name="merge")
@@ -888,6 +1650,10 @@ def setup_parser():
     parser_run.set_defaults(_name="run")
     parser_console.set_defaults(func=cmd_console_check)
     parser_console.set_defaults(_name='console_check')
+    parser_check_merge.set_defaults(func=cmd_check_merge)
+    parser_check_merge.set_defaults(_name="check_merge")
+    parser_maintain.set_defaults(func=cmd_maintain)
+    parser_maintain.set_defaults(_name="maintain")
     parser_all.set_defaults(func=cmd_all)
     parser_all.set_defaults(_name="all")
 
@@ -1031,12 +1797,42 @@ def check_args(parser, args):
       parser - the parser object
       args   - the parsed arguments
     """
+    # The "all" command takes the build options too
+    building = args._name in ('build', 'all')
+
     # Users must specify a glob to match generated kernel config files when
     # building configs with `make rh-configs`
-    if (args._name == 'build' and args.cfgtype == 'rh-configs'
+    if (building and args.cfgtype == 'rh-configs'
             and not args.rh_configs_glob):
         parser.error("--cfgtype rh-configs requires --rh-configs-glob to set")
 
+    # Build targets must be valid and uniquely named
+    if building and args.target:
+        try:
+            names = [parse_build_target(target)['name']
+                     for target in args.target]
+        except ValueError as exc:
+            parser.error(str(exc))
+        if len(set(names)) != len(names):
+            parser.error("build target names must be unique, use name=NAME")
+
+    # The number of make jobs is either chosen automatically or given
+    if (building and args.make_jobs
+            and args.make_jobs != 'auto'
+            and (not args.make_jobs.isdigit() or int(args.make_jobs) < 1)):
+        parser.error("--make-jobs must be a positive number or 'auto'")
+
+    # Build priorities must be in the range build slots support
+    if (building
+            and not 0 <= args.build_priority <= BuildSlots.MAX_PRIORITY):
+        parser.error("--build-priority must be between 0 and %d" %
+                     BuildSlots.MAX_PRIORITY)
+
+    # A remote compiler cache backs a local one
+    if (building and args.ccache_remote
+            and not args.ccache_dir):
+        parser.error("--ccache-remote requires --ccache-dir to set")
+
     # Check required arguments for 'report'
     if args._name == 'report':
 
@@ -1070,12 +1866,16 @@ def main():
 
         # We are gradually migrating away from messing with cfg and passing
         # it everywhere.
+        # Save the resources used by the commands the stage ran, too.
         var_args = vars(args)
-        if var_args['_name'] in ['merge', 'build']:
+        if var_args['_name'] in ['merge', 'build', 'check_merge', 'maintain']:
             args.func(var_args)
+            update_state(var_args['rc'],
+                         ACCOUNTING.get_state(var_args['_name']))
         else:
             cfg = load_config(args)
             args.func(cfg)
+            save_state(cfg, ACCOUNTING.get_state(var_args['_name']))
 
         sys.exit(retcode)
     except KeyboardInterrupt:
@@ -12,7 +12,11 @@
 # along with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Class for building kernels"""
+from distutils.spawn import find_executable
+import fcntl
 import glob
+import hashlib
+import json
 import logging
 import multiprocessing
 import os
@@ -21,9 +25,150 @@ import re
 import shlex
 import shutil
 import subprocess
-import sys
+import threading
+import time
 
+from skt import accounting
+from skt.buildlogindex import BuildLogIndex
 from skt.misc import join_with_slash
+from skt.outputtee import OutputTee
+
+
+def get_cgroup_dirs(proc_cgroup="/proc/self/cgroup",
+                    cgroup_root="/sys/fs/cgroup"):
+    """
+    Get the cgroup v2 directories of the current process and its ancestors.
+
+    Args:
+        proc_cgroup:    Path to the cgroup membership file of the process.
+        cgroup_root:    Path to the cgroup v2 hierarchy mount point.
+
+    Returns:
+        A list of directories, starting with the one of the process, empty
+        if the process is not in a cgroup v2 hierarchy.
+    """
+    try:
+        with open(proc_cgroup, 'r') as fileh:
+            lines = fileh.read().splitlines()
+    except IOError:
+        return []
+
+    for line in lines:
+        if line.startswith("0::"):
+            path = line[len("0::"):].strip('/')
+            break
+    else:
+        return []
+
+    dirs = []
+    parts = path.split('/') if path else []
+    while True:
+        dirs.append(os.path.join(cgroup_root, *parts))
+        if not parts:
+            return dirs
+        parts.pop()
+
+
+def get_cpu_limit(cgroup_dirs):
+    """
+    Get the number of CPUs available to the process, honouring the cgroup
+    CPU quotas.
+
+    Args:
+        cgroup_dirs:    The cgroup directories, see get_cgroup_dirs().
+
+    Returns:
+        The number of CPUs.
+    """
+    cpus = multiprocessing.cpu_count()
+    for cgroup_dir in cgroup_dirs:
+        try:
+            with open(os.path.join(cgroup_dir, "cpu.max"), 'r') as fileh:
+                (quota, period) = fileh.read().split()[:2]
+        except (IOError, ValueError):
+            continue
+        if quota != "max":
+            # Round up, a partial CPU still runs a job
+            cpus = min(cpus, max(1, -(-int(quota) // int(period))))
+
+    return cpus
+
+
+def get_memory_limit(cgroup_dirs, proc_meminfo="/proc/meminfo"):
+    """
+    Get the amount of memory available to the process, honouring the cgroup
+    memory limits.
+
+    Args:
+        cgroup_dirs:    The cgroup directories, see get_cgroup_dirs().
+        proc_meminfo:   Path to the system memory information file.
+
+    Returns:
+        The available memory in bytes, or None if unknown.
+    """
+    memory = None
+    try:
+        with open(proc_meminfo, 'r') as fileh:
+            for line in fileh:
+                if line.startswith("MemAvailable:"):
+                    memory = int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+
+    for cgroup_dir in cgroup_dirs:
+        try:
+            with open(os.path.join(cgroup_dir, "memory.max"), 'r') as fileh:
+                limit = fileh.read().strip()
+            if limit == "max":
+                continue
+            # The memory already used by the cgroup isn't available
+            with open(os.path.join(cgroup_dir, "memory.current"),
+                      'r') as fileh:
+                available = int(limit) - int(fileh.read().strip())
+        except (IOError, ValueError):
+            continue
+        memory = available if memory is None else min(memory, available)
+
+    return memory
+
+
+def get_build_jobs(memory_per_job=1024 ** 3, cgroup_dirs=None):
+    """
+    Choose the number of make jobs fitting the CPU and memory limits of the
+    process and the current load of the host.
+
+    Args:
+        memory_per_job: Memory needed by a single job, in bytes.
+        cgroup_dirs:    The cgroup directories, see get_cgroup_dirs(). Looked
+                        up if None.
+
+    Returns:
+        A dictionary with the number of "jobs", and the "cpus", "memory"
+        (None if unknown) and "load" they were chosen from.
+    """
+    if cgroup_dirs is None:
+        cgroup_dirs = get_cgroup_dirs()
+
+    cpus = get_cpu_limit(cgroup_dirs)
+    memory = get_memory_limit(cgroup_dirs)
+    load = os.getloadavg()[0]
+
+    # Leave the CPUs already kept busy by others alone
+    jobs = min(cpus, multiprocessing.cpu_count() - int(load))
+    if memory is not None:
+        jobs = min(jobs, memory // memory_per_job)
+
+    return {'jobs': max(1, int(jobs)), 'cpus': cpus, 'memory': memory,
+            'load': load}
+
+
+# Compiler wrapper recording the time taken to compile each object
+CC_TIMER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "cctime.sh")
+
+# Tools to compress kernel tarballs with, and the suffixes of the tarballs
+TARBALL_COMPRESSIONS = ('gzip', 'pigz', 'zstd')
+TARBALL_SUFFIXES = ('.tar.gz', '.tar.zst')
 
 
 class KernelBuilder(object):
@@ -31,31 +176,75 @@ class KernelBuilder(object):
     KernelBuilder - a class used to build a kernel, e.g. call 'make',
     clean kernel source tree, etc.
     """
+    # Number of out-of-tree build directories to keep
+    BUILD_DIRS = 4
+    # Kernel ARCH values of the build architectures
+    KERNEL_ARCHES = {
+        'aarch64': 'arm64',
+        'i686': 'i386',
+        'ppc64': 'powerpc',
+        'ppc64le': 'powerpc',
+        's390x': 's390',
+        'x86_64': 'x86_64',
+    }
+    # Serializes cleaning the source tree shared by concurrent builders
+    _source_lock = threading.Lock()
+
     # pylint: disable=too-many-instance-attributes,too-many-arguments
     def __init__(self, source_dir, basecfg, cfgtype=None,
                  extra_make_args=None, enable_debuginfo=False,
                  rh_configs_glob=None, localversion=None,
-                 make_target=None):
+                 make_target=None, ccache_dir=None, ccache_size=None,
+                 ccache_remote=None, build_cache=None, build_dir_root=None,
+                 build_arch=None, cross_compiler_prefix=None, jobs=None,
+                 buildlog=None, name=None, load_limit=None, build_slots=None,
+                 build_priority=50, output=None, object_timing=False,
+                 compression=None):
         self.source_dir = source_dir
         self.basecfg = basecfg
         self.cfgtype = cfgtype if cfgtype is not None else "olddefconfig"
         self._ready = 0
-        self.buildlog = join_with_slash(self.source_dir, "build.log")
+        self.name = name
+        self.output = output if output is not None else 'full'
+        self.buildlog = (buildlog if buildlog is not None
+                         else join_with_slash(self.source_dir, "build.log"))
         self.make_argv_base = [
             "make", "-C", self.source_dir
         ]
+        self.jobs = jobs if jobs is not None else multiprocessing.cpu_count()
+        self.load_limit = load_limit
         self.make_target_args = {
             'targz-pkg': [
                 "INSTALL_MOD_STRIP=1",
-                "-j%d" % multiprocessing.cpu_count(),
+                "-j%d" % self.jobs,
             ],
             'binrpm-pkg': [
-                "-j%d" % multiprocessing.cpu_count()
+                "-j%d" % self.jobs
             ]
         }
+        # Let make hold off starting more jobs while the load is above the
+        # limit, adjusting the parallelism to the host during the build.
+        if load_limit is not None:
+            for target_args in self.make_target_args.values():
+                target_args.append("-l%g" % load_limit)
         self.enable_debuginfo = enable_debuginfo
-        self.build_arch = self.__get_build_arch()
-        self.cross_compiler_prefix = self.__get_cross_compiler_prefix()
+
+        # Builders for other architectures than the environment sets pass
+        # them to make, so they don't depend on the process environment.
+        if build_arch is not None:
+            self.build_arch = build_arch
+            self.make_argv_base.append("ARCH={}".format(
+                self.KERNEL_ARCHES.get(build_arch, build_arch)
+            ))
+        else:
+            self.build_arch = self.__get_build_arch()
+        if cross_compiler_prefix is not None:
+            self.cross_compiler_prefix = cross_compiler_prefix
+            self.make_argv_base.append(
+                "CROSS_COMPILE={}".format(cross_compiler_prefix)
+            )
+        else:
+            self.cross_compiler_prefix = self.__get_cross_compiler_prefix()
         self.rh_configs_glob = rh_configs_glob
         self.localversion = localversion
 
@@ -72,12 +261,68 @@ class KernelBuilder(object):
             )
             raise(KeyError, error_message)
 
+        # Package an uncompressed tarball and compress it with a
+        # multi-threaded compressor afterwards, if requested and available,
+        # as the tar-pkg targets compress with a single thread.
+        self.compression = compression if compression is not None else 'gzip'
+        if self.compression != 'gzip' and \
+                not find_executable(self.compression):
+            logging.warning("%s not found, compressing with gzip",
+                            self.compression)
+            self.compression = 'gzip'
+        self.compressor = None
+        if self.make_target == 'targz-pkg' and self.compression != 'gzip':
+            self.compressor = self.compression
+            self.compile_args[-1] = 'tar-pkg'
+
         # Split the extra make arguments provided by the user
         if extra_make_args:
             self.extra_make_args = shlex.split(extra_make_args)
         else:
             self.extra_make_args = []
 
+        # Use a compiler cache, with a separate directory for each
+        # architecture, if requested and available.
+        self.ccache_dir = None
+        self.ccache_size = ccache_size
+        self.ccache_remote = ccache_remote
+        self.ccache_stats = None
+        if ccache_dir:
+            if find_executable("ccache"):
+                self.ccache_dir = join_with_slash(ccache_dir,
+                                                  self.build_arch)
+            else:
+                logging.warning("ccache not found, building without it")
+
+        # Build out of the source tree in a persistent directory matching the
+        # configuration and toolchain, if requested, so object files of
+        # earlier builds are reused.
+        self.output_dir = self.source_dir
+        self.__build_dir_lock = None
+        if build_dir_root:
+            self.output_dir = self.__get_build_dir(build_dir_root)
+            self.make_argv_base.append("O={}".format(self.output_dir))
+
+        # The cache of whole build results, and the kernel release of the
+        # result restored from it
+        self.build_cache = build_cache
+        self.build_cache_hit = False
+        self.__cached_release = None
+
+        # The host-wide build slots to run make in, and the number of jobs
+        # and seconds of waiting of the lease the build got
+        self.build_slots = build_slots
+        self.build_priority = build_priority
+        self.build_lease = None
+
+        # Seconds taken by each phase of the build as (phase, seconds)
+        # tuples, the seconds into the compilation each milestone was
+        # reached, and whether to time the compilation of each object
+        self.timings = []
+        self.milestones = {}
+        self.object_timing = object_timing
+        self.timing_path = self.buildlog + ".timing.json"
+
         # Truncate the buildlog, if it exists.
         self.__reset_build_log()
 
@@ -108,6 +353,17 @@ class KernelBuilder(object):
 
     def __prepare_kernel_config(self):
         """Prepare the kernel config for the compile."""
+        start = time.time()
+
+        # Out-of-tree builds refuse to start if the source tree was built in
+        with self._source_lock:
+            if (self.output_dir != self.source_dir
+                    and os.path.exists(join_with_slash(self.source_dir,
+                                                       ".config"))):
+                args = ["make", "-C", self.source_dir, "mrproper"]
+                logging.info("cleaning up source tree: %s", args)
+                self.run_multipipe(args)
+
         if self.cfgtype == 'rh-configs' or self.cfgtype == \
                 'rh-configs-permissive':
             # Build Red Hat configs and copy the correct one into place
@@ -122,7 +378,7 @@ class KernelBuilder(object):
             args = [
                 'cp',
                 self.basecfg,
-                join_with_slash(self.source_dir, ".config")
+                self.get_cfgpath()
             ]
             self.run_multipipe(args)
 
@@ -146,6 +402,7 @@ class KernelBuilder(object):
         )
 
         self._ready = 1
+        self.timings.append(('config', time.time() - start))
 
     def __make_redhat_config(self, target):
         """ Prepare the Red Hat kernel config files.
@@ -153,35 +410,40 @@ class KernelBuilder(object):
             Args:
                 target: makefile target, usually 'rh-configs' or
                 'rh-configs-permissive'
+
+            Raises:
+                IOError: When no built config matches the config glob.
         """
-        args = self.make_argv_base + [target]
-        logging.info("building Red Hat configs: %s", args)
-
-        # Unset CROSS_COMPILE because rh-configs doesn't handle the cross
-        # compile args correctly in some cases
-        environ = os.environ.copy()
-        environ.pop('CROSS_COMPILE', None)
-        self.run_multipipe(args, env=environ)
-
-        # Copy the correct kernel config into place
-        escaped_source_dir = self.__glob_escape(self.source_dir)
-        config = join_with_slash(escaped_source_dir, self.rh_configs_glob)
-        config_filename = glob.glob(config)
-
-        # We should exit with an error if there are no matches
-        if not config_filename:
-            logging.error(
-                "The glob string provided with --rh-configs-glob did not "
-                "match any of the kernel configuration files built with "
-                "`make rh-configs`."
-            )
-            sys.exit(1)
+        # The Red Hat config targets don't support out-of-tree builds, so
+        # concurrent builders take turns generating and copying the configs.
+        with self._source_lock:
+            args = ["make", "-C", self.source_dir, target]
+            logging.info("building Red Hat configs: %s", args)
+
+            # Unset CROSS_COMPILE because rh-configs doesn't handle the cross
+            # compile args correctly in some cases
+            environ = os.environ.copy()
+            environ.pop('CROSS_COMPILE', None)
+            self.run_multipipe(args, env=environ)
+
+            # Copy the correct kernel config into place
+            escaped_source_dir = self.__glob_escape(self.source_dir)
+            config = join_with_slash(escaped_source_dir, self.rh_configs_glob)
+            config_filename = glob.glob(config)
+
+            # Fail the build if there are no matches
+            if not config_filename:
+                logging.error(
+                    "The glob string provided with --rh-configs-glob did not "
+                    "match any of the kernel configuration files built with "
+                    "`make rh-configs`."
+                )
+                raise IOError("No Red Hat config matches {}".format(
+                    self.rh_configs_glob
+                ))
 
-        logging.info("copying Red Hat config: %s", config_filename[0])
-        shutil.copyfile(
-            config_filename[0],
-            join_with_slash(self.source_dir, ".config")
-        )
+            logging.info("copying Red Hat config: %s", config_filename[0])
+            shutil.copyfile(config_filename[0], self.get_cfgpath())
 
     def __make_config(self):
         """Make a config using the kernels Makefile."""
@@ -199,10 +461,14 @@ class KernelBuilder(object):
         return platform.machine()
 
     def __reset_build_log(self):
-        """Truncate the build log."""
+        """Truncate the build log, and remove its index."""
         if os.path.isfile(self.buildlog):
             with open(self.buildlog, 'w') as fileh:
                 fileh.write('')
+        try:
+            os.unlink(BuildLogIndex(self.buildlog).path)
+        except OSError:
+            pass
 
     @classmethod
     def __get_cross_compiler_prefix(cls):
@@ -224,7 +490,7 @@ class KernelBuilder(object):
         Returns:
             Absolute path to kernel .config.
         """
-        return join_with_slash(self.source_dir, ".config")
+        return join_with_slash(self.output_dir, ".config")
 
     def getrelease(self):
         """
@@ -233,13 +499,17 @@ class KernelBuilder(object):
         Returns:
              kernel release like '4.17.0-rc6+'.
         """
+        if self.__cached_release is not None:
+            return self.__cached_release
+
         krelease = None
         if not self._ready:
             self.__prepare_kernel_config()
 
         args = self.make_argv_base + ["kernelrelease"]
-        make = subprocess.Popen(args, stdout=subprocess.PIPE)
-        (stdout, _) = make.communicate()
+        with accounting.account('build'):
+            make = accounting.popen(args, stdout=subprocess.PIPE)
+            (stdout, _) = make.communicate()
         for line in stdout.split("\n"):
             match = re.match(r'^\d+\.\d+\.\d+.*$', line)
             if match:
@@ -251,44 +521,216 @@ class KernelBuilder(object):
 
         return krelease
 
+    def __get_compiler_args(self):
+        """
+        Get the make arguments wrapping the target and host compilers with
+        ccache, if it is used, and the target compiler with the timing
+        wrapper, if objects are timed. Compilers set with the extra make
+        arguments are wrapped instead of the default ones.
+
+        Returns:
+            A tuple (compiler arguments, remaining extra make arguments).
+        """
+        wrappers = {'CC': [], 'HOSTCC': []}
+        if self.object_timing:
+            wrappers['CC'].append("sh {}".format(CC_TIMER))
+        if self.ccache_dir:
+            wrappers['CC'].append("ccache")
+            wrappers['HOSTCC'].append("ccache")
+        if not wrappers['CC']:
+            return ([], self.extra_make_args)
+
+        compilers = {
+            'CC': "{}gcc".format(self.cross_compiler_prefix or ''),
+            'HOSTCC': "gcc",
+        }
+        extra_make_args = []
+        for arg in self.extra_make_args:
+            (name, sep, value) = arg.partition('=')
+            if sep and wrappers.get(name):
+                compilers[name] = value
+            else:
+                extra_make_args.append(arg)
+
+        compiler_args = ["{}={} {}".format(var, ' '.join(wrappers[var]),
+                                           compilers[var])
+                         for var in sorted(compilers) if wrappers[var]]
+        return (compiler_args, extra_make_args)
+
     def assemble_make_options(self):
         """Assemble all of the make options into a list."""
+        (compiler_args, extra_make_args) = self.__get_compiler_args()
         kernel_build_argv = (
             self.make_argv_base
             + self.compile_args
-            + self.extra_make_args
+            + compiler_args
+            + extra_make_args
         )
         return kernel_build_argv
 
-    def find_rpm(self):
+    def __get_toolchain_version(self):
         """
-        Find RPMs in the buildlog.
+        Get the version of the compiler the kernel is built with.
 
         Returns:
-            A list of paths to RPM files.
+            The first line of the compiler version output, or None if the
+            compiler can't be run.
+        """
+        compiler = "{}gcc".format(self.cross_compiler_prefix or '')
+        for arg in self.extra_make_args:
+            if arg.startswith("CC="):
+                compiler = arg[len("CC="):]
+        if compiler.startswith("ccache "):
+            compiler = compiler[len("ccache "):]
+
+        try:
+            with accounting.account('build'):
+                output = accounting.check_output(shlex.split(compiler)
+                                                 + ["--version"],
+                                                 stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        return output.splitlines()[0] if output else None
 
+    def __get_build_dir(self, build_dir_root):
         """
-        # Compile a regex to look for the tarball filename.
-        rpm_regex = re.compile(r"^Wrote: (.*\.rpm)$")
+        Get and lock the persistent build directory matching the base
+        configuration, architecture, make arguments and toolchain. Any of
+        them changing selects another directory, so stale objects are never
+        reused, while kbuild itself rebuilds what changed in the source.
+        The least recently used unlocked directories beyond BUILD_DIRS are
+        removed.
 
-        # Read the buildlog line by line looking for the RPMs.
-        rpm_files = []
-        with open(self.buildlog, 'r') as fileh:
-            for log_line in fileh:
-                match = rpm_regex.search(log_line)
+        Args:
+            build_dir_root: The directory to keep build directories in.
 
-                # If we find a match, store the path to the tarball and stop
-                # reading the buildlog.
-                if match:
-                    rpm_path = match.group(1)
-                    rpm_files.append(rpm_path)
+        Returns:
+            The build directory path.
+        """
+        basecfg_hash = None
+        if self.basecfg and os.path.isfile(self.basecfg):
+            with open(self.basecfg, 'r') as fileh:
+                basecfg_hash = hashlib.sha256(fileh.read()).hexdigest()
+
+        key = hashlib.sha256(json.dumps([
+            basecfg_hash, self.cfgtype, self.rh_configs_glob,
+            self.enable_debuginfo, self.build_arch,
+            self.cross_compiler_prefix, self.make_target,
+            self.extra_make_args, self.__get_toolchain_version()
+        ])).hexdigest()[:16]
+
+        build_dir = join_with_slash(build_dir_root, key)
+        try:
+            os.makedirs(build_dir)
+        except OSError:
+            pass
 
-                    # Ensure the RPM is actually on the filesystem.
-                    if not os.path.isfile(rpm_path):
-                        raise IOError(
-                            "Built kernel RPM not found: "
-                            "{}".format(rpm_path)
-                        )
+        # Concurrent builds in the same directory would break each other.
+        # The lock is held as long as the builder exists.
+        self.__build_dir_lock = open(build_dir + ".lock", 'a')
+        try:
+            fcntl.flock(self.__build_dir_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logging.info("waiting for build directory %s", build_dir)
+            fcntl.flock(self.__build_dir_lock, fcntl.LOCK_EX)
+        os.utime(build_dir, None)
+        logging.info("build directory: %s", build_dir)
+
+        self.__evict_build_dirs(build_dir_root)
+        return build_dir
+
+    def __evict_build_dirs(self, build_dir_root):
+        """Remove the least recently used unlocked build directories."""
+        build_dirs = sorted(
+            (os.path.getmtime(join_with_slash(build_dir_root, name)), name)
+            for name in os.listdir(build_dir_root)
+            if os.path.isdir(join_with_slash(build_dir_root, name))
+        )
+        for (_, name) in build_dirs[:-self.BUILD_DIRS]:
+            path = join_with_slash(build_dir_root, name)
+            with open(path + ".lock", 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                logging.info("removing build directory %s", path)
+                shutil.rmtree(path)
+
+    def __get_build_env(self):
+        """
+        Get the environment to compile the kernel with.
+
+        Returns:
+            A dictionary of environment variables.
+        """
+        env = os.environ.copy()
+        if self.ccache_dir:
+            env['CCACHE_DIR'] = self.ccache_dir
+            # Hash paths relative to the source, so caches are shared between
+            # work directories.
+            env['CCACHE_BASEDIR'] = os.path.realpath(self.source_dir)
+            if self.ccache_size:
+                env['CCACHE_MAXSIZE'] = self.ccache_size
+            if self.ccache_remote:
+                # Objects are keyed by their content hash, so any builder can
+                # reuse them. The variable was renamed in ccache 4.8.
+                env['CCACHE_REMOTE_STORAGE'] = self.ccache_remote
+                env['CCACHE_SECONDARY_STORAGE'] = self.ccache_remote
+        if self.object_timing:
+            env['SKT_CC_TIMES'] = self.buildlog + ".objects"
+
+        return env
+
+    def __get_ccache_stats(self, env):
+        """
+        Get the ccache hit and miss counters.
+
+        Args:
+            env:    The build environment, selecting the cache directory.
+
+        Returns:
+            A tuple (hits, misses, remote storage hits), or None if the
+            counters can't be read.
+        """
+        try:
+            with accounting.account('build'):
+                output = accounting.check_output(["ccache", "--print-stats"],
+                                                 env=env)
+        except (OSError, subprocess.CalledProcessError):
+            logging.warning("failed to read ccache statistics")
+            return None
+
+        counters = {}
+        for line in output.splitlines():
+            fields = line.split('\t')
+            if len(fields) == 2 and fields[1].isdigit():
+                counters[fields[0]] = int(fields[1])
+
+        return (counters.get('direct_cache_hit', 0)
+                + counters.get('preprocessed_cache_hit', 0),
+                counters.get('cache_miss', 0),
+                counters.get('remote_storage_hit',
+                             counters.get('secondary_storage_hit', 0)))
+
+    def find_rpm(self):
+        """
+        Find RPMs in the buildlog.
+
+        Returns:
+            A list of paths to RPM files.
+
+        """
+        # Look the RPMs up in the buildlog index.
+        rpm_files = BuildLogIndex.load(self.buildlog).rpms
+
+        # Ensure the RPMs are actually on the filesystem.
+        for rpm_path in rpm_files:
+            if not os.path.isfile(rpm_path):
+                raise IOError(
+                    "Built kernel RPM not found: "
+                    "{}".format(rpm_path)
+                )
 
         return rpm_files
 
@@ -303,8 +745,9 @@ class KernelBuilder(object):
             Path to the repo directory.
 
         """
-        # Set a path for the RPM repository directory.
-        repo_dir = join_with_slash(self.source_dir, 'rpm_repo/')
+        # Set a path for the RPM repository directory, in the output
+        # directory, as concurrent builders share the source directory.
+        repo_dir = join_with_slash(self.output_dir, 'rpm_repo/')
 
         # Remove the existing repo directory if it exists.
         if os.path.isdir(repo_dir):
@@ -319,7 +762,9 @@ class KernelBuilder(object):
 
         # Create an RPM repository in the repo directory.
         args = ["createrepo", repo_dir]
+        start = time.time()
         exit_code = self.run_multipipe(args)
+        self.timings.append(('createrepo', time.time() - start))
 
         # If the RPM repo build failed, raise an exception.
         if exit_code != 0:
@@ -335,25 +780,13 @@ class KernelBuilder(object):
             The full path to the tarball (as a string), or None if the tarball
             line was not found in the log.
         """
-        # Compile a regex to look for the tarball filename.
-        tgz_regex = re.compile("^Tarball successfully created in (.*)$")
-
-        # Read the buildlog line by line looking for the tarball.
+        # Look the first tarball up in the buildlog index.
+        tarballs = BuildLogIndex.load(self.buildlog).tarballs
         fpath = None
-        with open(self.buildlog, 'r') as fileh:
-            for log_line in fileh:
-                match = tgz_regex.search(log_line)
-
-                # If we find a match, store the path to the tarball and stop
-                # reading the buildlog.
-                if match:
-                    fpath = os.path.realpath(
-                        join_with_slash(
-                            self.source_dir,
-                            match.group(1)
-                        )
-                    )
-                    break
+        if tarballs:
+            fpath = os.path.realpath(
+                join_with_slash(self.output_dir, tarballs[0])
+            )
 
         return fpath
 
@@ -374,9 +807,40 @@ class KernelBuilder(object):
             ParsingError:        When can not find the tarball path in stdout.
             IOError:             When tarball file doesn't exist.
         """
+        self.timings = []
+        self.milestones = {}
+        try:
+            return self.__compile_kernel(timeout)
+        finally:
+            self.__save_timings()
+
+    def __compile_kernel(self, timeout):
+        """
+        Compile the kernel and package it, see compile_kernel().
+
+        Args:
+            timeout:    Max time in seconds will wait for build.
+        Returns:
+            Path to the kernel tarball or path to the RPM repository
+            containing the kernel RPMs.
+        """
         # Prepare the kernel configuration file.
         self.__prepare_kernel_config()
 
+        # Reuse the result of an identical earlier build, if there is one.
+        cache_key = self.__get_build_cache_key()
+        if cache_key is not None:
+            start = time.time()
+            package_path = self.__restore_build(cache_key)
+            if package_path is not None:
+                self.timings.append(('restore', time.time() - start))
+                return package_path
+
+        # Start timing the objects of this build only.
+        if self.object_timing:
+            with open(self.buildlog + ".objects", 'w'):
+                pass
+
         # Get the kernel build options.
         kernel_build_argv = self.assemble_make_options()
         logging.info("building kernel: %s", kernel_build_argv)
@@ -387,8 +851,41 @@ class KernelBuilder(object):
             + kernel_build_argv
         )
 
-        # Compile the kernel.
-        returncode = self.run_multipipe(kernel_build_argv)
+        # Wait for the slots of the host-wide pool, running as many jobs as
+        # slots leased.
+        lease = None
+        if self.build_slots is not None:
+            lease = self.build_slots.acquire(self.jobs, self.build_priority)
+            self.build_lease = (lease.jobs, lease.wait)
+            kernel_build_argv = [
+                "-j%d" % lease.jobs if arg == "-j%d" % self.jobs else arg
+                for arg in kernel_build_argv
+            ]
+
+        # Compile the kernel, counting the ccache hits and misses of this
+        # build only, as the cache may be shared.
+        env = self.__get_build_env()
+        if self.ccache_dir:
+            stats_before = self.__get_ccache_stats(env)
+        start = time.time()
+        try:
+            returncode = self.run_multipipe(kernel_build_argv, env=env)
+        finally:
+            if lease is not None:
+                lease.release()
+        self.timings.append(('build', time.time() - start))
+        phases = BuildLogIndex.load(self.buildlog).phases
+        if phases:
+            self.milestones = phases[-1]['milestones']
+        if self.ccache_dir:
+            stats_after = self.__get_ccache_stats(env)
+            if stats_before and stats_after:
+                self.ccache_stats = tuple(
+                    after - before
+                    for (before, after) in zip(stats_before, stats_after)
+                )
+                logging.info("ccache hits: %d, misses: %d, remote hits: %d",
+                             *self.ccache_stats)
 
         # The timeout command exits with 124 if a timeout occurred.
         if returncode == 124:
@@ -411,6 +908,125 @@ class KernelBuilder(object):
         if 'rpm' in self.make_target:
             package_path = self.handle_rpm()
 
+        if cache_key is not None:
+            self.build_cache.store(cache_key, package_path,
+                                   self.get_cfgpath(), self.getrelease())
+
+        return package_path
+
+    def get_object_timings(self):
+        """
+        Get the time taken to compile each object, recorded by the compiler
+        wrapper.
+
+        Returns:
+            A list of (object, seconds) tuples, the slowest objects first.
+        """
+        seconds = {}
+        try:
+            with open(self.buildlog + ".objects", 'r') as fileh:
+                for line in fileh:
+                    try:
+                        (obj, nanoseconds) = line.rsplit(None, 1)
+                        seconds[obj] = (seconds.get(obj, 0)
+                                        + int(nanoseconds) / 1e9)
+                    except ValueError:
+                        continue
+        except IOError:
+            return []
+
+        return sorted(seconds.items(), key=lambda item: item[1],
+                      reverse=True)
+
+    def __save_timings(self):
+        """Write the timings of the build next to the build log."""
+        data = {
+            'phases': [{'phase': phase, 'seconds': seconds}
+                       for (phase, seconds) in self.timings],
+            'milestones': self.milestones,
+            'objects': ([{'object': obj, 'seconds': seconds}
+                         for (obj, seconds) in self.get_object_timings()]
+                        if self.object_timing else [])
+        }
+        with open(self.timing_path, 'w') as fileh:
+            json.dump(data, fileh, indent=2)
+
+    def __get_build_cache_key(self):
+        """
+        Get the build cache key of the build, made from the source tree, the
+        kernel configuration, and the make target and arguments.
+
+        Returns:
+            The key, or None if there is no build cache or the source tree
+            has uncommitted changes.
+        """
+        if self.build_cache is None:
+            return None
+
+        try:
+            git_argv = ["git", "-C", self.source_dir]
+            with accounting.account('git'):
+                tree = accounting.check_output(git_argv + ["rev-parse",
+                                                           "HEAD^{tree}"])
+                changes = accounting.check_output(git_argv + [
+                    "status", "--porcelain", "--untracked-files=no"
+                ])
+        except (OSError, subprocess.CalledProcessError):
+            logging.warning("failed to get the source tree, not caching")
+            return None
+
+        if changes.strip():
+            logging.info("source tree has uncommitted changes, not caching")
+            return None
+
+        with open(self.get_cfgpath(), 'r') as fileh:
+            config = fileh.read()
+
+        # Results compressed differently are different results.
+        make_target = self.make_target
+        if self.compressor is not None:
+            make_target = "{}:{}".format(make_target, self.compressor)
+
+        return self.build_cache.get_key(
+            tree.strip(), config, make_target, self.build_arch,
+            self.cross_compiler_prefix, self.extra_make_args
+        )
+
+    def __restore_build(self, key):
+        """
+        Restore the result of an earlier build from the build cache.
+
+        Args:
+            key:    The build cache key.
+
+        Returns:
+            Path to the kernel tarball or path to the RPM repository, or None
+            if the build is not cached.
+        """
+        entry = self.build_cache.lookup(key)
+        if entry is None:
+            return None
+
+        package_path = join_with_slash(self.output_dir,
+                                       os.path.basename(entry['package']))
+        if 'rpm' in self.make_target:
+            package_path = join_with_slash(self.output_dir, 'rpm_repo/')
+        try:
+            if os.path.isdir(entry['package']):
+                if os.path.isdir(package_path):
+                    shutil.rmtree(package_path)
+                shutil.copytree(entry['package'], package_path)
+            else:
+                shutil.copyfile(entry['package'], package_path)
+            shutil.copyfile(entry['config'], self.get_cfgpath())
+        except (IOError, OSError) as exc:
+            # The entry may have been evicted in the meantime
+            logging.warning("failed to restore cached build: %s", exc)
+            return None
+
+        logging.info("restored cached build %s", key)
+        self.build_cache_hit = True
+        self.__cached_release = entry['krelease']
         return package_path
 
     def handle_rpm(self):
@@ -460,11 +1076,47 @@ class KernelBuilder(object):
         if not os.path.isfile(fpath):
             raise IOError("Built kernel tarball {} not found".format(fpath))
 
+        # Compress the uncompressed tarball built for a parallel compressor.
+        if self.compressor is not None:
+            fpath = self.__compress_tarball(fpath)
+
         return fpath
 
+    def __compress_tarball(self, fpath):
+        """
+        Compress a tarball with the parallel compressor, running as many
+        threads as make jobs, and remove the uncompressed tarball.
+
+        Args:
+            fpath:  The path to the uncompressed tarball.
+
+        Returns:
+            The full path of the compressed tarball.
+        Raises:
+            CalledProcessError: When the compressor fails.
+        """
+        if self.compressor == 'zstd':
+            args = ["zstd", "-T%d" % self.jobs, "-q", "-f", "--rm", fpath]
+            suffix = ".zst"
+        else:
+            args = ["pigz", "-p", str(self.jobs), "-f", fpath]
+            suffix = ".gz"
+
+        logging.info("compressing tarball: %s", args)
+        start = time.time()
+        exit_code = self.run_multipipe(args)
+        self.timings.append(('compress', time.time() - start))
+        if exit_code != 0:
+            raise subprocess.CalledProcessError(exit_code, ' '.join(args))
+
+        return fpath + suffix
+
     def run_multipipe(self, args, env=os.environ.copy()):
         """
-        Run a process while writing to stdout/file simultaneously.
+        Run a process while writing its output to the build log and stdout
+        simultaneously. The output is copied in chunks, byte for byte to the
+        build log, and to stdout as selected by the builder's output mode if
+        the "multipipe" logger is enabled for INFO messages.
 
         Args:
             args:   A command to run in list format.
@@ -475,57 +1127,45 @@ class KernelBuilder(object):
             The return code from the Popen call.
 
         """
-        # Set up a basic logger.
-        root = logging.getLogger('multipipe')
-
-        # Don't adjust the parent logger's settings with the changes we make
-        # here.
-        root.propagate = False
-
-        # Set up a handler that writes directly to the build log.
-        file_handler = logging.FileHandler(self.buildlog)
-        file_handler.setLevel(logging.DEBUG)
-
-        # Set up another handler that writes to stdout.
-        stdout_handler = logging.StreamHandler(sys.stdout)
-        stdout_handler.setLevel(logging.DEBUG)
-
-        # Ensure that the log format is unaltered -- just messages are
-        # written without any time prefixes.
-        formatter = logging.Formatter('%(message)s')
-        file_handler.setFormatter(formatter)
-        stdout_handler.setFormatter(formatter)
+        # The logger is separate for each named builder as they may run
+        # concurrently.
+        logger = logging.getLogger('multipipe.{}'.format(self.name)
+                                   if self.name else 'multipipe')
+        tee = OutputTee(
+            self.output if logger.isEnabledFor(logging.INFO) else None,
+            # Tell apart the output of concurrent builders on stdout.
+            "[{}] ".format(self.name) if self.name else ""
+        )
 
-        # Add the file and stdout handlers to our logger.
-        root.addHandler(file_handler)
-        root.addHandler(stdout_handler)
+        # Index the markers in the output as it goes by.
+        index = BuildLogIndex.load(self.buildlog)
+        index.start_phase(' '.join(args))
 
-        # Run the command.
         logging.debug("Running multipipe command: %s", ' '.join(args))
-        root.info("$ %s", ' '.join(args))
-        process = subprocess.Popen(
-            args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            bufsize=1,
-            env=env
-        )
+        with open(self.buildlog, 'ab') as logh, accounting.account('build'):
+            header = "$ {}\n".format(' '.join(args))
+            tee.write(logh, header)
+            index.scan(header)
+            process = accounting.popen(
+                args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                env=env
+            )
 
-        # Loop over the buffered stdout/stderr from the command and write the
-        # output to our logger.
-        for line in iter(process.stdout.readline, ''):
-            root.info(line.strip())
-
-        # Ensure the process has exited.
-        exit_code = process.wait()
-
-        # Remove the extra handlers we added.
-        # NOTE(mhayden): Removing this step will cause all log lines to be
-        #                written *twice* to stdout/log. This was very annoying
-        #                to debug, so please don't remove these unless you
-        #                know what you're doing.
-        for handler in root.handlers[:]:
-            root.removeHandler(handler)
+            # Copy the output as it comes, without waiting for whole lines.
+            fileno = process.stdout.fileno()
+            for chunk in iter(lambda: os.read(fileno, OutputTee.CHUNK_SIZE),
+                              ''):
+                tee.write(logh, chunk)
+                index.scan(chunk)
+            process.stdout.close()
+
+            # Ensure the process has exited.
+            exit_code = process.wait()
+        tee.close(self.buildlog)
+        index.end_phase(exit_code)
+        index.save()
 
         return exit_code
 
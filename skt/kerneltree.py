@@ -12,12 +12,20 @@
 # along with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Class for managing a kernel source tree."""
+import hashlib
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import re
+import shutil
 import subprocess
+import tempfile
+import time
 
-from skt.misc import join_with_slash, get_patch_mbox, SKT_SUCCESS, SKT_FAIL
+from skt import accounting
+from skt.misc import join_with_slash, get_patch_mbox, get_ref_name, \
+    lock_repository, SKT_SUCCESS, SKT_FAIL
 
 
 class KernelTree(object):
@@ -25,8 +33,20 @@ class KernelTree(object):
     KernelTree - a kernel git repository "checkout", i.e. a clone with a
     working directory.
     """
-
-    def __init__(self, uri, ref=None, wdir=None, fetch_depth=None):
+    # Number of commit queries sent to the query process in one write
+    QUERY_BATCH = 256
+    # Number of times to deepen shallow history looking for a merge base
+    # before fetching all of it
+    DEEPEN_ROUNDS = 6
+    # Number of base history commits to look for already applied patches in
+    PATCH_ID_HISTORY = 2000
+    # The first git version with "git merge-tree --write-tree"
+    MERGE_TREE_VERSION = (2, 38)
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, uri, ref=None, wdir=None, fetch_depth=None,
+                 reference=None, patch_cache=None, fetch_filter=None,
+                 deepen=False, applied_patches="apply"):
         """
         Initialize a KernelTree.
 
@@ -39,6 +59,21 @@ class KernelTree(object):
             fetch_depth:
                     The amount of git history to include with the clone.
                     Smaller depths lead to faster repo clones.
+            reference:
+                    An optional ReferenceRepository to borrow objects from.
+                    Only objects missing from it are fetched into the clone.
+            patch_cache:
+                    An optional PatchCache remembering the results of
+                    applying patches.
+            fetch_filter:
+                    An optional partial clone filter specification, e.g.
+                    "blob:none". Filtered out objects are fetched on demand.
+            deepen:
+                    If True, fetch references to merge with fetch_depth too,
+                    and deepen the history only until a merge base is found.
+            applied_patches:
+                    What to do with patches already present in the base
+                    history: "apply" them anyway, "skip" them, or "fail".
         """
         # The git "working directory" (the "checkout")
         self.wdir = wdir
@@ -50,6 +85,42 @@ class KernelTree(object):
         self.ref = ref if ref is not None else "master"
         self.mergelog = join_with_slash(self.wdir, "merge.log")
         self.fetch_depth = fetch_depth
+        self.fetch_filter = fetch_filter
+        self.deepen = deepen
+        # The git directory shared with other worktrees of the repository,
+        # holding the repository lock, set up along with the repository
+        self.__common_dir = None
+        # The namespace of the fetched references of a worktree, so they
+        # don't collide with the ones of the other worktrees, or None if the
+        # repository has no other worktrees
+        self.__ref_namespace = None
+        # The shared object store to borrow objects from
+        self.reference = reference
+        # The cache of patch application results
+        self.patch_cache = patch_cache
+        # The long-lived "git cat-file --batch" process answering commit
+        # queries, started on first use
+        self.__query = None
+        # Destination refs which are already fetched and shouldn't be
+        # fetched again
+        self.__fetched = set()
+        # The table of remote names keyed by remote URLs, read from the
+        # repository configuration on first use
+        self.__remotes = None
+        # The full hash the base reference points to on the origin remote,
+        # looked up on first use
+        self.__remote_head = None
+        # The remotes whose last use was already recorded during this run
+        self.__used_remotes = set()
+        # The remotes already registered for filtered fetches during this run
+        self.__promisors = set()
+        self.applied_patches = applied_patches
+        # Names of the patches skipped as already applied
+        self.skipped_patches = []
+        # The commit checked out as the base, and the patch-ids of its
+        # history, keyed by patch-id
+        self.__base_head = None
+        self.__base_patch_ids = None
 
         try:
             os.mkdir(self.wdir)
@@ -71,7 +142,8 @@ class KernelTree(object):
         Args:
             func:       The subprocess-module-compatible function to call.
             *args:      Git command arguments.
-            **kwargs:   Keyword arguments to the function to call.
+            **kwargs:   Keyword arguments to the function to call. An "env"
+                        dictionary is added to the git environment.
 
         Returns:
             The function return value.
@@ -82,14 +154,21 @@ class KernelTree(object):
             "--git-dir", self.gdir,
             "-c", "user.name=skt",
             "-c", "user.email=skt",
+            # Leave repacking to maintain(), instead of stalling whichever
+            # pipeline stage happens to cross the loose object threshold.
+            "-c", "gc.auto=0",
+            "-c", "maintenance.auto=false",
         ]
         cmd_args = list(base_argv) + list(args)
 
+        kwargs.setdefault('stderr', subprocess.STDOUT)
+        env = dict(os.environ, **{'LC_ALL': 'C'})
+        env.update(kwargs.pop('env', {}))
+
         logging.debug("executing: %s", " ".join(cmd_args))
         return func(
             cmd_args,
-            env=dict(os.environ, **{'LC_ALL': 'C'}),
-            stderr=subprocess.STDOUT,
+            env=env,
             **kwargs
         )
 
@@ -105,9 +184,10 @@ class KernelTree(object):
             Git command output.
         """
         try:
-            return self.__git_cmd_call(subprocess.check_output,
-                                       *args,
-                                       **kwargs)
+            with accounting.account('git'):
+                return self.__git_cmd_call(accounting.check_output,
+                                           *args,
+                                           **kwargs)
         except subprocess.CalledProcessError as exc:
             logging.debug(exc.output)
             raise exc
@@ -124,13 +204,14 @@ class KernelTree(object):
         Returns:
             Git command exit status and output.
         """
-        process = self.__git_cmd_call(subprocess.Popen,
-                                      *args,
-                                      stdin=subprocess.PIPE,
-                                      stdout=subprocess.PIPE,
-                                      **kwargs)
-        (output, _) = process.communicate(command_input)
-        status = process.wait()
+        with accounting.account('git'):
+            process = self.__git_cmd_call(accounting.popen,
+                                          *args,
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          **kwargs)
+            (output, _) = process.communicate(command_input)
+            status = process.wait()
         return status, output
 
     def getpath(self):
@@ -145,15 +226,55 @@ class KernelTree(object):
         """Initialize the repo and set the origin."""
         self.__git_cmd("init")
 
-        # Does the repo have an origin set?
-        if 'origin' in self.__git_cmd("remote").split('\n'):
-            # Ensure the origin is set to the correct URL
-            logging.debug("Setting URL for remote 'origin': %s", self.uri)
-            self.__git_cmd("remote", "set-url", "origin", self.uri)
-        else:
-            # Add the origin remote
-            logging.debug("Adding missing remote 'origin': %s", self.uri)
-            self.__git_cmd("remote", "add", "origin", self.uri)
+        # A worktree shares the configuration, the shallow history and the
+        # references with the common repository and its other worktrees,
+        # possibly used by other pipelines at the same time.
+        gdir = self.__git_cmd("rev-parse", "--absolute-git-dir").strip()
+        common_dir = os.path.join(
+            self.wdir, self.__git_cmd("rev-parse", "--git-common-dir").strip()
+        )
+        self.__common_dir = common_dir
+        if os.path.realpath(gdir) != os.path.realpath(common_dir):
+            self.__ref_namespace = os.path.basename(gdir)
+
+        with self.__repo_lock():
+            # Does the repo have an origin set?
+            if 'origin' in self.__git_cmd("remote").split('\n'):
+                # Ensure the origin is set to the correct URL
+                logging.debug("Setting URL for remote 'origin': %s", self.uri)
+                self.__git_cmd("remote", "set-url", "origin", self.uri)
+            else:
+                # Add the origin remote
+                logging.debug("Adding missing remote 'origin': %s", self.uri)
+                self.__git_cmd("remote", "add", "origin", self.uri)
+
+        if self.reference is not None:
+            self.__setup_alternates()
+
+    def __repo_lock(self):
+        """Hold the repository lock, see lock_repository()."""
+        return lock_repository(self.__common_dir)
+
+    def __setup_alternates(self):
+        """
+        Point the repository at the reference repository's object store, so
+        objects already present there are not fetched again.
+        """
+        # Worktrees keep their objects in the common repository, so let git
+        # resolve the path instead of assuming a plain ".git" directory.
+        alternates = self.__git_cmd("rev-parse", "--git-path",
+                                    "objects/info/alternates").strip()
+        alternates = os.path.join(self.wdir, alternates)
+        objects_dir = self.reference.get_objects_dir()
+
+        if os.path.isfile(alternates):
+            with open(alternates, 'r') as fileh:
+                if objects_dir in fileh.read().splitlines():
+                    return
+
+        logging.debug("borrowing objects from %s", objects_dir)
+        with open(alternates, 'a') as fileh:
+            fileh.write(objects_dir + "\n")
 
     def get_commit_details(self, ref=None, show_format="%H"):
         """
@@ -178,6 +299,131 @@ class KernelTree(object):
 
         return stdout.rstrip()
 
+    def __query_objects(self, revs):
+        """
+        Read objects through the long-lived "git cat-file --batch" process,
+        starting it if it isn't running yet. All revisions are sent in one
+        write and the answers are read back afterwards.
+
+        Args:
+            revs:   A list of revision expressions naming the objects. Keep it
+                    short enough for the requests to fit into a pipe buffer.
+
+        Returns:
+            A list with a tuple of the full hash and the raw content for each
+            object, or None for objects which don't exist.
+        """
+        if self.__query is None or self.__query.poll() is not None:
+            # Keep stderr separate, the protocol is spoken on stdout only.
+            # The process is accounted once close_query() waits for it.
+            with accounting.account('git'):
+                self.__query = self.__git_cmd_call(accounting.popen,
+                                                   "cat-file", "--batch",
+                                                   stdin=subprocess.PIPE,
+                                                   stdout=subprocess.PIPE,
+                                                   stderr=None)
+
+        self.__query.stdin.write("".join(rev + "\n" for rev in revs))
+        self.__query.stdin.flush()
+
+        result = []
+        for _ in revs:
+            header = self.__query.stdout.readline().split()
+            if len(header) != 3:
+                # "<rev> missing" or "<rev> ambiguous"
+                result.append(None)
+                continue
+
+            content = self.__query.stdout.read(int(header[2]))
+            # Skip the newline terminating the object content
+            self.__query.stdout.read(1)
+            result.append((header[0], content))
+
+        return result
+
+    def close_query(self):
+        """Stop the commit query process, if it's running."""
+        if self.__query is not None:
+            self.__query.stdin.close()
+            self.__query.wait()
+            self.__query = None
+
+    @classmethod
+    def __parse_commit(cls, sha, content):
+        """
+        Parse a raw commit object.
+
+        Args:
+            sha:        The full hash of the commit.
+            content:    The raw commit object content.
+
+        Returns:
+            A dictionary with the "hash", "subject", "date" (committer date
+            as an epoch timestamp) and "author" ("Name <email>") of the
+            commit.
+        """
+        headers, _, message = content.partition("\n\n")
+        metadata = {'hash': sha}
+        for line in headers.split("\n"):
+            match = re.match(r'^(author|committer) (.*) (\d+) [-+]\d{4}$',
+                             line)
+            if not match:
+                continue
+            if match.group(1) == 'author':
+                metadata['author'] = match.group(2)
+            else:
+                metadata['date'] = int(match.group(3))
+
+        # Like "git show --format=%s", fold the first paragraph into a line
+        paragraph = message.strip().split("\n\n")[0]
+        metadata['subject'] = ' '.join(
+            line.strip() for line in paragraph.split("\n")
+        )
+        return metadata
+
+    def get_commits_metadata(self, refs):
+        """
+        Get the metadata of several commits in one round trip to the
+        long-lived query process, without starting a process per commit.
+
+        Args:
+            refs:   A list of references to commits. None stands for the
+                    current commit.
+
+        Returns:
+            A list of dictionaries with the "hash", "subject", "date" and
+            "author" of each commit, in the order of the references.
+
+        Raises:
+            ValueError if a reference doesn't name a commit.
+        """
+        revs = ["%s^{commit}" % (ref if ref is not None else "HEAD")
+                for ref in refs]
+
+        result = []
+        for start in range(0, len(revs), self.QUERY_BATCH):
+            batch = revs[start:start + self.QUERY_BATCH]
+            for rev, obj in zip(batch, self.__query_objects(batch)):
+                if obj is None:
+                    raise ValueError("Unknown commit: %s" % rev)
+                result.append(self.__parse_commit(*obj))
+
+        return result
+
+    def get_commit_metadata(self, ref=None):
+        """
+        Get the metadata of a commit specified by an optional ref.
+
+        Args:
+            ref: An optional reference to a commit in a git repo to be
+                 inspected. The current commit is used if a ref is not
+                 provided.
+        Returns:
+            A dictionary with the "hash", "subject", "date" and "author" of
+            the commit.
+        """
+        return self.get_commits_metadata([ref])[0]
+
     def get_commit_date(self, ref=None):
         """
         Get the commit date of the commit specified by an optional ref.
@@ -186,10 +432,9 @@ class KernelTree(object):
                  inspected. The current commit is used if a ref is not
                  provided.
         Returns:
-            The epoch timestamp string of the commit's committer date.
+            The epoch timestamp of the commit's committer date.
         """
-        result = self.get_commit_details(ref, show_format='%ct')
-        return int(result)
+        return self.get_commit_metadata(ref)['date']
 
     def get_commit_hash(self, ref=None):
         """
@@ -201,7 +446,7 @@ class KernelTree(object):
         Returns:
             The commit's full hash string.
         """
-        return self.get_commit_details(ref, show_format='%H')
+        return self.get_commit_metadata(ref)['hash']
 
     def get_commit_subject(self, ref=None):
         """
@@ -213,19 +458,36 @@ class KernelTree(object):
         Returns:
             The commit's subject line.
         """
-        return self.get_commit_details(ref, show_format='%s')
+        return self.get_commit_metadata(ref)['subject']
 
-    def checkout(self):
+    def __fetch_base(self):
         """
-        Clone and checkout the specified reference from the specified repo URL
-        to the specified working directory. Requires "ref" (reference) to be
-        specified upon creation.
+        Fetch the base reference from the origin remote, unless it was
+        already fetched.
 
         Returns:
-            Full hash of the last commit.
+            The destination reference the base reference was fetched to.
         """
-        dstref = join_with_slash("refs", "remotes", "origin",
-                                 self.ref.split('/')[-1])
+        dstref = self.__get_dstref("origin", self.ref)
+        if dstref in self.__fetched:
+            return dstref
+
+        # Nothing to fetch if we already have exactly that commit checked out
+        if self.__is_at_remote_head():
+            logging.info("base repo is up to date at %s", self.__remote_head)
+            self.__git_cmd("update-ref", dstref, self.__remote_head)
+            self.__fetched.add(dstref)
+            return dstref
+
+        # Bring the shared object store up to date first, so the fetch below
+        # only needs to transfer what is missing from it.
+        if self.reference is not None:
+            try:
+                self.reference.update(self.uri, self.ref)
+            except subprocess.CalledProcessError as exc:
+                logging.warning("failed to update reference repo %s: %s",
+                                self.reference.path, exc)
+
         logging.info("fetching base repo")
         git_fetch_args = [
             "fetch", "origin",
@@ -233,47 +495,457 @@ class KernelTree(object):
         ]
         # If the user provided extra arguments for the git fetch step, append
         # them to the existing set of arguments.
+        if self.fetch_filter:
+            self.__set_promisor("origin")
+            git_fetch_args.append('--filter=%s' % self.fetch_filter)
+
         if self.fetch_depth:
             git_fetch_args.extend(['--depth', self.fetch_depth])
+            with self.__repo_lock():
+                self.__git_cmd(*git_fetch_args)
+        else:
+            # The __git_cmd() method expects a list of args, not a list of
+            # strings, so we need to expand our list into args with *.
+            self.__git_cmd(*git_fetch_args)
+
+        self.__fetched.add(dstref)
+        return dstref
+
+    def __add_remote(self, uri):
+        """
+        Add a remote for a repository to merge from.
+
+        Args:
+            uri: The Git URI of the remote repository.
+
+        Returns:
+            The remote name.
+        """
+        remotes = self.__get_remotes()
+        remote_name = self.__get_remote_name(uri)
+
+        if remotes.get(uri) != remote_name:
+            try:
+                with self.__repo_lock():
+                    self.__git_cmd("remote", "add", remote_name, uri)
+            except subprocess.CalledProcessError:
+                pass
+            remotes[uri] = remote_name
+
+        # Remember when the remote was last used, so maintain() can prune the
+        # ones no longer merged from.
+        if remote_name not in self.__used_remotes:
+            self.__used_remotes.add(remote_name)
+            try:
+                with self.__repo_lock():
+                    self.__git_cmd("config",
+                                   "remote.%s.sktlastused" % remote_name,
+                                   str(int(time.time())))
+            except subprocess.CalledProcessError:
+                logging.warning("failed to record use of remote %s",
+                                remote_name)
+
+        return remote_name
+
+    def __set_promisor(self, remote_name):
+        """
+        Register a remote for filtered fetches, the same way the first "git
+        fetch --filter" from it would. Concurrent fetches would otherwise all
+        try to write the registration to the configuration, failing on its
+        lock.
+
+        Args:
+            remote_name:    The remote name.
+        """
+        if remote_name in self.__promisors:
+            return
+
+        with self.__repo_lock():
+            self.__git_cmd("config", "core.repositoryformatversion", "1")
+            self.__git_cmd("config", "remote.%s.promisor" % remote_name,
+                           "true")
+            self.__git_cmd("config",
+                           "remote.%s.partialclonefilter" % remote_name,
+                           self.fetch_filter)
+        self.__promisors.add(remote_name)
+
+    def __get_dstref(self, remote_name, ref):
+        """
+        Get the destination reference to fetch a remote reference to, named
+        with get_ref_name(). A worktree fetches into its own namespace, so
+        pipelines sharing the repository don't overwrite each other's
+        references either.
+
+        Args:
+            remote_name:    The remote name.
+            ref:            The remote reference.
+
+        Returns:
+            The destination reference.
+        """
+        name = get_ref_name(ref)
+        if self.__ref_namespace:
+            name = join_with_slash(self.__ref_namespace, name)
+        return join_with_slash("refs", "remotes", remote_name, name)
+
+    def __fetch_remote_ref(self, remote_name, ref):
+        """
+        Fetch a reference from a remote, unless it was already fetched.
+
+        Args:
+            remote_name:    The remote name.
+            ref:            The remote reference to fetch.
+
+        Returns:
+            The destination reference the reference was fetched to.
+        """
+        dstref = self.__get_dstref(remote_name, ref)
+        if dstref in self.__fetched:
+            return dstref
+
+        logging.info("fetching %s", dstref)
+        git_fetch_args = ["fetch", remote_name, "+%s:%s" % (ref, dstref)]
+        if self.fetch_filter:
+            self.__set_promisor(remote_name)
+            git_fetch_args.append('--filter=%s' % self.fetch_filter)
+
+        if self.deepen and self.fetch_depth:
+            # Start as shallow as the base, merge_git_ref() adds history
+            # until a merge base is found.
+            git_fetch_args.extend(['--depth', self.fetch_depth])
+            with self.__repo_lock():
+                self.__git_cmd(*git_fetch_args)
+        else:
+            self.__git_cmd(*git_fetch_args)
+
+        self.__fetched.add(dstref)
+        return dstref
+
+    def __has_merge_base(self, dstref):
+        """
+        Check if the current commit and a reference share history.
+
+        Args:
+            dstref: The reference to check.
+
+        Returns:
+            True if a merge base was found, False otherwise.
+        """
+        try:
+            self.__git_cmd("merge-base", "HEAD", dstref)
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    def __deepen_to_merge_base(self, remote_name, ref, dstref):
+        """
+        Deepen the shallow history of the base and of a reference to merge,
+        doubling the amount each time, until they share a merge base. Fetch
+        the complete history if none is found after DEEPEN_ROUNDS attempts.
+
+        Args:
+            remote_name:    The remote name of the reference to merge.
+            ref:            The remote reference to merge.
+            dstref:         The destination reference it was fetched to.
+        """
+        basedst = self.__get_dstref("origin", self.ref)
+        step = int(self.fetch_depth)
+        for _ in range(self.DEEPEN_ROUNDS):
+            if self.__has_merge_base(dstref):
+                return
+
+            logging.info("no merge base with %s, deepening by %d", dstref,
+                         step)
+            with self.__repo_lock():
+                self.__git_cmd("fetch", "--deepen=%d" % step, "origin",
+                               "+%s:%s" % (self.ref, basedst))
+                self.__git_cmd("fetch", "--deepen=%d" % step, remote_name,
+                               "+%s:%s" % (ref, dstref))
+            step *= 2
+
+        if not self.__has_merge_base(dstref):
+            logging.info("no merge base with %s, fetching complete history",
+                         dstref)
+            with self.__repo_lock():
+                self.__git_cmd("fetch", "--unshallow", "origin",
+                               "+%s:%s" % (self.ref, basedst))
+                self.__git_cmd("fetch", remote_name,
+                               "+%s:%s" % (ref, dstref))
+
+    def prefetch(self, merge_refs, jobs=4):
+        """
+        Fetch the base reference and all references to merge concurrently, so
+        checkout() and merge_git_ref() don't wait for the network one remote
+        at a time.
+
+        Args:
+            merge_refs: A list of (uri, ref) tuples of references to merge.
+                        The ref is assumed to be "master" if missing.
+            jobs:       Maximum number of concurrent fetches.
+        """
+        fetches = [(self.__fetch_base, ())]
+        # Fetching to the same destination twice at once would fail on the
+        # ref lock
+        seen = set([self.__get_dstref("origin", self.ref)])
+        # Remotes are added one by one, as each of them rewrites the
+        # repository configuration.
+        for merge_ref in merge_refs:
+            uri = merge_ref[0]
+            ref = merge_ref[1] if len(merge_ref) > 1 else "master"
+            remote_name = self.__add_remote(uri)
+            dstref = self.__get_dstref(remote_name, ref)
+            if dstref not in seen:
+                seen.add(dstref)
+                fetches.append((self.__fetch_remote_ref, (remote_name, ref)))
+
+        logging.info("prefetching %d references with %d jobs",
+                     len(fetches), jobs)
+        pool = ThreadPool(max(1, min(jobs, len(fetches))))
+        try:
+            pool.map(lambda fetch: fetch[0](*fetch[1]), fetches)
+        finally:
+            pool.close()
+            pool.join()
+
+    def __prune_remotes(self, max_age):
+        """
+        Remove merge remotes, along with their references, which weren't used
+        for a while. Remotes without a recorded use are considered used now.
+
+        Args:
+            max_age: Maximum time since the last use of a remote, in seconds.
+        """
+        now = int(time.time())
+        try:
+            output = self.__git_cmd("config", "-z", "--get-regexp",
+                                    r"^remote\..*\.sktlastused$",
+                                    stderr=None)
+        except subprocess.CalledProcessError:
+            output = ""
+
+        last_used = {}
+        for entry in output.split("\0"):
+            key, _, value = entry.partition("\n")
+            if value:
+                last_used[key[len("remote."):-len(".sktlastused")]] = value
+
+        for uri, remote_name in self.__get_remotes().items():
+            if remote_name == "origin":
+                continue
+
+            if remote_name not in last_used:
+                with self.__repo_lock():
+                    self.__git_cmd("config",
+                                   "remote.%s.sktlastused" % remote_name,
+                                   str(now))
+            elif now - int(last_used[remote_name]) > max_age:
+                logging.info("removing unused remote %s", remote_name)
+                with self.__repo_lock():
+                    self.__git_cmd("remote", "remove", remote_name)
+                del self.__remotes[uri]
+
+    def get_object_counts(self):
+        """
+        Get the number of loose objects and packs in the repository.
+
+        Returns:
+            A tuple (loose objects, packs).
+        """
+        counts = {}
+        for line in self.__git_cmd("count-objects", "-v").splitlines():
+            key, _, value = line.partition(":")
+            counts[key] = value.strip()
+
+        return (int(counts.get("count", 0)), int(counts.get("packs", 0)))
+
+    def maintain(self, remote_max_age=None):
+        """
+        Optimize the repository for the following pipelines: prune unused
+        merge remotes, pack loose objects into a new pack, consolidate small
+        packs under a multi-pack-index, and write an incremental commit-graph.
+        Meant to be run between pipelines, as automatic garbage collection is
+        disabled for all other git commands. Failing steps are skipped.
+
+        Args:
+            remote_max_age: Remove merge remotes not used for that many
+                            seconds, or keep all remotes if None.
+
+        Returns:
+            A list of (step name, duration in seconds) tuples of the steps
+            which succeeded.
+        """
+        steps = []
+        if remote_max_age is not None:
+            steps.append(("prune_remotes",
+                          [lambda: self.__prune_remotes(remote_max_age)]))
+        steps.extend([
+            ("repack", [
+                lambda: self.__git_cmd("repack", "-d", "-l", "-q")
+            ]),
+            ("multi_pack_index", [
+                lambda: self.__git_cmd("multi-pack-index", "write"),
+                lambda: self.__git_cmd("multi-pack-index", "expire"),
+                lambda: self.__git_cmd("multi-pack-index", "repack",
+                                       "--batch-size=2g"),
+            ]),
+            ("commit_graph", [
+                lambda: self.__git_cmd("commit-graph", "write", "--reachable",
+                                       "--split", "--no-progress")
+            ]),
+        ])
+
+        timings = []
+        for name, commands in steps:
+            start = time.time()
+            try:
+                for command in commands:
+                    command()
+            except subprocess.CalledProcessError as exc:
+                logging.warning("maintenance step %s failed: %s", name,
+                                exc.output)
+                continue
+
+            duration = time.time() - start
+            logging.info("maintenance step %s took %.2fs", name, duration)
+            timings.append((name, duration))
+
+        return timings
+
+    def __get_remote_head(self):
+        """
+        Get the full hash the base reference points to on the origin remote,
+        asking the remote only once.
+
+        Returns:
+            The full commit hash, or None if it can't be determined.
+        """
+        if self.__remote_head is not None:
+            return self.__remote_head
+
+        if re.match(r'^[0-9a-f]{40}$', self.ref):
+            self.__remote_head = self.ref
+            return self.__remote_head
+
+        try:
+            output = self.__git_cmd("ls-remote", "origin", self.ref,
+                                    stderr=None)
+        except subprocess.CalledProcessError:
+            return None
+
+        heads = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                heads[fields[1]] = fields[0]
+
+        # Prefer the same order git uses to resolve a short reference, and
+        # annotated tags peeled to the commit.
+        for name in [self.ref, "refs/heads/" + self.ref,
+                     "refs/tags/%s^{}" % self.ref, "refs/tags/" + self.ref]:
+            if name in heads:
+                self.__remote_head = heads[name]
+                break
+
+        return self.__remote_head
+
+    def __is_at_remote_head(self):
+        """
+        Check if the current commit is the one the base reference points to
+        on the origin remote.
+
+        Returns:
+            True if the remote base reference is checked out, False otherwise.
+        """
+        remote_head = self.__get_remote_head()
+        if remote_head is None:
+            return False
+
+        try:
+            return self.get_commit_metadata()['hash'] == remote_head
+        except ValueError:
+            # Nothing is checked out yet
+            return False
+
+    def __is_clean(self):
+        """
+        Check if the work tree and the index match the current commit, and no
+        patch application or merge is in progress. Untracked files are
+        ignored, just like "git reset --hard" does. A file system monitor or
+        untracked cache configured for the repository speeds this up.
+
+        Returns:
+            True if the tree is clean, False otherwise.
+        """
+        for state in ["rebase-apply", "MERGE_HEAD"]:
+            path = self.__git_cmd("rev-parse", "--git-path", state).strip()
+            if os.path.exists(os.path.join(self.wdir, path)):
+                return False
+
+        try:
+            status = self.__git_cmd("status", "--porcelain",
+                                    "--untracked-files=no")
+        except subprocess.CalledProcessError:
+            return False
+
+        return status.strip() == ""
+
+    def checkout(self):
+        """
+        Clone and checkout the specified reference from the specified repo URL
+        to the specified working directory. Requires "ref" (reference) to be
+        specified upon creation.
 
-        # The __git_cmd() method expects a list of args, not a list of strings,
-        # so we need to expand our list into args with *.
-        self.__git_cmd(*git_fetch_args)
+        Returns:
+            Full hash of the last commit.
+        """
+        dstref = self.__fetch_base()
 
-        logging.info("checking out %s", self.ref)
-        self.__git_cmd("checkout", "-q", "--detach", dstref)
-        self.__git_cmd("reset", "--hard", dstref)
+        if self.__is_at_remote_head() and self.__is_clean():
+            # Skip rewriting the index and stat-ing the whole tree again
+            logging.info("%s is already checked out", self.ref)
+        else:
+            logging.info("checking out %s", self.ref)
+            self.__git_cmd("checkout", "-q", "--detach", dstref)
+            self.__git_cmd("reset", "--hard", dstref)
 
         head = self.get_commit_hash()
         logging.info("baserepo %s: %s", self.ref, head)
+        self.__base_head = str(head).rstrip()
+        self.__base_patch_ids = None
         return str(head).rstrip()
 
-    def __get_remote_url(self, remote):
+    def __get_remotes(self):
         """
-        Get the URL of a specific remote.
-
-        Args:
-            remote: The name of the remote.
+        Get the table of configured remotes. It is read from the local
+        repository configuration once and kept up to date in memory
+        afterwards, so no remote has to be contacted to resolve a name.
 
         Returns:
-            URL of the remote, None if the remote doesn't exist.
+            A dictionary of remote names keyed by remote URLs.
         """
-        grs = subprocess.Popen(["git",
-                                "--work-tree", self.wdir,
-                                "--git-dir", self.gdir,
-                                "remote", "show", remote],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-        (stdout, _) = grs.communicate()
-        for line in stdout.split("\n"):
-            match = re.match('Fetch URL: (.*)', line)
-            if match:
-                return match.group(1)
-        return None
+        if self.__remotes is None:
+            try:
+                output = self.__git_cmd("config", "-z", "--get-regexp",
+                                        r"^remote\..*\.url$",
+                                        stderr=None)
+            except subprocess.CalledProcessError:
+                # No remotes are configured
+                output = ""
+
+            self.__remotes = {}
+            # Entries look like "remote.<name>.url\n<url>\0"
+            for entry in output.split("\0"):
+                key, _, url = entry.partition("\n")
+                if url:
+                    self.__remotes[url] = key[len("remote."):-len(".url")]
+
+        return self.__remotes
 
     def __get_remote_name(self, uri):
         """
-        Get the remote name of a specific URI.
+        Get the remote name of a specific URI. Remotes which aren't configured
+        yet get a name derived from the URI, with a hash of the whole URI
+        appended to avoid collisions.
 
         Args:
             uri: The URI of the repository's remote.
@@ -281,17 +953,14 @@ class KernelTree(object):
         Returns:
             A string representing the remote name.
         """
-        remote_name = (uri.split('/')[-1].replace('.git', '')
-                       if not uri.endswith('/')
-                       else uri.split('/')[-2].replace('.git', ''))
-        while self.__get_remote_url(remote_name) == uri:
-            logging.warning(
-                "remote '%s' already exists with a different uri, adding '_'",
-                remote_name
-            )
-            remote_name += '_'
+        remotes = self.__get_remotes()
+        if uri in remotes:
+            return remotes[uri]
 
-        return remote_name
+        basename = (uri.split('/')[-1].replace('.git', '')
+                    if not uri.endswith('/')
+                    else uri.split('/')[-2].replace('.git', ''))
+        return "%s-%s" % (basename, hashlib.sha1(uri).hexdigest()[:8])
 
     def merge_git_ref(self, uri, ref="master"):
         """
@@ -305,29 +974,18 @@ class KernelTree(object):
             A tuple (SKT_SUCCESS, reference to commit) on success.
             A tuple (SKT_FAIL, None)                   on failure.
         """
-        remote_name = self.__get_remote_name(uri)
         head = None
 
-        try:
-            self.__git_cmd("remote", "add", remote_name, uri)
-        except subprocess.CalledProcessError:
-            pass
+        remote_name = self.__add_remote(uri)
+        dstref = self.__fetch_remote_ref(remote_name, ref)
 
-        dstref = join_with_slash("refs",
-                                 "remotes",
-                                 remote_name,
-                                 ref.split('/')[-1])
-        logging.info("fetching %s", dstref)
-        self.__git_cmd("fetch", remote_name,
-                       "+%s:%s" % (ref, dstref))
+        if self.deepen and self.fetch_depth:
+            self.__deepen_to_merge_base(remote_name, ref, dstref)
 
         logging.info("merging %s: %s", remote_name, ref)
         try:
-            grargs = {'stdout': subprocess.PIPE} if \
-                logging.getLogger().level > logging.DEBUG else {}
-
-            self.__git_cmd("merge", "--no-edit", dstref, **grargs)
-            head = self.get_commit_hash(dstref)
+            self.__git_cmd("merge", "--no-edit", dstref)
+            head = self.get_commit_metadata(dstref)['hash']
             logging.info("%s %s: %s", remote_name, ref, head)
         except subprocess.CalledProcessError:
             logging.warning("failed to merge '%s' from %s, skipping", ref,
@@ -337,6 +995,225 @@ class KernelTree(object):
 
         return (SKT_SUCCESS, head)
 
+    def __get_patch_cache_base(self):
+        """
+        Get the commit patches are about to be applied to, if patch
+        application results are cached.
+
+        Returns:
+            The full hash of the current commit, or None if there is no patch
+            cache.
+        """
+        if self.patch_cache is None:
+            return None
+
+        return self.get_commit_metadata()['hash']
+
+    def __apply_cached_patches(self, base, contents, name):
+        """
+        Reuse a cached result of applying patches to a base commit. A known
+        resulting commit is checked out, a known failure is reported with the
+        stored merge log.
+
+        Args:
+            base:       The full hash of the commit to apply the patches to,
+                        or None if there is no patch cache.
+            contents:   A list of patch contents, in application order.
+            name:       The name of the patch to report failures with.
+
+        Returns:
+            True if the cached result was applied, False if there is none.
+
+        Raises:
+            PatchApplicationError if the patches are known not to apply.
+        """
+        if base is None:
+            return False
+
+        result = self.patch_cache.lookup(base, contents)
+        if result is None:
+            return False
+
+        if result.get('log') is not None:
+            logging.error('Patch application failed (cached) with:\n%s',
+                          result['log'])
+            with open(self.mergelog, "w") as fileh:
+                fileh.write(result['log'])
+            raise PatchApplicationError("Failed to apply patch %s" % name,
+                                        index=result.get('index'))
+
+        try:
+            self.get_commit_metadata(result['commit'])
+        except ValueError:
+            # The commit was created in another repository
+            return False
+
+        logging.info("Using cached result of %s: %s", name, result['commit'])
+        self.__git_cmd("reset", "-q", "--hard", result['commit'])
+        return True
+
+    def __cache_patch_result(self, base, contents, log=None, index=None):
+        """
+        Remember the result of applying patches to a base commit.
+
+        Args:
+            base:       The full hash of the commit the patches were applied
+                        to, or None if there is no patch cache.
+            contents:   A list of patch contents, in application order.
+            log:        The merge log if the patches failed to apply, None if
+                        they were applied and the result is checked out.
+            index:      The index of the patch which failed to apply.
+        """
+        if base is None:
+            return
+
+        if log is None:
+            self.patch_cache.store(base, contents,
+                                   commit=self.get_commit_metadata()['hash'])
+        else:
+            self.patch_cache.store(base, contents, log=log, index=index)
+
+    def __get_patch_ids(self, content):
+        """
+        Get the stable patch-ids of the patches in an mbox or a diff.
+
+        Args:
+            content: The patch content.
+
+        Returns:
+            A list of patch-ids, empty if the content has no diff.
+        """
+        status, output = self.__git_cmd_pipe(content, "patch-id", "--stable")
+        if status != 0:
+            return []
+
+        return [line.split()[0] for line in output.splitlines() if line]
+
+    def __get_base_patch_ids(self):
+        """
+        Get the patch-ids of the recent base history. They are computed once
+        per base commit and cached in the repository. Only the history which
+        was fetched is indexed, so patches applied before the start of a
+        shallow history are not found. Such an index is not cached, as the
+        history may be deepened later.
+
+        Returns:
+            A dictionary of commit hashes keyed by their patch-ids.
+        """
+        if self.__base_patch_ids is not None:
+            return self.__base_patch_ids
+
+        base = self.__base_head or self.get_commit_metadata()['hash']
+        common_dir = self.__git_cmd("rev-parse", "--git-common-dir").strip()
+        cache_dir = os.path.join(self.wdir, common_dir, "skt-patch-ids")
+        cache_path = os.path.join(cache_dir, base + ".json")
+
+        try:
+            with open(cache_path, 'r') as fileh:
+                self.__base_patch_ids = json.load(fileh)
+            return self.__base_patch_ids
+        except (IOError, ValueError):
+            pass
+
+        shallow = self.__git_cmd("rev-parse",
+                                 "--is-shallow-repository").strip() == "true"
+        if shallow:
+            logging.warning("history of %s is shallow, patches applied before "
+                            "its first fetched commit are not detected", base)
+
+        logging.info("indexing patch-ids of %d commits of %s",
+                     self.PATCH_ID_HISTORY, base)
+        # Stream the history straight into "git patch-id" instead of holding
+        # all of the diffs in memory.
+        with accounting.account('git'):
+            log = self.__git_cmd_call(accounting.popen, "log", "-p",
+                                      "--no-merges", "--format=commit %H",
+                                      "-n", str(self.PATCH_ID_HISTORY), base,
+                                      stdout=subprocess.PIPE, stderr=None)
+            patch_id = self.__git_cmd_call(accounting.popen, "patch-id",
+                                           "--stable", stdin=log.stdout,
+                                           stdout=subprocess.PIPE,
+                                           stderr=None)
+            log.stdout.close()
+            output = patch_id.communicate()[0]
+            log.wait()
+
+        self.__base_patch_ids = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                self.__base_patch_ids[fields[0]] = fields[1]
+
+        if not shallow and log.returncode == 0 and patch_id.returncode == 0:
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                pass
+            tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+            with open(tmp_path, 'w') as fileh:
+                json.dump(self.__base_patch_ids, fileh)
+            os.rename(tmp_path, cache_path)
+
+        return self.__base_patch_ids
+
+    def __find_applied(self, content):
+        """
+        Find the base history commits a patch is already applied as.
+
+        Args:
+            content: The patch content.
+
+        Returns:
+            A list of the commit hashes, or None if some of the patches in
+            the content are not in the base history.
+        """
+        patch_ids = self.__get_patch_ids(content)
+        if not patch_ids:
+            return None
+
+        base_patch_ids = self.__get_base_patch_ids()
+        if not all(patch_id in base_patch_ids for patch_id in patch_ids):
+            return None
+
+        return [base_patch_ids[patch_id] for patch_id in patch_ids]
+
+    def __skip_applied(self, content, name, index=None):
+        """
+        Check if a patch is already applied to the base, and act according
+        to the applied_patches setting.
+
+        Args:
+            content:    The patch content.
+            name:       The patch name to report.
+            index:      The index of the patch in a series, if any.
+
+        Returns:
+            True if the patch should be skipped, False if it should be
+            applied.
+
+        Raises:
+            PatchApplicationError if the patch is already applied and the
+            setting is "fail".
+        """
+        if self.applied_patches == "apply":
+            return False
+
+        commits = self.__find_applied(content)
+        if commits is None:
+            return False
+
+        message = "Patch %s is already applied as %s" % (name,
+                                                         ", ".join(commits))
+        if self.applied_patches == "fail":
+            logging.error(message)
+            with open(self.mergelog, "w") as fileh:
+                fileh.write(message + "\n")
+            raise PatchApplicationError(message, index=index)
+
+        logging.warning("%s, skipping", message)
+        self.skipped_patches.append(name)
+        return True
+
     def merge_patchwork_patch(self, uri, session_id=None):
         """
         Apply a patch from Patchwork (using git am)
@@ -349,6 +1226,13 @@ class KernelTree(object):
             PatchApplicationError in case the patch failed to apply.
         """
         patch_content = get_patch_mbox(uri, session_id)
+        patch_name = os.path.basename(os.path.normpath(uri))
+        if self.__skip_applied(patch_content, patch_name):
+            return
+
+        base = self.__get_patch_cache_base()
+        if self.__apply_cached_patches(base, [patch_content], patch_name):
+            return
 
         logging.info("Applying %s", uri)
 
@@ -364,11 +1248,13 @@ class KernelTree(object):
             with open(self.mergelog, "w") as fileh:
                 fileh.write(output)
 
+            self.__cache_patch_result(base, [patch_content], log=output)
             raise PatchApplicationError(
-                "Failed to apply patch %s" %
-                os.path.basename(os.path.normpath(uri))
+                "Failed to apply patch %s" % patch_name
             )
 
+        self.__cache_patch_result(base, [patch_content])
+
     def merge_patch_file(self, path):
         """
         Apply a particular local patch run.
@@ -382,6 +1268,16 @@ class KernelTree(object):
         if not os.path.exists(path):
             raise Exception("Patch %s not found" % path)
 
+        base = self.__get_patch_cache_base()
+        patch_content = None
+        if base is not None or self.applied_patches != "apply":
+            with open(path, 'r') as fileh:
+                patch_content = fileh.read()
+        if self.__skip_applied(patch_content, path):
+            return
+        if self.__apply_cached_patches(base, [patch_content], path):
+            return
+
         # Run in workdir to workaround "git am" ignoring --work-tree
         try:
             self.__git_cmd("am", path, cwd=self.wdir)
@@ -393,8 +1289,289 @@ class KernelTree(object):
             with open(self.mergelog, "w") as fileh:
                 fileh.write(exc.output)
 
+            self.__cache_patch_result(base, [patch_content], log=exc.output)
             raise PatchApplicationError("Failed to apply patch %s" % path)
 
+        self.__cache_patch_result(base, [patch_content])
+
+    def merge_patch_series(self, patches, session_id=None):
+        """
+        Apply a series of local and Patchwork patches with a single "git am"
+        run, feeding it all of them as one mbox stream.
+
+        Args:
+            patches:    A list of ("patch", path) and ("pw", uri) tuples, in
+                        application order.
+            session_id: Patchwork session cookie, in case login is required.
+
+        Raises:
+            PatchApplicationError in case a patch failed to apply. Its
+            "index" attribute is the index of the failed patch in the list.
+        """
+        names = []
+        contents = []
+        for (patch_type, patch) in patches:
+            if patch_type == 'pw':
+                contents.append(get_patch_mbox(patch, session_id))
+                names.append(os.path.basename(os.path.normpath(patch)))
+            else:
+                if not os.path.exists(patch):
+                    raise Exception("Patch %s not found" % patch)
+                with open(patch, 'r') as fileh:
+                    contents.append(fileh.read())
+                names.append(patch)
+
+        # Leave out the patches already in the base, keeping track of the
+        # original index of each remaining one.
+        indexes = [index for index in range(len(patches))
+                   if not self.__skip_applied(contents[index], names[index],
+                                              index=index)]
+        if not indexes:
+            return
+        patches = [patches[index] for index in indexes]
+        contents = [contents[index] for index in indexes]
+        names = [names[index] for index in indexes]
+
+        base = self.get_commit_metadata()['hash']
+        cache_base = base if self.patch_cache is not None else None
+        try:
+            if self.__apply_cached_patches(cache_base, contents,
+                                           ', '.join(names)):
+                return
+        except PatchApplicationError as exc:
+            if exc.index is not None:
+                exc.index = indexes[exc.index]
+            raise
+
+        # The number of commits each patch file creates, used to find out
+        # which one failed from the number of commits "git am" made.
+        counts = [len(re.findall(r'^From \S+ ', content, re.MULTILINE))
+                  for content in contents]
+        if 0 in counts:
+            # Not everything is in mbox format, so it can't be concatenated.
+            logging.info("Not all patches are mboxes, applying one by one")
+            for index, (patch_type, patch) in enumerate(patches):
+                try:
+                    if patch_type == 'pw':
+                        self.merge_patchwork_patch(patch, session_id)
+                    else:
+                        self.merge_patch_file(patch)
+                except PatchApplicationError as exc:
+                    exc.index = indexes[index]
+                    raise
+            return
+
+        logging.info("Applying a series of %d patches", len(patches))
+        # Run in workdir to workaround "git am" ignoring --work-tree
+        status, output = self.__git_cmd_pipe(
+            ''.join(content if content.endswith("\n") else content + "\n"
+                    for content in contents),
+            "am", "-",
+            cwd=self.wdir
+        )
+        if status != 0:
+            logging.error('Patch application failed with:\n%s', output)
+
+            # "git am" stops at the first failing patch, with the previous
+            # ones committed.
+            applied = int(self.__git_cmd("rev-list", "--count",
+                                         "%s..HEAD" % base))
+            index = 0
+            while index < len(counts) - 1 and applied >= counts[index]:
+                applied -= counts[index]
+                index += 1
+
+            self.__git_cmd("am", "--abort", cwd=self.wdir)
+
+            with open(self.mergelog, "w") as fileh:
+                fileh.write(output)
+
+            self.__cache_patch_result(cache_base, contents, log=output,
+                                      index=index)
+            raise PatchApplicationError(
+                "Failed to apply patch %s" % names[index],
+                index=indexes[index]
+            )
+
+        self.__cache_patch_result(cache_base, contents)
+
+    def __check_patch(self, base, content):
+        """
+        Check if a patch applies to a base commit, using a temporary index
+        instead of the work tree.
+
+        Args:
+            base:       The full hash of the base commit.
+            content:    The patch content.
+
+        Returns:
+            A tuple (status, files), where status is "pass", "conflict" or
+            "fail", and files is a list of the files which didn't apply.
+        """
+        tmpdir = tempfile.mkdtemp(prefix="skt-index-")
+        env = {'GIT_INDEX_FILE': os.path.join(tmpdir, "index")}
+        try:
+            self.__git_cmd("read-tree", base, env=env)
+            status, output = self.__git_cmd_pipe(content, "apply", "--cached",
+                                                 "--check", env=env,
+                                                 cwd=self.wdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        if status == 0:
+            return ("pass", [])
+
+        files = []
+        for match in re.finditer(r'^error: (?:patch failed: (.+):\d+|(.+): '
+                                 r'(?:patch does not apply|does not exist '
+                                 r'in index|already exists in index))$',
+                                 output, re.MULTILINE):
+            name = match.group(1) or match.group(2)
+            if name not in files:
+                files.append(name)
+
+        return ("conflict" if files else "fail", files)
+
+    def __check_git_version(self, version):
+        """
+        Check if the installed git is recent enough.
+
+        Args:
+            version:    The minimum version, as a tuple of numbers.
+
+        Raises:
+            GitVersionError if the installed git is older.
+        """
+        output = self.__git_cmd("version")
+        match = re.search(r'(\d+)\.(\d+)', output)
+        if match and tuple(int(number) for number in match.groups()) < version:
+            raise GitVersionError("%s is too old, at least %s is required" % (
+                output.strip(), ".".join(str(number) for number in version)
+            ))
+
+    def __check_ref(self, base, remote_name, ref):
+        """
+        Check if a git reference merges cleanly into a base commit, with an
+        in-memory merge.
+
+        Args:
+            base:           The full hash of the base commit.
+            remote_name:    The remote name.
+            ref:            The remote reference to merge.
+
+        Returns:
+            A tuple (status, files), where status is "pass", "conflict" or
+            "fail", and files is a list of the conflicting files.
+        """
+        dstref = self.__fetch_remote_ref(remote_name, ref)
+        try:
+            self.__git_cmd("merge-tree", "--write-tree", "--name-only",
+                           "--no-messages", base, dstref, stderr=None)
+        except subprocess.CalledProcessError as exc:
+            # Usage error, the options are not supported
+            if exc.returncode == 129:
+                raise GitVersionError("git merge-tree doesn't support "
+                                      "--write-tree")
+            if exc.returncode != 1:
+                return ("fail", [])
+            # The resulting tree is followed by the conflicting files
+            files = []
+            for name in exc.output.splitlines()[1:]:
+                if name and name not in files:
+                    files.append(name)
+            return ("conflict", files)
+
+        return ("pass", [])
+
+    def check_mergeability(self, merge_queue, session_id=None, jobs=4):
+        """
+        Check if each of the references and patches applies to the base on
+        its own, without checking anything out. The base and references are
+        fetched, patches are checked with "git apply" against a temporary
+        index and references with an in-memory "git merge-tree", which
+        requires git 2.38 or newer.
+
+        Each item is checked alone against the base, not on top of the items
+        before it as a series, so items which pass may still conflict with
+        each other when merged together, and a patch depending on an earlier
+        item fails.
+
+        Args:
+            merge_queue:    A list of ("merge_ref", "uri [ref]"),
+                            ("patch", path) and ("pw", uri) tuples.
+            session_id:     Patchwork session cookie, in case login is
+                            required.
+            jobs:           Maximum number of concurrent checks.
+
+        Returns:
+            A list of (status, files) tuples, one for each merge queue item,
+            where status is "pass", "conflict" or "fail", and files is a list
+            of the conflicting files.
+
+        Raises:
+            GitVersionError if references are checked, but the installed git
+            is too old to.
+        """
+        if any(merge_type == 'merge_ref' for (merge_type, _) in merge_queue):
+            self.__check_git_version(self.MERGE_TREE_VERSION)
+
+        base = self.get_commit_metadata(self.__fetch_base())['hash']
+        logging.info("checking %d items against %s", len(merge_queue), base)
+
+        # Remotes are added one by one, as each of them rewrites the
+        # repository configuration.
+        checks = []
+        for (merge_type, value) in merge_queue:
+            if merge_type == 'merge_ref':
+                merge_ref = value.split()
+                ref = merge_ref[1] if len(merge_ref) > 1 else "master"
+                checks.append((merge_type,
+                               (self.__add_remote(merge_ref[0]), ref)))
+            else:
+                checks.append((merge_type, value))
+
+        def check(item):
+            """Check a single merge queue item."""
+            (merge_type, value) = item
+            try:
+                if merge_type == 'merge_ref':
+                    return self.__check_ref(base, *value)
+                if merge_type == 'pw':
+                    content = get_patch_mbox(value, session_id)
+                else:
+                    with open(value, 'r') as fileh:
+                        content = fileh.read()
+                return self.__check_patch(base, content)
+            except GitVersionError:
+                raise
+            # pylint: disable=broad-except
+            except Exception as exc:
+                logging.warning("failed to check %s: %s", value, exc)
+                return ("fail", [])
+
+        pool = ThreadPool(max(1, min(jobs, len(checks))))
+        try:
+            return pool.map(check, checks)
+        finally:
+            pool.close()
+            pool.join()
+
+
+class GitVersionError(Exception):
+    """Exception raised when the installed git is too old for an operation."""
+
 
 class PatchApplicationError(Exception):
     """Exception raised when the patch fails to apply."""
+
+    def __init__(self, message, index=None):
+        """
+        Initialize a PatchApplicationError.
+
+        Args:
+            message:    The error message.
+            index:      The index of the failed patch within a series, if
+                        known.
+        """
+        super(PatchApplicationError, self).__init__(message)
+        self.index = index
@@ -12,10 +12,13 @@
 # along with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Functions and constants used by multiple parts of skt."""
+from contextlib import contextmanager
 import cookielib
 from email.errors import HeaderParseError
 import email.header
 import email.parser
+import fcntl
+import hashlib
 import re
 
 import requests
@@ -74,6 +77,41 @@ def join_with_slash(base, *suffix_tuple):
     return '/'.join(parts) + ending
 
 
+def get_ref_name(ref):
+    """
+    Get the name to fetch a remote reference to, within a namespace of
+    fetched references. It is the last component of the reference, with a
+    hash of the whole reference appended, so references sharing the last
+    component don't overwrite each other.
+
+    Args:
+        ref:    The remote reference.
+
+    Returns:
+        The name of the destination reference within its namespace.
+    """
+    return "%s-%s" % (ref.split('/')[-1], hashlib.sha1(ref).hexdigest()[:8])
+
+
+@contextmanager
+def lock_repository(common_dir):
+    """
+    Hold the repository lock, serializing updates of the configuration and
+    of the shallow history of a repository with other threads, and with other
+    processes working with the repository or any of its worktrees.
+
+    Args:
+        common_dir: The git directory shared by all worktrees of the
+                    repository.
+    """
+    with open(join_with_slash(common_dir, "skt.lock"), 'a') as lockh:
+        fcntl.flock(lockh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockh, fcntl.LOCK_UN)
+
+
 def get_patch_name(content):
     """
     Retrieve patch name from 'Subject' header from the mbox string
@@ -0,0 +1,112 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Class for copying the output of commands to a log and stdout."""
+import sys
+import time
+
+
+class OutputTee(object):
+    """
+    OutputTee - copy the output of a command to the build log and stdout.
+    Stdout gets the output in full, throttled to a progress line at most every
+    THROTTLE_INTERVAL seconds, or nothing until the command finishes. The
+    last two modes end with a summary of the last lines. Only whole lines are
+    written to stdout, so output of concurrent commands doesn't interleave
+    mid-line.
+    """
+    # Output modes
+    MODES = ('full', 'throttle', 'summary')
+    # Bytes read from the command at once
+    CHUNK_SIZE = 64 * 1024
+    # Seconds between progress lines in throttled mode
+    THROTTLE_INTERVAL = 30
+    # Lines of output written in summarized mode
+    SUMMARY_LINES = 20
+
+    def __init__(self, mode, prefix=""):
+        """
+        Initialize an output tee.
+
+        Args:
+            mode:   The output mode, one of MODES, or None for no output to
+                    stdout.
+            prefix: A prefix of the lines written to stdout.
+        """
+        self.mode = mode
+        self.prefix = prefix
+        self.lines = 0
+        # The incomplete last line in full mode, or the last lines otherwise
+        self.__pending = ""
+        self.__last_progress = time.time()
+
+    def __output(self, data):
+        """Write whole lines to stdout, prefixing each one."""
+        if self.prefix:
+            data = self.prefix + data[:-1].replace(
+                "\n", "\n" + self.prefix
+            ) + "\n"
+        sys.stdout.write(data)
+        sys.stdout.flush()
+
+    def write(self, logh, chunk):
+        """
+        Write a chunk of output.
+
+        Args:
+            logh:   The build log file.
+            chunk:  The output.
+        """
+        logh.write(chunk)
+        self.lines += chunk.count("\n")
+        if self.mode is None:
+            return
+
+        data = self.__pending + chunk
+        if self.mode == 'full':
+            end = data.rfind("\n") + 1
+            if end:
+                self.__output(data[:end])
+            self.__pending = data[end:]
+            return
+
+        # Keep enough of the output for a progress line or the summary
+        self.__pending = data[-self.CHUNK_SIZE:]
+        now = time.time()
+        if (self.mode == 'throttle'
+                and now - self.__last_progress >= self.THROTTLE_INTERVAL):
+            self.__last_progress = now
+            lines = self.__pending[:self.__pending.rfind("\n")].split("\n")
+            self.__output("[{} lines] {}\n".format(self.lines, lines[-1]))
+
+    def close(self, buildlog):
+        """
+        Write the rest of the output once the command finished.
+
+        Args:
+            buildlog:   The path to the build log, mentioned in the summary.
+        """
+        if self.mode is None:
+            return
+
+        pending = self.__pending
+        if pending and not pending.endswith("\n"):
+            pending += "\n"
+        if self.mode == 'full':
+            if pending:
+                self.__output(pending)
+            return
+
+        tail = pending.splitlines(True)[-self.SUMMARY_LINES:]
+        self.__output("[{} lines, see {}]\n".format(self.lines, buildlog)
+                      + "".join(tail))
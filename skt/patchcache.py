@@ -0,0 +1,112 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Class for caching the results of applying patches."""
+import hashlib
+import json
+import os
+
+from skt.misc import join_with_slash
+
+
+class PatchCache(object):
+    """
+    PatchCache - a directory of results of applying patches to base commits,
+    keyed by the base commit and the content of the patches, so repeated
+    merges of the same series skip "git am".
+    """
+
+    def __init__(self, path):
+        """
+        Initialize a PatchCache.
+
+        Args:
+            path:   The directory to store the results in. It is created on
+                    the first store.
+        """
+        self.path = path
+
+    @classmethod
+    def get_key(cls, base, contents):
+        """
+        Get the cache key of applying patches to a base commit.
+
+        Args:
+            base:       The full hash of the base commit.
+            contents:   A list of patch contents, in application order.
+
+        Returns:
+            The key as a hexadecimal string.
+        """
+        key = hashlib.sha256(base)
+        for content in contents:
+            key.update(hashlib.sha256(content).digest())
+        return key.hexdigest()
+
+    def __get_entry_path(self, key):
+        """
+        Get the path of the file storing a cache entry.
+
+        Args:
+            key:    The cache key.
+
+        Returns:
+            Path to the entry file.
+        """
+        return join_with_slash(self.path, key[:2], key + ".json")
+
+    def lookup(self, base, contents):
+        """
+        Look up the result of applying patches to a base commit.
+
+        Args:
+            base:       The full hash of the base commit.
+            contents:   A list of patch contents, in application order.
+
+        Returns:
+            A dictionary with either the resulting "commit" hash, or the merge
+            "log" of the failed application and the "index" of the failed
+            patch. None if the result is unknown.
+        """
+        try:
+            with open(self.__get_entry_path(self.get_key(base, contents)),
+                      'r') as fileh:
+                return json.load(fileh)
+        except (IOError, ValueError):
+            return None
+
+    # pylint: disable=too-many-arguments
+    def store(self, base, contents, commit=None, log=None, index=None):
+        """
+        Store the result of applying patches to a base commit.
+
+        Args:
+            base:       The full hash of the base commit.
+            contents:   A list of patch contents, in application order.
+            commit:     The full hash of the resulting commit, if the patches
+                        applied.
+            log:        The merge log, if the patches failed to apply.
+            index:      The index of the patch which failed to apply.
+        """
+        entry_path = self.__get_entry_path(self.get_key(base, contents))
+        try:
+            os.makedirs(os.path.dirname(entry_path))
+        except OSError:
+            pass
+
+        # Write atomically, concurrent pipelines may read the entry.
+        tmpfile = "%s.%d.tmp" % (entry_path, os.getpid())
+        with open(tmpfile, 'w') as fileh:
+            json.dump({'base': base, 'commit': commit, 'log': log,
+                       'index': index}, fileh)
+        os.rename(tmpfile, entry_path)
@@ -19,6 +19,7 @@ import subprocess
 
 from abc import ABCMeta, abstractmethod
 
+from skt import accounting
 from skt.misc import join_with_slash
 
 
@@ -104,7 +105,8 @@ class ScpPublisher(Publisher):
             Published URL corresponding to the specified source.
         """
         destination = join_with_slash(self.destination, "")
-        subprocess.check_call(["scp", source, destination])
+        with accounting.account('publish'):
+            accounting.check_call(["scp", source, destination])
         return self.geturl(source)
 
 
@@ -122,11 +124,12 @@ class SftpPublisher(Publisher):
         Returns:
             Published URL corresponding to the specified source.
         """
-        proc = subprocess.Popen(['sftp', self.destination],
-                                stdin=subprocess.PIPE)
-        proc.stdin.write("put -r %s\n" % source)
-        proc.stdin.close()
-        proc.wait()
+        with accounting.account('publish'):
+            proc = accounting.popen(['sftp', self.destination],
+                                    stdin=subprocess.PIPE)
+            proc.stdin.write("put -r %s\n" % source)
+            proc.stdin.close()
+            proc.wait()
         return self.geturl(source)
 
 
@@ -0,0 +1,156 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Class for managing a host-wide reference repository."""
+import fcntl
+import hashlib
+import logging
+import os
+import subprocess
+import time
+
+from skt import accounting
+from skt.misc import join_with_slash, get_ref_name
+
+
+class ReferenceRepository(object):
+    """
+    ReferenceRepository - a host-wide bare git repository shared by KernelTree
+    clones through git alternates, acting as an object cache for the upstream
+    kernel history.
+    """
+
+    def __init__(self, path, refresh_interval=3600):
+        """
+        Initialize a ReferenceRepository.
+
+        Args:
+            path:               The directory to house the bare repository.
+                                It is created on the first update.
+            refresh_interval:   Minimum number of seconds between two fetches
+                                of the same remote reference.
+        """
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.lockfile = join_with_slash(self.path, "skt.lock")
+
+    def __git_cmd(self, *args):
+        """
+        Run a git command against the reference repository and return its
+        output.
+
+        Args:
+            *args:  Git command arguments.
+
+        Returns:
+            Git command output.
+        """
+        # Objects in here are borrowed by other repositories, so they must
+        # never be pruned by an automatic garbage collection.
+        cmd_args = ["git", "--git-dir", self.path, "-c", "gc.auto=0"]
+        cmd_args += list(args)
+
+        logging.debug("executing: %s", " ".join(cmd_args))
+        try:
+            with accounting.account('git'):
+                return accounting.check_output(
+                    cmd_args,
+                    env=dict(os.environ, **{'LC_ALL': 'C'}),
+                    stderr=subprocess.STDOUT
+                )
+        except subprocess.CalledProcessError as exc:
+            logging.debug(exc.output)
+            raise exc
+
+    def get_objects_dir(self):
+        """
+        Get the path to the object database of the reference repository.
+
+        Returns:
+            Absolute path of the "objects" directory.
+        """
+        return join_with_slash(os.path.abspath(self.path), "objects")
+
+    def __get_stamp(self, uri, ref):
+        """
+        Get the path of the file recording the last fetch of a reference.
+
+        Args:
+            uri:    The Git URI of the remote repository.
+            ref:    The remote reference.
+
+        Returns:
+            Path to the stamp file.
+        """
+        digest = hashlib.sha1("%s %s" % (uri, ref)).hexdigest()
+        return join_with_slash(self.path, "skt-stamps", digest)
+
+    def is_fresh(self, uri, ref):
+        """
+        Check if a remote reference was fetched recently enough.
+
+        Args:
+            uri:    The Git URI of the remote repository.
+            ref:    The remote reference.
+
+        Returns:
+            True if the reference was fetched within the refresh interval,
+            False otherwise.
+        """
+        try:
+            mtime = os.path.getmtime(self.__get_stamp(uri, ref))
+        except OSError:
+            return False
+
+        return time.time() - mtime < self.refresh_interval
+
+    def update(self, uri, ref):
+        """
+        Fetch a remote reference into the reference repository, unless it was
+        refreshed recently. Concurrent callers are serialized with a lock file,
+        so several pipelines can share the same repository safely.
+
+        Args:
+            uri:    The Git URI of the remote repository.
+            ref:    The remote reference to fetch.
+        """
+        try:
+            os.makedirs(join_with_slash(self.path, "skt-stamps"))
+        except OSError:
+            pass
+
+        with open(self.lockfile, 'a') as lockh:
+            fcntl.flock(lockh, fcntl.LOCK_EX)
+            try:
+                # Another pipeline may have refreshed it while we waited for
+                # the lock.
+                if self.is_fresh(uri, ref):
+                    logging.debug("reference repo is fresh for %s %s",
+                                  uri, ref)
+                    return
+
+                self.__git_cmd("init", "--bare", "-q")
+
+                # Keep the fetched history reachable under a per-remote
+                # namespace, so it is never considered garbage.
+                namespace = hashlib.sha1(uri).hexdigest()
+                dstref = join_with_slash("refs", "skt", namespace,
+                                         get_ref_name(ref))
+                logging.info("updating reference repo %s", self.path)
+                self.__git_cmd("fetch", "--no-tags", uri,
+                               "+%s:%s" % (ref, dstref))
+
+                with open(self.__get_stamp(uri, ref), 'w') as fileh:
+                    fileh.write("%d\n" % time.time())
+            finally:
+                fcntl.flock(lockh, fcntl.LOCK_UN)
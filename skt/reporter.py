@@ -25,10 +25,12 @@ import sys
 
 from jinja2 import Environment, FileSystemLoader
 
+from skt.buildlogindex import BuildLogIndex
 from skt.console import gzipdata
 from skt.misc import get_patch_name, get_patch_mbox
 from skt.misc import WaivingWrap
 import skt.runner
+from skt.state_file import get_target_states
 
 # Determine the absolute path to this script and the directory which holds
 # the jinja2 templates.
@@ -109,6 +111,8 @@ class Reporter(object):
     """Abstract test result reporter"""
     # pylint: disable=too-few-public-methods,too-many-instance-attributes
     TYPE = 'default'
+    # Maximum number of build error locations in a report
+    MAX_BUILD_ERRORS = 5
 
     def __init__(self, cfg):
         """
@@ -208,10 +212,11 @@ class Reporter(object):
 
         return result
 
-    def __getbuildlog(self, suffix=None):
+    def __getbuildlog(self, job_cfg, suffix=None):
         """
         Read a build log from the disk and add it to the list of attachments.
         Args:
+            job_cfg: The state of the job, e.g. of a target of several.
             suffix: The extra text to add to the build log file name. This is
                     helpful for distinguishing between different architectures
                     that were built. Examples: 'aarch64', 'x86_64'.
@@ -219,7 +224,7 @@ class Reporter(object):
                  exists from a failed build. Otherwise None is returned.
         """
         # Did the build fail?
-        if not self.cfg.get('buildlog'):
+        if not job_cfg.get('buildlog'):
             return None
 
         if suffix:
@@ -227,11 +232,35 @@ class Reporter(object):
         else:
             attachment_name = "build.log.gz"
 
-        with open(self.cfg.get("buildlog"), 'r') as fileh:
+        with open(job_cfg.get("buildlog"), 'r') as fileh:
             self.attach.append((attachment_name, gzipdata(fileh.read())))
 
         return attachment_name
 
+    def __getbuilderrors(self, job_cfg):
+        """
+        Get the first errors of a failed build from the index of its build
+        log, so the log doesn't have to be searched.
+
+        Args:
+            job_cfg: The state of the job, e.g. of a target of several.
+
+        Returns: A list of "location: message" strings, at most
+                 MAX_BUILD_ERRORS.
+        """
+        index = BuildLogIndex.load(job_cfg.get('buildlog'))
+        errors = []
+        for diagnostic in index.get_diagnostics('error')[
+                :self.MAX_BUILD_ERRORS]:
+            if diagnostic['line'] is not None:
+                location = "{}:{}".format(diagnostic['file'],
+                                          diagnostic['line'])
+            else:
+                location = diagnostic['file'] or diagnostic['tool']
+            errors.append("{}: {}".format(location, diagnostic['message']))
+
+        return errors
+
     @classmethod
     def __get_task_logs(cls, task_node):
         """
@@ -268,22 +297,25 @@ class Reporter(object):
         task_node = recipe.find(xml_task_element)
         return task_node
 
-    def __getjobresults(self):
+    def __getjobresults(self, job_cfg):
         """
         Retrieve job results which should be appended to the report.
         Every test run has a list of receipe sets that were run. Each set
         can contain one or more recipes. Each recipe has one or more tasks
         that run individual tests.
 
+        Args:
+            job_cfg: The state of the job, e.g. of a target of several.
+
         Returns:
             A list of dictionaries, each representing a job's recipe result.
         """
         result = []
 
-        runner = skt.runner.getrunner(*self.cfg.get("runner"))
+        runner = skt.runner.getrunner(*job_cfg.get("runner"))
 
         # Get the list of recipes sets that were run.
-        recipe_set_list = self.cfg.get('recipe_sets', [])
+        recipe_set_list = job_cfg.get('recipe_sets', [])
 
         # Get the XML result tree for each recipe set.
         recipe_set_results = [runner.getresultstree(recipe_set_id)
@@ -414,35 +446,49 @@ class Reporter(object):
                 )
                 return report_text, set()
 
-            # Store the data about this job for the report.
-            job_data = self.cfg
-
-            # If our make options contain '-C <path>', we should remove that.
-            if 'make_opts' in job_data:
-                pattern = r' -C [\w\-/\d]+'
-                job_data['make_opts'] = re.sub(
-                    pattern, '', job_data['make_opts']
-                )
+            # Each target of a build of several targets is a job of its own.
+            targets = get_target_states(self.cfg)
+            for (index, target) in enumerate(targets):
+                # Store the data about this job for the report.
+                job_data = dict(target)
+
+                # If our make options contain '-C <path>', we should remove
+                # that.
+                if 'make_opts' in job_data:
+                    pattern = r' -C [\w\-/\d]+'
+                    job_data['make_opts'] = re.sub(
+                        pattern, '', job_data['make_opts']
+                    )
 
-            # Did the compile fail for this job?
-            # If yes, store the build log and skip to the next job since we
-            # didn't test anything in this job.
-            if self.cfg.get('buildlog'):
-                self.multireport_failed = MultiReportFailure.BUILD
-                kernel_arch = self.cfg.get('kernel_arch')
-                job_data['buildlog'] = self.__getbuildlog(kernel_arch)
-                report_jobs.append(job_data)
-                continue
-
-            # Did the tests run for this job?
-            if self.cfg.get('runner') and self.cfg.get('retcode'):
-                # If the tests failed, mark the result as a test failure.
-                if self.cfg.get('retcode') != '0':
-                    self.multireport_failed = MultiReportFailure.TEST
-
-                # Collect the tests results and append them to our list.
-                job_data['test_results'] = self.__getjobresults()
-                report_jobs.append(job_data)
+                # Did the compile fail for this job?
+                # If yes, store the build log and skip to the next job since
+                # we didn't test anything in this job.
+                if target.get('buildlog'):
+                    self.multireport_failed = MultiReportFailure.BUILD
+                    kernel_arch = target.get('kernel_arch')
+                    # Get the errors first, the log path is replaced with the
+                    # attachment name.
+                    job_data['build_errors'] = self.__getbuilderrors(target)
+                    job_data['buildlog'] = self.__getbuildlog(target,
+                                                              kernel_arch)
+                    report_jobs.append(job_data)
+                    continue
+
+                # Did the tests run for this job? Only the first target is
+                # tested.
+                if index == 0 and target.get('runner') and \
+                        target.get('retcode'):
+                    # If the tests failed, mark the result as a test failure.
+                    if target.get('retcode') != '0':
+                        self.multireport_failed = MultiReportFailure.TEST
+
+                    # Collect the tests results and append them to our list.
+                    job_data['test_results'] = self.__getjobresults(target)
+                    report_jobs.append(job_data)
+                elif len(targets) > 1:
+                    # The other targets were only built, and passed.
+                    job_data['test_results'] = []
+                    report_jobs.append(job_data)
 
         # Render the report.
         report_text = template.render(
@@ -495,10 +541,11 @@ class Reporter(object):
             detail = "Build failed"
 
         # Kernel release should be same for all kernels built
-        if self.cfg.get("krelease"):
+        krelease_value = get_target_states(self.cfg)[0].get("krelease")
+        if krelease_value:
             repo_name = self._get_repo_name(self.cfg.get('baserepo'))
             krelease = " for kernel {} ({})".format(
-                self.cfg.get("krelease"),
+                krelease_value,
                 repo_name
             )
 
@@ -24,6 +24,7 @@ import xml.etree.ElementTree as etree
 from abc import ABCMeta, abstractmethod
 from defusedxml.ElementTree import fromstring
 
+from skt import accounting
 from skt.misc import SKT_SUCCESS, SKT_FAIL, SKT_ERROR
 from skt.misc import WaivingWrap
 
@@ -188,8 +189,9 @@ class BeakerRunner(Runner):
         """
         args = ["bkr", "job-results", "--prettyxml", taskspec]
 
-        bkr = subprocess.Popen(args, stdout=subprocess.PIPE)
-        (stdout, _) = bkr.communicate()
+        with accounting.account('bkr'):
+            bkr = accounting.popen(args, stdout=subprocess.PIPE)
+            (stdout, _) = bkr.communicate()
 
         # Write the Beaker results locally so they could be stored as an
         # artifact.
@@ -382,7 +384,8 @@ class BeakerRunner(Runner):
         logging.info('Cancelling pending jobs!')
 
         for job_id in set(self.job_to_recipe_set_map):
-            ret = subprocess.call(['bkr', 'job-cancel', job_id])
+            with accounting.account('bkr'):
+                ret = accounting.call(['bkr', 'job-cancel', job_id])
             if ret:
                 logging.info('Failed to cancel the remaining recipe sets!')
 
@@ -588,10 +591,10 @@ class BeakerRunner(Runner):
 
         args += ["-"]
 
-        bkr = subprocess.Popen(args, stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE)
-
-        (stdout, _) = bkr.communicate(xml)
+        with accounting.account('bkr'):
+            bkr = accounting.popen(args, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+            (stdout, _) = bkr.communicate(xml)
 
         for line in stdout.split("\n"):
             match = re.match(r"^Submitted: \['([^']+)'\]$", line)
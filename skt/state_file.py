@@ -15,6 +15,9 @@
 import ConfigParser
 import os
 
+# The prefix of the state keys of the targets of a build of several targets
+TARGET_KEY_PREFIX = "target."
+
 
 def get_state(state_file, state_key):
     """
@@ -74,3 +77,53 @@ def update_state(state_file, state_dict):
     # Write the update state file to disk.
     with open(state_file, 'w') as fileh:
         config.write(fileh)
+
+
+def get_target_key(name, key):
+    """
+    Get the state key to save a value of a target of a build of several
+    targets under. Target names can't contain dots, so the key can't be
+    mistaken for the one of another target, or for a key of the build.
+
+    Args:
+        name:   The target name.
+        key:    The key of the value in the state of the target.
+
+    Returns:
+        The key to save the value under.
+    """
+    return "{}{}.{}".format(TARGET_KEY_PREFIX, name, key)
+
+
+def get_target_states(state):
+    """
+    Split the state of a build of several targets into the state of each
+    target. The keys saved with get_target_key() lose the target prefix in
+    the state of that target, and are left out of the state of the other
+    ones.
+
+    Args:
+        state:  A dictionary of state, e.g. the skt configuration.
+
+    Returns:
+        A list of state dictionaries, one for each target listed in the
+        "build_targets" state, or a list of the state itself if the build was
+        not a build of several targets.
+    """
+    names = (state.get('build_targets') or '').split()
+    if not names:
+        return [state]
+
+    common = {key: val for (key, val) in state.items()
+              if not key.startswith(TARGET_KEY_PREFIX)}
+
+    target_states = [dict(common) for _ in names]
+    states_by_name = dict(zip(names, target_states))
+    for (key, val) in state.items():
+        if key.startswith(TARGET_KEY_PREFIX):
+            (name, _, target_key) = \
+                key[len(TARGET_KEY_PREFIX):].partition('.')
+            if name in states_by_name:
+                states_by_name[name][target_key] = val
+
+    return target_states
@@ -0,0 +1,335 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Class for sharing one kernel repository through a pool of worktrees."""
+import fcntl
+import json
+import logging
+import os
+import subprocess
+import time
+
+from skt import accounting
+from skt.misc import join_with_slash, get_ref_name, lock_repository
+
+
+class WorktreePool(object):
+    """
+    WorktreePool - a single bare kernel repository with a bounded set of git
+    worktrees, leased to pipelines so they share one object database and get
+    an already populated tree.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, path, max_trees=4, lease_timeout=24 * 60 * 60,
+                 wait_timeout=60 * 60, fetch_depth=None):
+        """
+        Initialize a WorktreePool.
+
+        Args:
+            path:           The directory to house the bare repository and
+                            the worktrees. It is created on the first lease.
+            max_trees:      Maximum number of worktrees kept in the pool.
+            lease_timeout:  Number of seconds after which a lease is
+                            considered stale and can be recovered.
+            wait_timeout:   Number of seconds to wait for a worktree to be
+                            returned when all of them are leased.
+            fetch_depth:    The amount of git history to fetch to start new
+                            worktrees at, or None to fetch all of it.
+        """
+        self.path = path
+        self.max_trees = max_trees
+        self.lease_timeout = lease_timeout
+        self.wait_timeout = wait_timeout
+        self.fetch_depth = fetch_depth
+        self.gdir = join_with_slash(self.path, "repo.git")
+        self.treedir = join_with_slash(self.path, "trees")
+        self.leasefile = join_with_slash(self.path, "leases.json")
+        self.lockfile = join_with_slash(self.path, "skt.lock")
+
+    def __git_cmd(self, *args):
+        """
+        Run a git command against the bare repository and return its output.
+
+        Args:
+            *args:  Git command arguments.
+
+        Returns:
+            Git command output.
+        """
+        cmd_args = ["git", "--git-dir", self.gdir] + list(args)
+
+        logging.debug("executing: %s", " ".join(cmd_args))
+        try:
+            with accounting.account('git'):
+                return accounting.check_output(
+                    cmd_args,
+                    env=dict(os.environ, **{'LC_ALL': 'C'}),
+                    stderr=subprocess.STDOUT
+                )
+        except subprocess.CalledProcessError as exc:
+            logging.debug(exc.output)
+            raise exc
+
+    def __load_leases(self):
+        """
+        Read the lease table.
+
+        Returns:
+            A dictionary of lease records keyed by worktree path.
+        """
+        if not os.path.isfile(self.leasefile):
+            return {}
+
+        with open(self.leasefile, 'r') as fileh:
+            return json.load(fileh)
+
+    def __save_leases(self, leases):
+        """
+        Write the lease table.
+
+        Args:
+            leases: A dictionary of lease records keyed by worktree path.
+        """
+        tmpfile = self.leasefile + ".tmp"
+        with open(tmpfile, 'w') as fileh:
+            json.dump(leases, fileh, indent=4, sort_keys=True)
+        os.rename(tmpfile, self.leasefile)
+
+    def __is_stale(self, tree, lease):
+        """
+        Check if a lease was abandoned by its owner.
+
+        Args:
+            tree:   The leased worktree path.
+            lease:  The lease record.
+
+        Returns:
+            True if the lease can be recovered, False otherwise.
+        """
+        # The owner link was removed or repointed, e.g. by a workdir cleanup.
+        if os.path.realpath(lease['owner']) != os.path.realpath(tree):
+            return True
+
+        return time.time() - lease['leased'] > self.lease_timeout
+
+    def __recover(self, leases):
+        """
+        Return stale leases to the pool and forget vanished worktrees.
+
+        Args:
+            leases: A dictionary of lease records keyed by worktree path.
+        """
+        for tree, lease in leases.items():
+            if not os.path.isdir(tree):
+                del leases[tree]
+            elif lease['owner'] and self.__is_stale(tree, lease):
+                logging.warning("recovering stale lease of %s by %s",
+                                tree, lease['owner'])
+                lease['owner'] = None
+
+        self.__git_cmd("worktree", "prune")
+
+    def __evict(self, leases, limit):
+        """
+        Remove the least recently used free worktrees until at most a given
+        number of worktrees is left.
+
+        Args:
+            leases: A dictionary of lease records keyed by worktree path.
+            limit:  The number of worktrees to keep.
+        """
+        free = sorted([tree for tree, lease in leases.items()
+                       if not lease['owner']],
+                      key=lambda tree: leases[tree]['used'])
+
+        while len(leases) > limit and free:
+            tree = free.pop(0)
+            logging.info("evicting worktree %s", tree)
+            self.__git_cmd("worktree", "remove", "--force", tree)
+            del leases[tree]
+
+    def __add_tree(self, leases, uri, ref):
+        """
+        Create a new worktree checked out at a remote reference.
+
+        Args:
+            leases: A dictionary of lease records keyed by worktree path.
+            uri:    The Git URI of the repository's origin remote.
+            ref:    The remote reference to check out.
+
+        Returns:
+            Path to the new worktree.
+        """
+        index = 0
+        while join_with_slash(self.treedir, str(index)) in leases:
+            index += 1
+        tree = join_with_slash(self.treedir, str(index))
+
+        # A worktree needs a commit to start from.
+        dstref = join_with_slash("refs", "remotes", "origin",
+                                 get_ref_name(ref))
+        git_fetch_args = ["fetch", "--no-tags", uri,
+                          "+%s:%s" % (ref, dstref)]
+        if self.fetch_depth:
+            # Worktrees already leased may be changing the shallow history
+            git_fetch_args.extend(['--depth', str(self.fetch_depth)])
+            with lock_repository(self.gdir):
+                self.__git_cmd(*git_fetch_args)
+        else:
+            self.__git_cmd(*git_fetch_args)
+
+        logging.info("adding worktree %s", tree)
+        self.__git_cmd("worktree", "add", "--detach", tree, dstref)
+        return tree
+
+    def __try_lease(self, owner, uri, ref):
+        """
+        Lease a worktree if one is available, while holding the pool lock.
+
+        Args:
+            owner:  The path which will link to the leased worktree.
+            uri:    The Git URI of the repository's origin remote.
+            ref:    The remote reference to start new worktrees at.
+
+        Returns:
+            The leased worktree path, or None if all worktrees are leased.
+        """
+        leases = self.__load_leases()
+        self.__recover(leases)
+
+        # Re-running a pipeline in the same workdir keeps its worktree.
+        for tree, lease in leases.items():
+            if lease['owner'] == owner:
+                lease['leased'] = time.time()
+                self.__save_leases(leases)
+                return tree
+
+        free = [tree for tree, lease in leases.items() if not lease['owner']]
+        if free:
+            # The most recently used tree is the warmest one.
+            tree = max(free, key=lambda tree: leases[tree]['used'])
+        elif len(leases) < self.max_trees:
+            tree = self.__add_tree(leases, uri, ref)
+        else:
+            self.__save_leases(leases)
+            return None
+
+        leases[tree] = {
+            'owner': owner,
+            'pid': os.getpid(),
+            'leased': time.time(),
+            'used': time.time(),
+        }
+        self.__evict(leases, self.max_trees)
+        self.__save_leases(leases)
+        return tree
+
+    def lease(self, owner, uri, ref="master"):
+        """
+        Lease a worktree and link it to the owner path. The lease lasts until
+        it is returned with release(), the owner link is removed or
+        repointed, or the lease times out.
+
+        Args:
+            owner:  The path to link to the leased worktree, usually the
+                    pipeline's work directory. It must not exist, or be a
+                    symbolic link.
+            uri:    The Git URI of the repository's origin remote.
+            ref:    The remote reference to start new worktrees at.
+
+        Returns:
+            The leased worktree path.
+
+        Raises:
+            WorktreePoolError if no worktree was returned in time, or the
+            owner path is in the way.
+        """
+        owner = os.path.abspath(owner)
+        if os.path.exists(owner) and not os.path.islink(owner):
+            raise WorktreePoolError(
+                "%s exists and is not a link to a worktree" % owner
+            )
+
+        try:
+            os.makedirs(self.treedir)
+        except OSError:
+            pass
+
+        deadline = time.time() + self.wait_timeout
+        while True:
+            with open(self.lockfile, 'a') as lockh:
+                fcntl.flock(lockh, fcntl.LOCK_EX)
+                try:
+                    if not os.path.isdir(self.gdir):
+                        self.__git_cmd("init", "--bare", "-q")
+                    tree = self.__try_lease(owner, uri, ref)
+                finally:
+                    fcntl.flock(lockh, fcntl.LOCK_UN)
+
+            if tree is not None:
+                break
+            if time.time() > deadline:
+                raise WorktreePoolError(
+                    "no worktree returned to %s in time" % self.path
+                )
+
+            logging.info("all %d worktrees are leased, waiting",
+                         self.max_trees)
+            time.sleep(10)
+
+        if os.path.islink(owner):
+            os.unlink(owner)
+        os.symlink(tree, owner)
+
+        logging.info("leased worktree %s to %s", tree, owner)
+        return tree
+
+    def release(self, tree):
+        """
+        Return a leased worktree to the pool. If the owner link is passed, it
+        is removed as well, as the worktree may be leased to another pipeline
+        right away.
+
+        Args:
+            tree:   The leased worktree path, or the owner link to it.
+        """
+        owner = None
+        if os.path.islink(tree):
+            owner = os.path.abspath(tree)
+        tree = os.path.realpath(tree)
+
+        with open(self.lockfile, 'a') as lockh:
+            fcntl.flock(lockh, fcntl.LOCK_EX)
+            try:
+                leases = self.__load_leases()
+                for path, lease in leases.items():
+                    if os.path.realpath(path) != tree:
+                        continue
+                    # Don't take a worktree away from its new owner
+                    if owner and lease['owner'] != owner:
+                        continue
+                    lease['owner'] = None
+                    lease['used'] = time.time()
+                    logging.info("returned worktree %s", path)
+                self.__evict(leases, self.max_trees)
+                self.__save_leases(leases)
+            finally:
+                fcntl.flock(lockh, fcntl.LOCK_UN)
+
+        if owner:
+            os.unlink(owner)
+
+
+class WorktreePoolError(Exception):
+    """Exception raised when a worktree can't be leased."""
@@ -13,6 +13,7 @@
 # Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Miscellaneous for tests."""
 import os
+import subprocess
 
 import mock
 from defusedxml.ElementTree import fromstring
@@ -43,6 +44,49 @@ def get_asset_content(filename):
         return asset.read()
 
 
+def make_source_repo(path):
+    """Create a git repository with a single commit on master."""
+    def git(*args):
+        """Run a git command in the source repository."""
+        subprocess.check_output(
+            ["git", "-C", path, "-c", "user.name=skt", "-c", "user.email=skt"]
+            + list(args)
+        )
+
+    os.mkdir(path)
+    git("init", "-q")
+    with open(os.path.join(path, "Makefile"), 'w') as fileh:
+        fileh.write("all:\n")
+    git("add", "Makefile")
+    git("commit", "-q", "-m", "Initial commit")
+    git("branch", "-M", "master")
+
+
+def make_patch(source, filename, content, name):
+    """
+    Create a patch writing a file on top of the source repository's master,
+    without changing master itself.
+
+    Returns:
+        Path to the patch.
+    """
+    def git(*args):
+        """Run a git command in the source repository."""
+        return subprocess.check_output(
+            ["git", "-C", source, "-c", "user.name=skt", "-c",
+             "user.email=skt"] + list(args)
+        )
+
+    git("checkout", "-q", "-b", name, "master")
+    with open(os.path.join(source, filename), 'w') as fileh:
+        fileh.write(content)
+    git("add", filename)
+    git("commit", "-q", "-m", "Patch " + name)
+    patch = git("format-patch", "-1", "-o", os.path.dirname(source), name)
+    git("checkout", "-q", "master")
+    return patch.strip()
+
+
 def fake_cancel_pending_jobs(sself):
     """Cancel pending job without calling 'bkr cancel'.
 
@@ -0,0 +1,103 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General Public
+# License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Test cases for accounting module."""
+import subprocess
+import sys
+import threading
+import unittest
+
+import mock
+
+from skt import accounting
+
+# A command using at least 256 MiB of memory
+LARGE_COMMAND = [sys.executable, '-c', 'x = " " * 256 * 1024 ** 2']
+
+
+class TestResourceAccounting(unittest.TestCase):
+    """Test cases for accounting.ResourceAccounting class."""
+
+    def test_categories(self):
+        """Ensure the usage of child processes is added up by category."""
+        resources = accounting.ResourceAccounting()
+        with resources.account('small'):
+            accounting.check_output(['true'])
+        with resources.account('small'):
+            accounting.check_call(['true'])
+        with resources.account('large'):
+            accounting.check_output(LARGE_COMMAND)
+
+        small = resources.categories['small']
+        large = resources.categories['large']
+        self.assertEqual(2, small['children'])
+        self.assertEqual(1, large['children'])
+        # The largest child doesn't hide the others
+        self.assertGreater(small['maxrss'], 0)
+        self.assertLess(small['maxrss'], 256 * 1024 ** 2)
+        self.assertGreaterEqual(large['maxrss'], 256 * 1024 ** 2)
+        self.assertGreater(large['user'] + large['sys'], 0)
+
+        state = resources.get_state('merge')
+        self.assertEqual('3', state['resources_merge_children'])
+        self.assertGreaterEqual(int(state['resources_merge_maxrss']),
+                                256 * 1024 ** 2)
+        self.assertRegexpMatches(
+            state['resources_merge_large'],
+            r'^children=1 wall=[0-9.]+ user=[0-9.]+ sys=[0-9.]+ '
+            r'maxrss=[0-9]+ read=[0-9]+ write=[0-9]+$'
+        )
+
+    def test_concurrent(self):
+        """Ensure children run concurrently are accounted separately."""
+        resources = accounting.ResourceAccounting()
+
+        def run(category, command):
+            """Run a command accounted to a category."""
+            with resources.account(category):
+                accounting.call(command)
+
+        threads = [threading.Thread(target=run, args=('large', LARGE_COMMAND)),
+                   threading.Thread(target=run, args=('small', ['true']))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLess(resources.categories['small']['maxrss'],
+                        256 * 1024 ** 2)
+        self.assertGreaterEqual(resources.categories['large']['maxrss'],
+                                256 * 1024 ** 2)
+
+    def test_child_process(self):
+        """Ensure real child processes are accounted, even if they fail."""
+        resources = accounting.ResourceAccounting()
+        with self.assertRaises(subprocess.CalledProcessError):
+            with resources.account('sh'):
+                accounting.check_output(['sh', '-c', 'exit 1'])
+
+        usage = resources.categories['sh']
+        self.assertEqual(1, usage['children'])
+        self.assertGreater(usage['wall'], 0)
+        self.assertGreater(usage['maxrss'], 0)
+        self.assertGreater(resources.get_totals()['maxrss'], 0)
+
+    @mock.patch('subprocess.Popen')
+    def test_substitute(self, mock_popen):
+        """Ensure substitutes for Popen are left alone."""
+        mock_popen.return_value.wait.return_value = 3
+        resources = accounting.ResourceAccounting()
+        with resources.account('sh'):
+            self.assertEqual(3, accounting.call(['sh']))
+
+        self.assertEqual(0, resources.categories['sh']['maxrss'])
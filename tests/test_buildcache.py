@@ -0,0 +1,54 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General Public
+# License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Test cases for buildcache module."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from skt.buildcache import BuildCache
+
+
+class BuildCacheTest(unittest.TestCase):
+    """Test cases for BuildCache class."""
+
+    def setUp(self):
+        """Create a temporary directory with an empty kernel configuration."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = "{}/config".format(self.tmpdir)
+        open(self.config, 'w').close()
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        shutil.rmtree(self.tmpdir)
+
+    def test_eviction(self):
+        """Ensure the least recently used builds are evicted first."""
+        build_cache = BuildCache(
+            "{}/cache".format(self.tmpdir), max_size=150
+        )
+        package = "{}/package.tar.gz".format(self.tmpdir)
+        with open(package, 'w') as fileh:
+            fileh.write("x" * 10)
+
+        for key in ['a', 'b']:
+            build_cache.store(key, package, self.config, '4.16.0')
+        # Make "a" the most recently used one
+        os.utime("{}/cache/b/entry.json".format(self.tmpdir), (0, 0))
+        self.assertEqual('4.16.0', build_cache.lookup('a')['krelease'])
+
+        build_cache.store('c', package, self.config, '4.16.0')
+        self.assertIsNotNone(build_cache.lookup('a'))
+        self.assertIsNone(build_cache.lookup('b'))
+        self.assertIsNotNone(build_cache.lookup('c'))
@@ -0,0 +1,145 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General Public
+# License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Test cases for buildslots module."""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from skt.buildslots import BuildSlots
+
+
+class TestBuildSlots(unittest.TestCase):
+    """Test cases for buildslots.BuildSlots class."""
+    def setUp(self):
+        """Create a build slot directory."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.poll = mock.patch.object(BuildSlots, 'POLL_INTERVAL', 0.01)
+        self.poll.start()
+
+    def tearDown(self):
+        """Remove the build slot directory."""
+        self.poll.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def wait_queued(self, count):
+        """Wait until a number of builds queue for slots."""
+        queue_dir = os.path.join(self.tmpdir, "queue")
+        for _ in range(500):
+            if len([name for name in os.listdir(queue_dir)
+                    if not name.startswith('.')]) == count:
+                return
+            time.sleep(0.01)
+        self.fail("builds didn't queue")
+
+    def test_fair_share(self):
+        """Ensure builds share the slots."""
+        slots = BuildSlots(self.tmpdir, 4, reserve=0)
+        with slots.acquire(8) as lease:
+            # A build alone gets as many slots as it wants
+            self.assertEqual(4, lease.jobs)
+
+        first = slots.acquire(2)
+        self.assertEqual(2, first.jobs)
+        # Other builds get an equal share at most
+        second = slots.acquire(8)
+        self.assertEqual(2, second.jobs)
+
+        # The next build waits for slots, and gets only its share
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(slots.acquire(8))
+        )
+        thread.start()
+        self.wait_queued(1)
+        first.release()
+        thread.join()
+        self.assertEqual(2, result[0].jobs)
+        self.assertEqual(2, len(os.listdir(os.path.join(self.tmpdir,
+                                                        "leases"))))
+
+        second.release()
+        result[0].release()
+        self.assertEqual([], os.listdir(os.path.join(self.tmpdir, "leases")))
+        self.assertEqual([], os.listdir(os.path.join(self.tmpdir, "queue")))
+
+    def test_staggered(self):
+        """Ensure a build started alone leaves slots for later builds."""
+        slots = BuildSlots(self.tmpdir, 8)
+        self.assertEqual(2, slots.reserve)
+        first = slots.acquire(8)
+        self.assertEqual(6, first.jobs)
+
+        # A later build starts right away with the reserved slots
+        second = slots.acquire(8)
+        self.assertEqual(2, second.jobs)
+
+        # And the next one waits for slots to become free
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(slots.acquire(8))
+        )
+        thread.start()
+        self.wait_queued(1)
+        second.release()
+        thread.join()
+        self.assertEqual(2, result[0].jobs)
+
+        first.release()
+        result[0].release()
+
+    def test_priority(self):
+        """Ensure builds with higher priority go first."""
+        slots = BuildSlots(self.tmpdir, 1)
+        lease = slots.acquire(1)
+        order = []
+
+        def build(name, priority):
+            """Hold the only slot for a moment."""
+            with slots.acquire(1, priority):
+                order.append(name)
+
+        threads = [threading.Thread(target=build, args=("low", 10))]
+        threads[0].start()
+        self.wait_queued(1)
+        threads.append(threading.Thread(target=build, args=("high", 90)))
+        threads[1].start()
+        self.wait_queued(2)
+
+        lease.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(["high", "low"], order)
+
+    def test_crashed_process(self):
+        """Ensure the slots of crashed processes are released."""
+        # pylint: disable=W0212
+        slots = BuildSlots(self.tmpdir, 2)
+        pid = os.fork()
+        if pid == 0:
+            slots.acquire(2)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        # The lease is left behind, but not locked anymore
+        self.assertEqual(1, len(os.listdir(os.path.join(self.tmpdir,
+                                                        "leases"))))
+        with slots.acquire(2) as lease:
+            self.assertEqual(2, lease.jobs)
+            self.assertEqual(1, len(os.listdir(os.path.join(self.tmpdir,
+                                                            "leases"))))
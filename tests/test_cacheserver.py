@@ -0,0 +1,75 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General Public
+# License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Test cases for cacheserver module."""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import requests
+
+from skt.cacheserver import CacheServer
+
+
+class TestCacheServer(unittest.TestCase):
+    """Test cases for cacheserver.CacheServer class."""
+    def setUp(self):
+        """Start a cache server on a free port."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = CacheServer(("127.0.0.1", 0), self.tmpdir)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = self.server.get_url()
+
+    def tearDown(self):
+        """Stop the cache server."""
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def test_objects(self):
+        """Ensure objects can be stored, retrieved and removed."""
+        url = self.url + "/ccache/ab/cdef0123"
+        self.assertEqual(404, requests.get(url).status_code)
+        self.assertEqual(404, requests.head(url).status_code)
+
+        self.assertEqual(201, requests.put(url, data="object").status_code)
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.tmpdir, "ccache", "ab", "cdef0123")
+        ))
+
+        response = requests.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("object", response.content)
+        response = requests.head(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("6", response.headers['Content-Length'])
+
+        # Objects are replaced as a whole
+        self.assertEqual(201, requests.put(url, data="other").status_code)
+        self.assertEqual("other", requests.get(url).content)
+
+        self.assertEqual(204, requests.delete(url).status_code)
+        self.assertEqual(404, requests.get(url).status_code)
+        self.assertEqual(404, requests.delete(url).status_code)
+
+    def test_invalid_key(self):
+        """Ensure keys can't point outside of the root directory."""
+        for path in ["/", "/a//b", "/%2e%2e/etc", "/a b"]:
+            self.assertEqual(400, requests.get(self.url + path).status_code)
+            self.assertEqual(
+                400, requests.put(self.url + path, data="x").status_code
+            )
@@ -14,13 +14,16 @@
 """Test cases for runner module."""
 import logging
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 from io import BytesIO
 from StringIO import StringIO
 
 import mock
+from mock import Mock
 
 from skt import executable
 
@@ -110,6 +113,39 @@ class TestExecutable(unittest.TestCase):
         )
         self.check_args_tester(args, expected_stderr=expected_stderr)
 
+    def test_check_args_ccache_remote(self):
+        """Test check_args() with a remote ccache but no local one."""
+        args = ['build', '--ccache-remote', 'http://localhost:8080']
+        expected_stderr = '--ccache-remote requires --ccache-dir to set'
+        self.check_args_tester(args, expected_stderr=expected_stderr)
+
+    def test_check_args_build_targets(self):
+        """Test check_args() with invalid build targets."""
+        args = ['build', '--target', 'x86_64', '--target', 'x86_64']
+        expected_stderr = 'build target names must be unique'
+        self.check_args_tester(args, expected_stderr=expected_stderr)
+
+        args = ['build', '--target', 'aarch64 compiler=gcc']
+        expected_stderr = 'Invalid build target setting: compiler=gcc'
+        self.check_args_tester(args, expected_stderr=expected_stderr)
+
+    def test_check_args_make_jobs(self):
+        """Test check_args() with an invalid number of make jobs."""
+        args = ['build', '--make-jobs', '0']
+        expected_stderr = "--make-jobs must be a positive number or 'auto'"
+        self.check_args_tester(args, expected_stderr=expected_stderr)
+
+    def test_check_args_all(self):
+        """Test check_args() checks the build options of "all" too."""
+        args = ['all', '-b', 'git://example.com/repo', '--make-jobs', 'x']
+        expected_stderr = "--make-jobs must be a positive number or 'auto'"
+        self.check_args_tester(args, expected_stderr=expected_stderr)
+
+        args = ['all', '-b', 'git://example.com/repo', '--target', 'x86_64',
+                '--target', 'x86_64']
+        expected_stderr = 'build target names must be unique'
+        self.check_args_tester(args, expected_stderr=expected_stderr)
+
     def test_check_args_stdio_mail(self):
         """Test check_args() with stdio and mail arguments."""
         args = ['report', '--reporter', 'stdio', '--mail-to',
@@ -290,6 +326,200 @@ class TestExecutable(unittest.TestCase):
         executable.cmd_publish(cfg)
         mock_publish.assert_called()
 
+    @mock.patch('skt.publisher.ScpPublisher.publish')
+    def test_cmd_publish_targets(self, mock_publish):
+        """Ensure cmd_publish() publishes the files of each target."""
+        cfg = {'publisher': ['scp', 'a', 'b'],
+               'build_targets': 'x86_64 arm',
+               'target.x86_64.buildconf': 'x86_64.config',
+               'target.x86_64.tarpkg': 'x86_64.tar.gz',
+               'target.arm.buildconf': 'arm.config',
+               'target.arm.buildlog': 'build-arm.log'}
+        mock_publish.side_effect = lambda source: 'http://example.com/' + \
+            source
+
+        executable.cmd_publish(cfg)
+        self.assertEqual('http://example.com/x86_64.tar.gz',
+                         cfg['target.x86_64.buildurl'])
+        self.assertEqual('http://example.com/x86_64.config',
+                         cfg['target.x86_64.cfgurl'])
+        self.assertEqual('http://example.com/arm.config',
+                         cfg['target.arm.cfgurl'])
+        self.assertNotIn('target.arm.buildurl', cfg)
+        self.assertNotIn('buildurl', cfg)
+
+    @mock.patch('atexit.register', Mock())
+    @mock.patch('signal.signal', Mock())
+    @mock.patch('skt.runner.getrunner')
+    def test_cmd_run_targets(self, mock_getrunner):
+        """Ensure cmd_run() tests the kernel of the first target."""
+        # pylint: disable=no-self-use
+        mock_getrunner.return_value.run.return_value = 0
+        mock_getrunner.return_value.job_to_recipe_set_map = {}
+        cfg = {'runner': ['beaker', {}],
+               'build_targets': 'x86_64 arm',
+               'target.x86_64.buildurl': 'http://example.com/x86_64.tar.gz',
+               'target.x86_64.krelease': '4.16.0',
+               'target.x86_64.kernel_arch': 'x86_64',
+               'target.arm.buildurl': 'http://example.com/arm.tar.gz',
+               'target.arm.kernel_arch': 'aarch64'}
+
+        executable.cmd_run(cfg)
+        mock_getrunner.return_value.run.assert_called_once_with(
+            'http://example.com/x86_64.tar.gz', None, '4.16.0', None,
+            arch='x86_64', waiving=None
+        )
+
+    @mock.patch('multiprocessing.cpu_count', Mock(return_value=8))
+    @mock.patch('skt.executable.get_build_jobs')
+    def test_get_make_jobs(self, mock_get_build_jobs):
+        """Ensure the number of make jobs is chosen as requested."""
+        self.assertEqual((4, {}), executable.get_make_jobs({}, 2))
+        self.assertEqual((6, {}),
+                         executable.get_make_jobs({'make_jobs': '6'}))
+
+        mock_get_build_jobs.return_value = {
+            'jobs': 5, 'cpus': 6, 'memory': 10 * 1024 ** 3, 'load': 1.25
+        }
+        (jobs, state) = executable.get_make_jobs(
+            {'make_jobs': 'auto', 'memory_per_job': 2048}, 2
+        )
+        mock_get_build_jobs.assert_called_with(2 * 1024 ** 3)
+        self.assertEqual(2, jobs)
+        self.assertEqual({'make_jobs_cpus': 6,
+                          'make_jobs_memory': 10 * 1024 ** 3,
+                          'make_jobs_load': '1.25'}, state)
+
+    def test_parse_build_target(self):
+        """Ensure parse_build_target() parses target settings."""
+        self.assertDictEqual(
+            {'arch': 'aarch64', 'name': 'arm', 'cross_compile': 'aarch64-',
+             'cfgtype': 'tinyconfig'},
+            executable.parse_build_target(
+                'aarch64 name=arm cross_compile=aarch64- cfgtype=tinyconfig'
+            )
+        )
+        self.assertDictEqual({'arch': 's390x', 'name': 's390x'},
+                             executable.parse_build_target('s390x'))
+        with self.assertRaises(ValueError):
+            executable.parse_build_target(' ')
+        # Names are part of state keys
+        for name in ['x86.64', 'X86_64']:
+            with self.assertRaises(ValueError):
+                executable.parse_build_target('x86_64 name=' + name)
+
+    @mock.patch('skt.executable.update_state')
+    @mock.patch('skt.executable.get_state', Mock(return_value='abcdef'))
+    @mock.patch('skt.executable.KernelBuilder')
+    def test_cmd_build_targets(self, mock_builder, mock_update_state):
+        """Ensure cmd_build() builds targets concurrently."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmpdir)
+
+        def create_builder(**kwargs):
+            """Create a builder mock producing a tarball."""
+            builder = Mock()
+            builder.build_arch = kwargs['build_arch']
+            builder.cross_compiler_prefix = kwargs['cross_compiler_prefix']
+            builder.source_dir = kwargs['source_dir']
+            builder.output_dir = kwargs['build_dir_root']
+            builder.ccache_stats = None
+            builder.build_lease = None
+            builder.timings = []
+            builder.jobs = kwargs['jobs']
+            builder.load_limit = None
+            builder.buildlog = kwargs['buildlog']
+            builder.assemble_make_options.return_value = ['make']
+            builder.getrelease.return_value = '4.16.0'
+            builder.get_cfgpath.return_value = "{}/{}.config".format(
+                tmpdir, kwargs['name']
+            )
+            with open(builder.get_cfgpath.return_value, 'w') as fileh:
+                fileh.write('CONFIG_X=y\n')
+            # The aarch64 tarball is compressed with zstd
+            tarball = "{}/{}.tar.{}".format(
+                tmpdir, kwargs['name'],
+                'zst' if kwargs['name'] == 'aarch64' else 'gz'
+            )
+            with open(tarball, 'w') as fileh:
+                fileh.write('Kernel data')
+            if kwargs['name'] == 's390x':
+                builder.compile_kernel.side_effect = \
+                    executable.ParsingError('Failed')
+            else:
+                builder.compile_kernel.return_value = tarball
+            return builder
+
+        mock_builder.side_effect = create_builder
+        args = {'rc': 'rc', 'workdir': tmpdir, 'make_target': 'targz-pkg',
+                'target': ['x86_64', 'aarch64 cross_compile=aarch64-',
+                           's390x']}
+
+        with mock.patch('logging.error'):
+            executable.cmd_build(args)
+        self.addCleanup(setattr, executable, 'retcode', 0)
+        self.assertEqual(executable.SKT_FAIL, executable.retcode)
+
+        self.assertEqual(3, mock_builder.call_count)
+        for call in mock_builder.call_args_list:
+            self.assertEqual(tmpdir + '-builds', call[1]['build_dir_root'])
+            self.assertGreaterEqual(call[1]['jobs'], 1)
+
+        details = mock_update_state.call_args_list[0][0][1]
+        self.assertEqual('x86_64 aarch64 s390x', details['build_targets'])
+        self.assertEqual('aarch64', details['target.aarch64.kernel_arch'])
+        self.assertEqual('aarch64-',
+                         details['target.aarch64.cross_compiler_prefix'])
+        self.assertNotIn('target.x86_64.cross_compiler_prefix', details)
+
+        results = mock_update_state.call_args_list[1][0][1]
+        self.assertEqual('abcdef-x86_64.tar.gz',
+                         results['target.x86_64.tarpkg'])
+        self.assertEqual('abcdef-aarch64.config',
+                         results['target.aarch64.buildconf'])
+        self.assertEqual('4.16.0', results['target.aarch64.krelease'])
+        self.assertEqual('abcdef-aarch64.tar.zst',
+                         results['target.aarch64.tarpkg'])
+        self.assertTrue(os.path.isfile('abcdef-aarch64.tar.zst'))
+        self.assertNotIn('target.s390x.tarpkg', results)
+        self.assertEqual("{}/build-s390x.log".format(tmpdir),
+                         results['target.s390x.buildlog'])
+
+    @mock.patch('skt.executable.update_state', Mock())
+    @mock.patch('skt.executable.KernelTree')
+    def test_cmd_merge_close_query(self, mock_ktree):
+        """Ensure cmd_merge() stops the commit query process on failure."""
+        ktree = mock_ktree.return_value
+        ktree.checkout.return_value = 'abcdef'
+        ktree.merge_git_ref.return_value = (1, 'abcdef')
+        args = {'rc': 'rc', 'baserepo': 'git://example.com/repo',
+                'workdir': 'workdir',
+                'merge_queue': [('merge_ref', 'git://example.com/other')]}
+
+        executable.cmd_merge(args)
+        self.addCleanup(setattr, executable, 'retcode', 0)
+        ktree.close_query.assert_called_once()
+
+    @mock.patch('skt.executable.WorktreePool')
+    def test_cmd_report_release(self, mock_pool):
+        """Ensure cmd_report() returns the leased worktree to its pool."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        workdir = "{}/workdir".format(tmpdir)
+        cfg = {'workdir': workdir, 'worktree_pool': tmpdir,
+               'worktree_pool_size': '2'}
+
+        # Nothing to return without a leased worktree
+        executable.cmd_report(cfg)
+        mock_pool.assert_not_called()
+
+        os.symlink(tmpdir, workdir)
+        executable.cmd_report(cfg)
+        mock_pool.assert_called_once_with(tmpdir, max_trees=2)
+        mock_pool.return_value.release.assert_called_once_with(workdir)
+
     def test_addtstamp(self):
         """Ensure addtstamp works."""
         testdata = {
@@ -320,3 +550,24 @@ class TestExecutable(unittest.TestCase):
         current_logger = logging.getLogger('executable')
         self.assertEqual(current_logger.getEffectiveLevel(), logging.WARNING -
                          (verbose * 10))
+
+    def test_group_patch_series(self):
+        """Ensure group_patch_series() groups consecutive patches only."""
+        merge_queue = [
+            ('pw', 'http://pw/1'),
+            ('merge_ref', 'http://example.com/repo.git'),
+            ('pw', 'http://pw/2'),
+            ('patch', '/tmp/3.patch'),
+            ('pw', 'http://pw/4'),
+            ('merge_ref', 'http://example.com/repo.git'),
+        ]
+        expected = [
+            ('pw', 'http://pw/1'),
+            ('merge_ref', 'http://example.com/repo.git'),
+            ('series', [('pw', 'http://pw/2'),
+                        ('patch', '/tmp/3.patch'),
+                        ('pw', 'http://pw/4')]),
+            ('merge_ref', 'http://example.com/repo.git'),
+        ]
+        self.assertEqual(expected,
+                         executable.group_patch_series(merge_queue))
@@ -14,6 +14,8 @@
 """Test cases for KernelBuilder class."""
 
 from __future__ import division
+import json
+import logging
 import unittest
 import tempfile
 import shutil
@@ -22,7 +24,11 @@ import subprocess
 import mock
 from mock import Mock
 
+from skt.buildcache import BuildCache
+from skt.buildlogindex import BuildLogIndex
+from skt.buildslots import BuildSlots
 import skt.kernelbuilder as kernelbuilder
+from skt.outputtee import OutputTee
 
 
 class KBuilderTest(unittest.TestCase):
@@ -205,12 +211,12 @@ class KBuilderTest(unittest.TestCase):
     @mock.patch("subprocess.check_call")
     def test_redhat_config_glob_failure(self, mock_check_call, mock_glob,
                                         mock_info, mock_err):
-        """Ensure that skt exits when no Red Hat config files match."""
+        """Ensure that the build fails when no Red Hat config files match."""
         # pylint: disable=W0212,E1101
         mock_check_call.return_value = ''
         mock_glob.return_value = []
         self.kbuilder.rh_configs_glob = "redhat/configs/kernel-*-x86_64.config"
-        with self.assertRaises(SystemExit):
+        with self.assertRaises(IOError):
             self.kbuilder._KernelBuilder__make_redhat_config('rh-configs')
 
         mock_info.assert_called_once()
@@ -264,6 +270,58 @@ class KBuilderTest(unittest.TestCase):
 
         self.assertEqual(test_tarball, fpath)
 
+    @mock.patch('skt.kernelbuilder.find_executable',
+                Mock(return_value='/usr/bin/zstd'))
+    def test_build_compressed_tarball(self):
+        """Ensure tarballs are compressed with the parallel compressor."""
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            make_target='targz-pkg',
+            jobs=8,
+            compression='zstd'
+        )
+        # An uncompressed tarball is built, still stripping modules
+        self.assertEqual(['INSTALL_MOD_STRIP=1', '-j8', 'tar-pkg'],
+                         kbuilder.compile_args)
+
+        test_tarball = "{}/linux-4.16.0.tar".format(kbuilder.source_dir)
+        with open(test_tarball, 'w') as fileh:
+            fileh.write("Kernel data")
+        with open(kbuilder.buildlog, 'w') as fileh:
+            fileh.write('Tarball successfully created in ./linux-4.16.0.tar\n')
+
+        with self.m_multipipe as m_multipipe:
+            fpath = kbuilder.compile_kernel()
+
+        self.assertEqual(test_tarball + ".zst", fpath)
+        self.assertEqual(
+            mock.call(["zstd", "-T8", "-q", "-f", "--rm", test_tarball]),
+            m_multipipe.mock_calls[-1]
+        )
+        self.assertIn('compress', dict(kbuilder.timings))
+
+        # A failing compressor fails the build
+        with self.m_multipipe as m_multipipe:
+            m_multipipe.side_effect = lambda args, **_: int(args[0] == "zstd")
+            with self.assertRaises(subprocess.CalledProcessError):
+                kbuilder.compile_kernel()
+
+    @mock.patch('logging.warning')
+    @mock.patch('skt.kernelbuilder.find_executable', Mock(return_value=None))
+    def test_compressor_missing(self, mock_logging):
+        """Ensure a missing compressor falls back to gzip."""
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            make_target='targz-pkg',
+            compression='pigz'
+        )
+        self.assertEqual('gzip', kbuilder.compression)
+        self.assertIsNone(kbuilder.compressor)
+        self.assertEqual('targz-pkg', kbuilder.compile_args[-1])
+        mock_logging.assert_called_once()
+
     def test_build_rpm(self):
         """Test the building and handling of RPMs."""
         kbuilder = kernelbuilder.KernelBuilder(
@@ -298,12 +356,12 @@ class KBuilderTest(unittest.TestCase):
                 fileh.write("Kernel data")
 
         # Ensure compile_kernel can handle an existing repo directory.
-        os.mkdir("{}/rpm_repo".format(kbuilder.source_dir))
+        os.mkdir("{}/rpm_repo".format(kbuilder.output_dir))
 
         with self.m_multipipe:
             fpath = kbuilder.compile_kernel()
 
-        self.assertEqual("{}/rpm_repo/".format(kbuilder.source_dir), fpath)
+        self.assertEqual("{}/rpm_repo/".format(kbuilder.output_dir), fpath)
 
     def test_bad_make_target(self):
         """Test what happens when an unsupported make target is used."""
@@ -328,6 +386,482 @@ class KBuilderTest(unittest.TestCase):
             with self.assertRaises(kernelbuilder.CommandTimeoutError):
                 self.kbuilder.compile_kernel()
 
+    @mock.patch('skt.kernelbuilder.find_executable',
+                Mock(return_value='/usr/bin/ccache'))
+    def test_ccache_make_options(self):
+        """Ensure ccache wraps the default and user-provided compilers."""
+        with mock.patch.dict(os.environ,
+                             {'CROSS_COMPILE': 'aarch64-linux-gnu-'}):
+            kbuilder = kernelbuilder.KernelBuilder(
+                self.tmpdir,
+                self.tmpconfig.name,
+                make_target='targz-pkg',
+                ccache_dir='/cache'
+            )
+        make_opts = kbuilder.assemble_make_options()
+        self.assertIn('CC=ccache aarch64-linux-gnu-gcc', make_opts)
+        self.assertIn('HOSTCC=ccache gcc', make_opts)
+        self.assertEqual(
+            '/cache/{}'.format(kbuilder.build_arch), kbuilder.ccache_dir
+        )
+
+        kbuilder.extra_make_args = ['CC=clang', 'V=1']
+        make_opts = kbuilder.assemble_make_options()
+        self.assertIn('CC=ccache clang', make_opts)
+        self.assertNotIn('CC=clang', make_opts)
+        self.assertIn('V=1', make_opts)
+
+    @mock.patch('logging.warning')
+    @mock.patch('skt.kernelbuilder.find_executable', Mock(return_value=None))
+    def test_ccache_missing(self, mock_logging):
+        """Ensure a missing ccache doesn't change the build."""
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            make_target='targz-pkg',
+            ccache_dir='/cache'
+        )
+        self.assertIsNone(kbuilder.ccache_dir)
+        self.assertNotIn('HOSTCC=ccache gcc', kbuilder.assemble_make_options())
+        mock_logging.assert_called_once()
+
+    @mock.patch('skt.accounting.check_output')
+    @mock.patch('skt.kernelbuilder.find_executable',
+                Mock(return_value='/usr/bin/ccache'))
+    def test_ccache_stats(self, mock_check_output):
+        """Ensure compile_kernel() counts the ccache hits of the build."""
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            make_target='targz-pkg',
+            ccache_dir='/cache',
+            ccache_size='5G'
+        )
+        mock_check_output.side_effect = [
+            "direct_cache_hit\t10\npreprocessed_cache_hit\t2\n"
+            "cache_miss\t7\n",
+            "direct_cache_hit\t40\npreprocessed_cache_hit\t2\n"
+            "cache_miss\t9\nstats_updated_timestamp\t1\n",
+        ]
+
+        with self.m_multipipe as m_multipipe:
+            m_multipipe.return_value = 1
+            with self.assertRaises(subprocess.CalledProcessError):
+                kbuilder.compile_kernel()
+
+        self.assertTupleEqual((30, 2, 0), kbuilder.ccache_stats)
+        env = m_multipipe.call_args_list[-1][1]['env']
+        self.assertEqual(kbuilder.ccache_dir, env['CCACHE_DIR'])
+        self.assertEqual('5G', env['CCACHE_MAXSIZE'])
+
+    def test_build_cache(self):
+        """Ensure identical builds are restored from the build cache."""
+        for args in [["init", "-q"],
+                     ["commit", "-q", "--allow-empty", "-m", "Initial"]]:
+            subprocess.check_output(["git", "-C", self.tmpdir, "-c",
+                                     "user.name=skt", "-c",
+                                     "user.email=skt"] + args)
+        build_cache = BuildCache(
+            "{}/cache".format(self.tmpdir)
+        )
+        test_tarball = "{}/{}".format(self.tmpdir, self.kernel_tarball)
+
+        def build():
+            """Build with a fresh builder and the same configuration."""
+            kbuilder = kernelbuilder.KernelBuilder(
+                self.tmpdir,
+                self.tmpconfig.name,
+                make_target='targz-pkg',
+                build_cache=build_cache
+            )
+            with open(kbuilder.get_cfgpath(), 'w') as fileh:
+                fileh.write("CONFIG_TEST=y\n")
+            with open(kbuilder.buildlog, 'w') as fileh:
+                fileh.write(self.success_str)
+            with self.m_multipipe as m_multipipe:
+                m_multipipe.reset_mock()
+                fpath = kbuilder.compile_kernel()
+            compiled = any(call[0][0][0] == 'timeout'
+                           for call in m_multipipe.call_args_list)
+            return kbuilder, fpath, compiled
+
+        with open(test_tarball, 'w') as fileh:
+            fileh.write("Kernel data")
+        with mock.patch.object(kernelbuilder.KernelBuilder, 'getrelease',
+                               Mock(return_value='4.16.0')):
+            (kbuilder, fpath, compiled) = build()
+        self.assertTrue(compiled)
+        self.assertFalse(kbuilder.build_cache_hit)
+
+        # The tarball is gone, like after it was published
+        os.unlink(test_tarball)
+        (kbuilder, fpath, compiled) = build()
+        self.assertFalse(compiled)
+        self.assertTrue(kbuilder.build_cache_hit)
+        self.assertEqual(test_tarball, fpath)
+        with open(fpath) as fileh:
+            self.assertEqual("Kernel data", fileh.read())
+        self.assertEqual('4.16.0', kbuilder.getrelease())
+
+    def test_build_dir(self):
+        """Ensure out-of-tree build directories follow the build inputs."""
+        build_dir_root = "{}/builds".format(self.tmpdir)
+
+        def make_builder(basecfg):
+            """Create a builder building out of tree."""
+            return kernelbuilder.KernelBuilder(
+                self.tmpdir,
+                basecfg,
+                make_target='targz-pkg',
+                build_dir_root=build_dir_root
+            )
+
+        kbuilder = make_builder(self.tmpconfig.name)
+        build_dir = kbuilder.output_dir
+        self.assertTrue(build_dir.startswith(build_dir_root + "/"))
+        self.assertTrue(os.path.isdir(build_dir))
+        self.assertIn("O={}".format(build_dir), kbuilder.make_argv_base)
+        self.assertEqual("{}/.config".format(build_dir),
+                         kbuilder.get_cfgpath())
+
+        # The tarball is looked for in the build directory
+        with open(kbuilder.buildlog, 'w') as fileh:
+            fileh.write(self.success_str)
+        self.assertEqual(
+            "{}/{}".format(os.path.realpath(build_dir), self.kernel_tarball),
+            kbuilder.find_tarball()
+        )
+
+        # The same inputs get the same directory once it is unlocked
+        del kbuilder
+        self.assertEqual(build_dir,
+                         make_builder(self.tmpconfig.name).output_dir)
+
+        # Another configuration gets another directory, and the least
+        # recently used directories are removed
+        os.utime(build_dir, (0, 0))
+        for index in range(kernelbuilder.KernelBuilder.BUILD_DIRS):
+            config = "{}/config{}".format(self.tmpdir, index)
+            with open(config, 'w') as fileh:
+                fileh.write("CONFIG_{}=y\n".format(index))
+            self.assertNotEqual(build_dir, make_builder(config).output_dir)
+
+        self.assertFalse(os.path.isdir(build_dir))
+        self.assertEqual(
+            kernelbuilder.KernelBuilder.BUILD_DIRS,
+            len([name for name in os.listdir(build_dir_root)
+                 if os.path.isdir(os.path.join(build_dir_root, name))])
+        )
+
+    def test_build_target(self):
+        """Ensure builders for other targets don't rely on the environment."""
+        buildlog = "{}/build-arm.log".format(self.tmpdir)
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            make_target='targz-pkg',
+            build_arch='aarch64',
+            cross_compiler_prefix='aarch64-linux-gnu-',
+            jobs=3,
+            buildlog=buildlog,
+            name='arm'
+        )
+        make_opts = kbuilder.assemble_make_options()
+        self.assertIn('ARCH=arm64', make_opts)
+        self.assertIn('CROSS_COMPILE=aarch64-linux-gnu-', make_opts)
+        self.assertIn('-j3', make_opts)
+        self.assertEqual('aarch64', kbuilder.build_arch)
+
+        # The output goes to the builder's own log
+        logger = logging.getLogger('multipipe.arm')
+        logger.setLevel(logging.INFO)
+        self.addCleanup(logger.setLevel, logging.NOTSET)
+        with mock.patch('sys.stdout'):
+            self.assertEqual(0, kbuilder.run_multipipe(['echo', 'arm']))
+        with open(buildlog) as fileh:
+            self.assertIn('arm\n', fileh.read())
+        self.assertFalse(os.path.exists(self.kbuilder.buildlog))
+
+    def test_load_limit(self):
+        """Ensure a load limit is passed to make."""
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            make_target='targz-pkg',
+            load_limit=6.5
+        )
+        self.assertIn('-l6.5', kbuilder.assemble_make_options())
+        self.assertNotIn('-l6.5', self.kbuilder.assemble_make_options())
+
+    def test_build_slots(self):
+        """Ensure make runs as many jobs as build slots leased."""
+        slots = BuildSlots(self.tmpdir + '/slots', 2)
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            make_target='targz-pkg',
+            jobs=8,
+            build_slots=slots
+        )
+        with open(kbuilder.buildlog, 'w') as fileh:
+            fileh.write(self.success_str)
+        with open(os.path.join(self.tmpdir, self.kernel_tarball), 'w'):
+            pass
+
+        with self.m_multipipe as m_multipipe:
+            kbuilder.compile_kernel()
+        argv = m_multipipe.call_args[0][0]
+        self.assertIn('-j2', argv)
+        self.assertNotIn('-j8', argv)
+        self.assertEqual(2, kbuilder.build_lease[0])
+
+        # The slots are released after the build
+        with slots.acquire(2) as lease:
+            self.assertEqual(2, lease.jobs)
+
+    def test_get_build_jobs(self):
+        """Ensure the number of jobs fits the cgroup limits and the load."""
+        proc_cgroup = os.path.join(self.tmpdir, 'cgroup')
+        with open(proc_cgroup, 'w') as fileh:
+            fileh.write("1:name=systemd:/ci/job\n0::/ci/job\n")
+        root = os.path.join(self.tmpdir, 'sys')
+        cgroup_dirs = kernelbuilder.get_cgroup_dirs(proc_cgroup, root)
+        self.assertEqual([os.path.join(root, 'ci', 'job'),
+                          os.path.join(root, 'ci'), root], cgroup_dirs)
+        os.makedirs(cgroup_dirs[0])
+
+        def write(name, content):
+            """Write a cgroup interface file."""
+            with open(os.path.join(root, name), 'w') as fileh:
+                fileh.write(content)
+
+        # The strictest limit of all ancestors applies
+        write('ci/job/cpu.max', 'max 100000\n')
+        write('ci/cpu.max', '250000 100000\n')
+        write('ci/job/memory.max', '8589934592\n')
+        write('ci/job/memory.current', '1073741824\n')
+        write('ci/memory.max', 'max\n')
+
+        with mock.patch('multiprocessing.cpu_count', Mock(return_value=16)):
+            self.assertEqual(3, kernelbuilder.get_cpu_limit(cgroup_dirs))
+            self.assertEqual(16, kernelbuilder.get_cpu_limit([]))
+            self.assertEqual(
+                7 * 1024 ** 3,
+                kernelbuilder.get_memory_limit(
+                    cgroup_dirs, os.path.join(self.tmpdir, 'meminfo')
+                )
+            )
+
+            with mock.patch('os.getloadavg',
+                            Mock(return_value=(1.5, 1.0, 1.0))), \
+                    mock.patch('skt.kernelbuilder.get_memory_limit',
+                               Mock(return_value=7 * 1024 ** 3)):
+                limits = kernelbuilder.get_build_jobs(cgroup_dirs=cgroup_dirs)
+                self.assertEqual(3, limits['jobs'])
+                # Memory limits the jobs
+                limits = kernelbuilder.get_build_jobs(3 * 1024 ** 3,
+                                                      cgroup_dirs)
+                self.assertEqual(2, limits['jobs'])
+
+            # Busy CPUs are left alone, but a job always runs
+            with mock.patch('os.getloadavg',
+                            Mock(return_value=(15.0, 1.0, 1.0))):
+                limits = kernelbuilder.get_build_jobs(cgroup_dirs=cgroup_dirs)
+                self.assertEqual(1, limits['jobs'])
+                self.assertEqual(3, limits['cpus'])
+                self.assertEqual(15.0, limits['load'])
+
+        # Processes outside of a cgroup v2 hierarchy have no limits
+        with open(proc_cgroup, 'w') as fileh:
+            fileh.write("1:name=systemd:/\n")
+        self.assertEqual([], kernelbuilder.get_cgroup_dirs(proc_cgroup, root))
+
+    def test_run_multipipe_output(self):
+        """Ensure command output is copied exactly, and shown as selected."""
+        logger = logging.getLogger('multipipe')
+        logger.setLevel(logging.INFO)
+        self.addCleanup(logger.setLevel, logging.NOTSET)
+        output = "  indented\n\tbinary \xff\nlast"
+        outfile = os.path.join(self.tmpdir, 'output')
+        with open(outfile, 'wb') as fileh:
+            fileh.write(output)
+        header = "$ cat {}\n".format(outfile)
+
+        for (mode, expected_stdout) in [
+                ('full', header + output + "\n"),
+                ('throttle', "[1 lines] {}[3 lines] \tbinary \xff\n"
+                 "[3 lines, see {}]\n{}{}\n".format(
+                     header, self.kbuilder.buildlog, header, output
+                 )),
+                ('summary', "[3 lines, see {}]\n{}{}\n".format(
+                    self.kbuilder.buildlog, header, output
+                ))]:
+            self.kbuilder.output = mode
+            with open(self.kbuilder.buildlog, 'w'):
+                pass
+            with mock.patch('sys.stdout') as mock_stdout, \
+                    mock.patch.object(OutputTee, 'THROTTLE_INTERVAL', 0):
+                self.assertEqual(0,
+                                 self.kbuilder.run_multipipe(['cat', outfile]))
+            stdout = "".join(call[0][0]
+                             for call in mock_stdout.write.call_args_list)
+            self.assertEqual(expected_stdout, stdout)
+            with open(self.kbuilder.buildlog, 'rb') as fileh:
+                self.assertEqual(header + output, fileh.read())
+
+        # Nothing is shown if the logger isn't enabled
+        logger.setLevel(logging.WARNING)
+        with mock.patch('sys.stdout') as mock_stdout:
+            self.kbuilder.run_multipipe(['cat', outfile])
+        mock_stdout.write.assert_not_called()
+
+    def test_build_log_index(self):
+        """Ensure markers are indexed as the output is written to the log."""
+        outfile = os.path.join(self.tmpdir, 'output')
+        with open(outfile, 'w') as fileh:
+            fileh.write("  CC      kernel/fork.o\n"
+                        "kernel/fork.c:10:2: warning: unused variable 'x'\n"
+                        "kernel/exit.c:20: error: expected ';'\n"
+                        "ld: vmlinux.o: in function `start':\n"
+                        "init/main.c:(.text+0x1c): undefined reference to "
+                        "`foo'\n"
+                        "aarch64-linux-gnu-ld: warning: orphan section\n"
+                        "ERROR: modpost: \"bar\" [drivers/x.ko] undefined!\n"
+                        "  LD      vmlinux\n"
+                        "Wrote: /tmp/kernel-4.16.0.x86_64.rpm\n"
+                        "Tarball successfully created in ./linux.tar.gz\n")
+        with mock.patch('sys.stdout'):
+            self.kbuilder.run_multipipe(['cat', outfile])
+            self.kbuilder.run_multipipe(['false'])
+
+        with open(self.kbuilder.buildlog + '.index') as fileh:
+            data = json.load(fileh)
+        self.assertEqual(os.path.getsize(self.kbuilder.buildlog),
+                         data['size'])
+        self.assertEqual(['./linux.tar.gz'], data['tarballs'])
+        self.assertEqual(['/tmp/kernel-4.16.0.x86_64.rpm'], data['rpms'])
+        self.assertEqual({'error': 3, 'warning': 2}, data['counts'])
+        self.assertEqual(
+            [('cc', 'warning', 'kernel/fork.c', 10,
+              "unused variable 'x'"),
+             ('cc', 'error', 'kernel/exit.c', 20, "expected ';'"),
+             ('ld', 'error', 'init/main.c', None,
+              "undefined reference to `foo'"),
+             ('ld', 'warning', None, None, "orphan section"),
+             ('modpost', 'error', 'drivers/x.ko', None,
+              '"bar" [drivers/x.ko] undefined!')],
+            [(diagnostic['tool'], diagnostic['severity'], diagnostic['file'],
+              diagnostic['line'], diagnostic['message'])
+             for diagnostic in data['diagnostics']]
+        )
+        with open(self.kbuilder.buildlog) as fileh:
+            fileh.seek(data['diagnostics'][1]['offset'])
+            self.assertEqual("kernel/exit.c:20: error: expected ';'\n",
+                             fileh.readline())
+        self.assertEqual([0, 1], [phase['returncode']
+                                  for phase in data['phases']])
+        self.assertEqual("cat " + outfile, data['phases'][0]['command'])
+        self.assertEqual(['vmlinux'], data['phases'][0]['milestones'].keys())
+        self.assertGreaterEqual(data['phases'][0]['seconds'],
+                                data['phases'][0]['milestones']['vmlinux'])
+
+        self.assertEqual(
+            os.path.realpath(os.path.join(self.tmpdir, 'linux.tar.gz')),
+            self.kbuilder.find_tarball()
+        )
+
+        # Output written to the log by others is indexed too
+        with open(self.kbuilder.buildlog, 'a') as fileh:
+            fileh.write("Wrote: /tmp/kernel-devel.rpm\n")
+        self.assertEqual(['/tmp/kernel-4.16.0.x86_64.rpm',
+                          '/tmp/kernel-devel.rpm'],
+                         BuildLogIndex.load(
+                             self.kbuilder.buildlog
+                         ).rpms)
+
+        # A truncated log is indexed again
+        with open(self.kbuilder.buildlog, 'w') as fileh:
+            fileh.write("Tarball successfully created in ./other.tar.gz\n")
+        self.assertEqual(['./other.tar.gz'],
+                         BuildLogIndex.load(
+                             self.kbuilder.buildlog
+                         ).tarballs)
+
+    def test_object_timing(self):
+        """Ensure the compilation of each object can be timed."""
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            make_target='targz-pkg',
+            cross_compiler_prefix='aarch64-linux-gnu-',
+            object_timing=True
+        )
+        make_opts = kbuilder.assemble_make_options()
+        self.assertIn(
+            'CC=sh {} aarch64-linux-gnu-gcc'.format(kernelbuilder.CC_TIMER),
+            make_opts
+        )
+        self.assertFalse([opt for opt in make_opts
+                          if opt.startswith('HOSTCC=')])
+
+        kbuilder.ccache_dir = '/cache'
+        make_opts = kbuilder.assemble_make_options()
+        self.assertIn(
+            'CC=sh {} ccache aarch64-linux-gnu-gcc'.format(
+                kernelbuilder.CC_TIMER
+            ),
+            make_opts
+        )
+        self.assertIn('HOSTCC=ccache gcc', make_opts)
+
+        # The wrapper records the objects written and passes the exit code
+        env = dict(os.environ, SKT_CC_TIMES=kbuilder.buildlog + '.objects')
+        for (obj, command) in [('kernel/fork.o', 'true'),
+                               ('kernel/exit.o', 'true'),
+                               ('kernel/fork.o', 'true')]:
+            subprocess.check_call(['sh', kernelbuilder.CC_TIMER, command,
+                                   '-c', 'x.c', '-o', obj], env=env)
+        self.assertEqual(1, subprocess.call(
+            ['sh', kernelbuilder.CC_TIMER, 'false', '-o', 'kernel/pid.o'],
+            env=env
+        ))
+        subprocess.check_call(['sh', kernelbuilder.CC_TIMER, 'true',
+                               '-o', '/dev/null'], env=env)
+        timings = kbuilder.get_object_timings()
+        self.assertEqual(['kernel/exit.o', 'kernel/fork.o', 'kernel/pid.o'],
+                         sorted(obj for (obj, _) in timings))
+        self.assertEqual(sorted([seconds for (_, seconds) in timings],
+                                reverse=True),
+                         [seconds for (_, seconds) in timings])
+
+    def test_build_timing(self):
+        """Ensure the phases of the build are timed."""
+        with open(self.kbuilder.buildlog, 'w') as fileh:
+            fileh.write(self.success_str)
+        with open(os.path.join(self.tmpdir, self.kernel_tarball), 'w'):
+            pass
+
+        with self.m_multipipe:
+            self.kbuilder.compile_kernel()
+        self.assertEqual(['config', 'build'],
+                         [phase for (phase, _) in self.kbuilder.timings])
+
+        with open(self.kbuilder.timing_path) as fileh:
+            data = json.load(fileh)
+        self.assertEqual(['config', 'build'],
+                         [phase['phase'] for phase in data['phases']])
+        self.assertEqual([], data['objects'])
+
+        # Failed builds are timed too
+        with self.m_multipipe as m_multipipe:
+            m_multipipe.return_value = 2
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.kbuilder.compile_kernel()
+        with open(self.kbuilder.timing_path) as fileh:
+            self.assertEqual(['config', 'build'],
+                             [phase['phase']
+                              for phase in json.load(fileh)['phases']])
+
     def test_reset_buildlog(self):
         """Test resetting the buildlog when it is present."""
         # pylint: disable=W0212,E1101
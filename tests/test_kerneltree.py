@@ -22,7 +22,12 @@ import subprocess
 import mock
 from mock import Mock
 
-from skt.kerneltree import KernelTree
+from skt import accounting
+from skt.kerneltree import GitVersionError, KernelTree, \
+    PatchApplicationError
+from skt.patchcache import PatchCache
+from skt.referencerepo import ReferenceRepository
+from tests.misc import make_patch, make_source_repo
 
 
 def make_process_exception(*args, **kwargs):
@@ -102,77 +107,70 @@ class KernelTreeTest(unittest.TestCase):
         result = self.kerneltree.getpath()
         self.assertEqual(result, self.tmpdir)
 
-    @mock.patch('subprocess.check_output')
-    def test_get_commit_date(self, mock_check_output):
+    @mock.patch('skt.kerneltree.KernelTree.get_commits_metadata')
+    def test_get_commit_date(self, mock_metadata):
         """Ensure that get_commit_date() returns an integer date."""
-        # Mock up an integer response that would normally come from the
-        # 'git show' command
-        mock_check_output.return_value = "100"
+        mock_metadata.return_value = [{'hash': 'abcdef', 'date': 100,
+                                       'subject': 'Subject'}]
 
         # Test it with a ref
         result = self.kerneltree.get_commit_date(ref='master')
-        call_args = mock_check_output.call_args_list[0][0]
-        self.assertIn('master', call_args[0])
-        mock_check_output.reset_mock()
+        mock_metadata.assert_called_once_with(['master'])
+        mock_metadata.reset_mock()
 
         self.assertEqual(result, 100)
 
         # Test it without a ref
         result = self.kerneltree.get_commit_date()
-        call_args = mock_check_output.call_args_list[0][0]
-        self.assertNotIn('master', call_args[0])
+        mock_metadata.assert_called_once_with([None])
 
         self.assertEqual(result, 100)
 
-    @mock.patch('subprocess.check_output')
-    def test_get_commit_hash(self, mock_check_output):
+    @mock.patch('skt.kerneltree.KernelTree.get_commits_metadata')
+    def test_get_commit_hash(self, mock_metadata):
         """Ensure get_commit_hash() returns a git commit hash."""
-        mock_check_output.return_value = "abcdef"
+        mock_metadata.return_value = [{'hash': 'abcdef', 'date': 100,
+                                       'subject': 'Subject'}]
 
-        with self.popen_good:
-            result = self.kerneltree.get_commit_hash(ref='master')
+        result = self.kerneltree.get_commit_hash(ref='master')
 
+        mock_metadata.assert_called_once_with(['master'])
         self.assertEqual(result, 'abcdef')
 
-    def test_get_remote_url(self):
-        """Ensure __get_remote_url() returns a fetch url."""
+    def test_get_remote_name(self):
+        """
+        Ensure __get_remote_name() resolves configured remotes and derives
+        deterministic names for new ones.
+        """
         # pylint: disable=W0212,E1101
-        expected_stdout = "Fetch URL: http://example.com/"
-        self.m_popen_good.communicate = Mock(
-            return_value=(expected_stdout, None)
-        )
+        get_remote_name = self.kerneltree._KernelTree__get_remote_name
 
-        with self.popen_good:
-            result = self.kerneltree._KernelTree__get_remote_url('origin')
+        self.assertEqual('origin', get_remote_name(self.kerneltree.uri))
 
-        self.assertEqual(result, 'http://example.com/')
+        name = get_remote_name("http://example.com/")
+        self.assertTrue(name.startswith('example.com-'))
+        self.assertEqual(name, get_remote_name("http://example.com/"))
+        self.assertNotEqual(name, get_remote_name("https://example.com/"))
 
-    @mock.patch('logging.warning')
-    def test_get_remote_name(self, mock_logging):
-        """
-        Ensure __get_remote_name() handles remote names
-        from __get_remote_url().
-        """
-        # If get_remote_url keeps returning the same value, then
-        # get_remote_name() will keep adding underscores forever and this test
-        # would never pass.
+    @mock.patch('skt.accounting.check_output')
+    def test_get_remotes(self, mock_check_output):
+        """Ensure __get_remotes() reads the configuration only once."""
         # pylint: disable=W0212,E1101
-        mocked_get_remote_url = mock.patch(
-            'skt.kerneltree.KernelTree._KernelTree__get_remote_url',
-            side_effect=['http://example.com/', "http://example2.com"]
+        mock_check_output.return_value = (
+            "remote.origin.url\nhttp://example.com/a.git\0"
+            "remote.b-1234.url\nhttp://example.com/b.git\0"
         )
+        expected = {
+            'http://example.com/a.git': 'origin',
+            'http://example.com/b.git': 'b-1234',
+        }
 
-        with mocked_get_remote_url:
-            result = self.kerneltree._KernelTree__get_remote_name(
-                "http://example.com/"
-            )
-
-        self.assertEqual('example.com_', result)
-
-        mock_logging.assert_called_once()
+        self.assertEqual(expected, self.kerneltree._KernelTree__get_remotes())
+        self.assertEqual(expected, self.kerneltree._KernelTree__get_remotes())
+        mock_check_output.assert_called_once()
 
     @mock.patch('logging.debug')
-    @mock.patch('subprocess.check_output')
+    @mock.patch('skt.accounting.check_output')
     def test_git_cmd(self, mock_check_output, mock_logging):
         """Ensure __git_cmd() works."""
         # pylint: disable=W0212,E1101
@@ -185,27 +183,32 @@ class KernelTreeTest(unittest.TestCase):
         """Ensure merge_git_ref() returns a proper tuple."""
         mock_git_cmd = mock.patch('skt.kerneltree.KernelTree.'
                                   '_KernelTree__git_cmd')
-        mock_get_commit_hash = mock.patch(
-            'skt.kerneltree.KernelTree.get_commit_hash',
-            return_value="abcdef"
+        mock_get_commit_metadata = mock.patch(
+            'skt.kerneltree.KernelTree.get_commit_metadata',
+            return_value={'hash': "abcdef"}
         )
 
-        with mock_git_cmd, mock_get_commit_hash:
+        with mock_git_cmd, mock_get_commit_metadata:
             result = self.kerneltree.merge_git_ref('http://example.com')
 
         self.assertTupleEqual((0, 'abcdef'), result)
 
     @mock.patch('logging.warning')
+    @mock.patch('skt.kerneltree.KernelTree._KernelTree__get_remotes')
     @mock.patch('skt.kerneltree.KernelTree._KernelTree__get_remote_name')
     @mock.patch('skt.kerneltree.KernelTree.get_commit_hash')
     @mock.patch('skt.kerneltree.KernelTree._KernelTree__git_cmd')
     def test_merge_git_ref_failure(self, mock_git_cmd, mock_get_commit_hash,
-                                   mock_get_remote_name, mock_logging):
+                                   mock_get_remote_name, mock_get_remotes,
+                                   mock_logging):
         """Ensure merge_git_ref() fails properly when remote add fails."""
+        # pylint: disable=too-many-arguments
         mock_get_remote_name.return_value = "origin"
+        mock_get_remotes.return_value = {}
         mock_git_cmd.side_effect = [
             subprocess.CalledProcessError(1, 'That failed', "output"),
             True,
+            True,
             subprocess.CalledProcessError(1, 'That failed', "output"),
             True
         ]
@@ -249,7 +252,7 @@ class KernelTreeTest(unittest.TestCase):
     def test_merge_patch_file(self):
         """Ensure merge_patch_file() tries to merge a patch."""
         mock_check_output = mock.patch(
-            'subprocess.check_output',
+            'skt.accounting.check_output',
             Mock(return_value='toot')
         )
         patch_file = "{}/test_patch.patch".format(self.tmpdir)
@@ -265,7 +268,7 @@ class KernelTreeTest(unittest.TestCase):
     def test_merge_patch_file_failure(self, mock_logging):
         """Ensure merge_patch_file() handles a patch apply failure."""
         mock_check_output = mock.patch(
-            'subprocess.check_output',
+            'skt.accounting.check_output',
             side_effect=make_process_exception
         )
 
@@ -288,14 +291,504 @@ class KernelTreeTest(unittest.TestCase):
     def test_setup_repository_add(self, mock_git_cmd):
         """Ensure __setup_repository() adds the origin URL."""
         # pylint: disable=W0212,E1101
-        mock_git_cmd.side_effect = [True, "remote1\nremote2\remote3\n", True]
+        gdir = self.kerneltree.gdir
+        mock_git_cmd.side_effect = [True, gdir, gdir,
+                                    "remote1\nremote2\remote3\n", True]
         self.kerneltree._KernelTree__setup_repository()
-        self.assertIn('add', mock_git_cmd.call_args_list[2][0])
+        self.assertIn('add', mock_git_cmd.call_args_list[4][0])
 
     @mock.patch('skt.kerneltree.KernelTree._KernelTree__git_cmd')
     def test_setup_repository_set(self, mock_git_cmd):
         """Ensure __setup_repository() sets the origin URL when it exists."""
         # pylint: disable=W0212,E1101
-        mock_git_cmd.side_effect = [True, "remote1\nremote2\norigin\n", True]
+        gdir = self.kerneltree.gdir
+        mock_git_cmd.side_effect = [True, gdir, gdir,
+                                    "remote1\nremote2\norigin\n", True]
         self.kerneltree._KernelTree__setup_repository()
-        self.assertIn('set-url', mock_git_cmd.call_args_list[2][0])
+        self.assertIn('set-url', mock_git_cmd.call_args_list[4][0])
+
+    def test_setup_alternates(self):
+        """Ensure a reference repository is registered as an alternate."""
+        reference = ReferenceRepository("{}/reference".format(self.tmpdir))
+        KernelTree(uri='http://example.com', wdir=self.tmpdir,
+                   reference=reference)
+        # Setting up the same tree again must not duplicate the entry
+        KernelTree(uri='http://example.com', wdir=self.tmpdir,
+                   reference=reference)
+
+        alternates = "{}/.git/objects/info/alternates".format(self.tmpdir)
+        with open(alternates) as fileh:
+            self.assertEqual(
+                ["{}/reference/objects".format(self.tmpdir)],
+                fileh.read().splitlines()
+            )
+
+    @mock.patch('logging.warning')
+    @mock.patch('skt.kerneltree.KernelTree.get_commit_hash')
+    @mock.patch('skt.kerneltree.KernelTree._KernelTree__git_cmd')
+    def test_checkout_reference(self, mock_git_cmd, mock_get_commit_hash,
+                                mock_logging):
+        """Ensure checkout() updates the reference repository first."""
+        # pylint: disable=unused-argument
+        self.kerneltree.reference = Mock()
+        self.kerneltree.reference.update.side_effect = make_process_exception
+        mock_get_commit_hash.return_value = "abcdef"
+
+        # A failing reference update must not break the checkout
+        self.assertEqual("abcdef", self.kerneltree.checkout())
+        self.kerneltree.reference.update.assert_called_once_with(
+            self.kerneltree.uri, 'master'
+        )
+        mock_logging.assert_called_once()
+
+    def test_checkout_noop(self):
+        """Ensure checkout() skips work when the base is checked out."""
+        # pylint: disable=W0212,E1101
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        ktree = KernelTree(source, wdir="{}/wdir".format(self.tmpdir))
+        head = ktree.checkout()
+
+        git_cmd = mock.patch.object(ktree, '_KernelTree__git_cmd',
+                                    wraps=ktree._KernelTree__git_cmd)
+        with git_cmd as mock_git_cmd:
+            self.assertEqual(head, ktree.checkout())
+        commands = [call[0][0] for call in mock_git_cmd.call_args_list]
+        self.assertNotIn("fetch", commands)
+        self.assertNotIn("checkout", commands)
+        self.assertNotIn("reset", commands)
+
+        # A dirty tree must be reset even if nothing needs fetching
+        with open("{}/wdir/Makefile".format(self.tmpdir), "w") as fileh:
+            fileh.write("dirty\n")
+        ktree = KernelTree(source, wdir="{}/wdir".format(self.tmpdir))
+        git_cmd = mock.patch.object(ktree, '_KernelTree__git_cmd',
+                                    wraps=ktree._KernelTree__git_cmd)
+        with git_cmd as mock_git_cmd:
+            self.assertEqual(head, ktree.checkout())
+        commands = [call[0][0] for call in mock_git_cmd.call_args_list]
+        self.assertNotIn("fetch", commands)
+        self.assertIn("reset", commands)
+        with open("{}/wdir/Makefile".format(self.tmpdir)) as fileh:
+            self.assertNotEqual("dirty\n", fileh.read())
+
+    def test_maintain(self):
+        """Ensure maintain() optimizes the repository and prunes remotes."""
+        def git(*args):
+            """Run a git command in the work directory."""
+            return subprocess.check_output(["git", "-C", wdir] + list(args))
+
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        other = "{}/other/repo".format(self.tmpdir)
+        subprocess.check_output(["git", "clone", "-q", source, other])
+        make_patch(other, "extra", "extra\n", "feature")
+        wdir = "{}/wdir".format(self.tmpdir)
+        ktree = KernelTree(source, wdir=wdir)
+        ktree.checkout()
+        self.assertEqual(0, ktree.merge_git_ref(other, "feature")[0])
+
+        # A recently used remote is kept
+        timings = ktree.maintain(remote_max_age=3600)
+        self.assertListEqual(
+            ["prune_remotes", "repack", "multi_pack_index", "commit_graph"],
+            [name for name, _ in timings]
+        )
+        remotes = git("remote").split()
+        self.assertEqual(2, len(remotes))
+        self.assertEqual(0, ktree.get_object_counts()[0])
+        self.assertTrue(os.path.exists(
+            "{}/.git/objects/info/commit-graphs".format(wdir)
+        ))
+
+        # An unused one is removed along with its references
+        remote = [name for name in remotes if name != "origin"][0]
+        git("config", "remote.%s.sktlastused" % remote, "0")
+        ktree.maintain(remote_max_age=3600)
+        self.assertListEqual(["origin"], git("remote").split())
+        self.assertNotIn("refs/remotes/%s" % remote,
+                         git("for-each-ref"))
+
+    def test_get_commits_metadata(self):
+        """Ensure get_commits_metadata() queries a single git process."""
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        subprocess.check_output([
+            "git", "-C", source, "-c", "user.name=Joe", "-c",
+            "user.email=joe@example.com", "commit", "-q", "--allow-empty",
+            "-m", "Second\ncommit\n\nBody"
+        ])
+        ktree = KernelTree(source, wdir="{}/wdir".format(self.tmpdir))
+        ktree.checkout()
+        ktree.close_query()
+
+        with mock.patch('subprocess.Popen', wraps=subprocess.Popen) as popen:
+            result = ktree.get_commits_metadata(['HEAD~1', None])
+            self.assertEqual(ktree.get_commit_metadata(), result[1])
+            # The single value getters use the same process
+            self.assertEqual(ktree.get_commit_hash('HEAD~1'),
+                             result[0]['hash'])
+            self.assertEqual(ktree.get_commit_date(), result[1]['date'])
+            self.assertEqual(ktree.get_commit_subject(),
+                             result[1]['subject'])
+            popen.assert_called_once()
+
+        self.assertEqual("Initial commit", result[0]['subject'])
+        self.assertEqual("Second commit", result[1]['subject'])
+        self.assertEqual("Joe <joe@example.com>", result[1]['author'])
+
+        with self.assertRaises(ValueError):
+            ktree.get_commits_metadata(['does-not-exist'])
+
+        ktree.close_query()
+
+    def test_query_accounting(self):
+        """Ensure the commit query and patch-id processes are accounted."""
+        # pylint: disable=W0212,E1101
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        ktree = KernelTree(source, wdir="{}/wdir".format(self.tmpdir))
+        head = ktree.checkout()
+        ktree.close_query()
+
+        with mock.patch.object(accounting.ACCOUNTING,
+                               'add_usage') as mock_add_usage:
+            ktree.get_commit_hash()
+            ktree.close_query()
+            ktree._KernelTree__get_base_patch_ids()
+
+        # The query process, both "git rev-parse", "git log" and
+        # "git patch-id"
+        self.assertEqual(5, mock_add_usage.call_count)
+        for call in mock_add_usage.call_args_list:
+            self.assertEqual('git', call[0][0])
+        self.assertTrue(head)
+
+    def test_prefetch(self):
+        """Ensure prefetch() fetches everything once, before the merges."""
+        # pylint: disable=W0212,E1101
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        subprocess.check_output(["git", "-C", source, "branch", "feature"])
+        ktree = KernelTree(source, wdir="{}/wdir".format(self.tmpdir))
+
+        ktree.prefetch([[source, 'feature'], [source]], jobs=2)
+        self.assertIn(
+            "refs/remotes/origin/feature",
+            subprocess.check_output(
+                ["git", "-C", ktree.wdir, "for-each-ref"]
+            )
+        )
+
+        # Neither the checkout nor the merge fetch again
+        with mock.patch('skt.kerneltree.KernelTree._KernelTree__git_cmd',
+                        wraps=ktree._KernelTree__git_cmd) as mock_git_cmd:
+            ktree.checkout()
+            ktree.merge_git_ref(source, 'feature')
+            commands = [call[0][0] for call in mock_git_cmd.call_args_list]
+
+        self.assertNotIn('fetch', commands)
+        self.assertIn('merge', commands)
+
+    def test_prefetch_filter(self):
+        """Ensure concurrent filtered fetches don't fight over the config."""
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        merge_refs = []
+        for index in range(12):
+            clone = "{}/clone{}".format(self.tmpdir, index)
+            subprocess.check_output(["git", "clone", "-q", source, clone])
+            subprocess.check_output(["git", "-C", clone, "config",
+                                     "uploadpack.allowfilter", "true"])
+            merge_refs.append(["file://" + clone])
+        subprocess.check_output(["git", "-C", source, "config",
+                                 "uploadpack.allowfilter", "true"])
+
+        ktree = KernelTree("file://" + source,
+                           wdir="{}/wdir".format(self.tmpdir),
+                           fetch_filter='blob:none')
+        ktree.prefetch(merge_refs, jobs=12)
+
+        config = subprocess.check_output(
+            ["git", "-C", ktree.wdir, "config", "--get-regexp",
+             r"^remote\..*\.partialclonefilter$"]
+        )
+        self.assertEqual(13, len(config.splitlines()))
+        ktree.checkout()
+
+    def test_merge_same_basename(self):
+        """Ensure references sharing the last component are all merged."""
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        heads = []
+        for (branch, filename) in [("a/topic", "a"), ("b/topic", "b")]:
+            make_patch(source, filename, filename, branch)
+            heads.append(subprocess.check_output(
+                ["git", "-C", source, "rev-parse", branch]
+            ).strip())
+
+        for prefetch in [False, True]:
+            wdir = "{}/wdir-{}".format(self.tmpdir, prefetch)
+            ktree = KernelTree(source, wdir=wdir)
+            merge_refs = [[source, "refs/heads/a/topic"],
+                          [source, "refs/heads/b/topic"]]
+            if prefetch:
+                ktree.prefetch(merge_refs, jobs=2)
+            ktree.checkout()
+
+            results = [ktree.merge_git_ref(*merge_ref)
+                       for merge_ref in merge_refs]
+            self.assertEqual([(0, heads[0]), (0, heads[1])], results)
+            self.assertTrue(os.path.isfile(os.path.join(wdir, "a")))
+            self.assertTrue(os.path.isfile(os.path.join(wdir, "b")))
+            ktree.close_query()
+
+    @mock.patch('logging.error')
+    def test_patch_cache(self, mock_logging):
+        """Ensure applying the same patch to the same base is cached."""
+        # pylint: disable=W0212,E1101
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        good = make_patch(source, "good.c", "int good;\n", "good")
+        bad = make_patch(source, "Makefile", "bad:\n", "bad")
+        ktree = KernelTree(source, wdir="{}/wdir".format(self.tmpdir),
+                           patch_cache=PatchCache(
+                               "{}/cache".format(self.tmpdir)
+                           ))
+        base = ktree.checkout()
+
+        # Apply for real and fill the cache
+        ktree.merge_patch_file(good)
+        applied = ktree.get_commit_hash()
+        self.assertNotEqual(base, applied)
+        ktree.checkout()
+        ktree.merge_patch_file(bad)
+        with self.assertRaises(PatchApplicationError):
+            ktree.merge_patch_file(bad)
+        ktree.checkout()
+
+        # Apply from the cache
+        with mock.patch('skt.kerneltree.KernelTree._KernelTree__git_cmd',
+                        wraps=ktree._KernelTree__git_cmd) as mock_git_cmd:
+            ktree.merge_patch_file(good)
+            self.assertEqual(applied, ktree.get_commit_hash())
+
+            ktree.checkout()
+            ktree.merge_patch_file(bad)
+            os.unlink(ktree.mergelog)
+            with self.assertRaises(PatchApplicationError):
+                ktree.merge_patch_file(bad)
+
+            commands = [call[0][0] for call in mock_git_cmd.call_args_list]
+
+        self.assertNotIn('am', commands)
+        self.assertTrue(os.path.isfile(ktree.mergelog))
+        self.assertEqual(2, mock_logging.call_count)
+
+    @mock.patch('logging.error')
+    def test_merge_patch_series(self, mock_logging):
+        """Ensure merge_patch_series() applies and attributes failures."""
+        # pylint: disable=W0212,E1101
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        good = make_patch(source, "good.c", "int good;\n", "good")
+        bad = make_patch(source, "Makefile", "bad:\n", "bad")
+        ktree = KernelTree(source, wdir="{}/wdir".format(self.tmpdir))
+        base = ktree.checkout()
+
+        with mock.patch('skt.kerneltree.KernelTree._KernelTree__git_cmd_pipe',
+                        wraps=ktree._KernelTree__git_cmd_pipe) as mock_pipe:
+            ktree.merge_patch_series([('patch', good), ('patch', bad)])
+            mock_pipe.assert_called_once()
+
+        self.assertEqual(
+            "2",
+            subprocess.check_output(["git", "-C", ktree.wdir, "rev-list",
+                                     "--count", base + "..HEAD"]).strip()
+        )
+
+        # The second copy of the bad patch is the one failing
+        ktree.checkout()
+        with self.assertRaises(PatchApplicationError) as context:
+            ktree.merge_patch_series([('patch', good), ('patch', bad),
+                                      ('patch', bad), ('patch', good)])
+        self.assertEqual(2, context.exception.index)
+        self.assertEqual(base, ktree.get_commit_hash())
+        self.assertTrue(os.path.isfile(ktree.mergelog))
+        mock_logging.assert_called_once()
+
+    @mock.patch('logging.error')
+    @mock.patch('logging.warning')
+    def test_applied_patches(self, mock_warning, mock_error):
+        """Ensure patches already in the base are skipped or reported."""
+        # pylint: disable=unused-argument
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        applied = make_patch(source, "applied.c", "int applied;\n",
+                             "applied")
+        new = make_patch(source, "new.c", "int new;\n", "new")
+        subprocess.check_output(["git", "-C", source, "merge", "-q",
+                                 "--ff-only", "applied"])
+        ktree = KernelTree(source, wdir="{}/wdir".format(self.tmpdir),
+                           applied_patches="skip")
+        base = ktree.checkout()
+
+        ktree.merge_patch_file(applied)
+        self.assertEqual(base, ktree.get_commit_hash())
+        self.assertListEqual([applied], ktree.skipped_patches)
+        self.assertTrue(os.path.isfile(
+            "{}/wdir/.git/skt-patch-ids/{}.json".format(self.tmpdir, base)
+        ))
+
+        # Only the new patch of a series is applied
+        ktree.merge_patch_series([('patch', applied), ('patch', new)])
+        self.assertEqual(
+            "Patch new",
+            ktree.get_commit_subject().strip()
+        )
+        self.assertEqual(base, ktree.get_commit_hash('HEAD~1'))
+
+        # Duplicates are failures if requested
+        ktree.checkout()
+        ktree.applied_patches = "fail"
+        with self.assertRaises(PatchApplicationError) as context:
+            ktree.merge_patch_series([('patch', new), ('patch', applied)])
+        self.assertEqual(1, context.exception.index)
+        self.assertEqual(base, ktree.get_commit_hash())
+
+    @mock.patch('logging.warning')
+    def test_applied_patches_shallow(self, mock_warning):
+        """Ensure a shallow base history is indexed with a warning."""
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        applied = make_patch(source, "applied.c", "int applied;\n",
+                             "applied")
+        subprocess.check_output(["git", "-C", source, "merge", "-q",
+                                 "--ff-only", "applied"])
+        ktree = KernelTree("file://" + source,
+                           wdir="{}/wdir".format(self.tmpdir),
+                           fetch_depth='2', applied_patches="skip")
+        base = ktree.checkout()
+
+        ktree.merge_patch_file(applied)
+        self.assertListEqual([applied], ktree.skipped_patches)
+        self.assertIn("shallow", mock_warning.call_args_list[0][0][0])
+        # The index of the shallow history is not cached
+        self.assertFalse(os.path.isfile(
+            "{}/wdir/.git/skt-patch-ids/{}.json".format(self.tmpdir, base)
+        ))
+
+    @mock.patch('logging.warning')
+    def test_check_mergeability(self, mock_logging):
+        """Ensure check_mergeability() reports results without a checkout."""
+        # pylint: disable=unused-argument
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        other = "{}/other/repo".format(self.tmpdir)
+        subprocess.check_output(["git", "clone", "-q", source, other])
+        good = make_patch(source, "good.c", "int good;\n", "good")
+        bad = make_patch(source, "Makefile", "bad:\n", "bad")
+        make_patch(other, "feature.c", "int feature;\n", "feature")
+        make_patch(other, "Makefile", "clash:\n", "clash")
+        # Make the bad patch and the clashing branch conflict with the base
+        subprocess.check_output(["git", "-C", source, "merge", "-q",
+                                 "--ff-only", "good"])
+        make_patch(source, "Makefile", "base:\n", "base")
+        subprocess.check_output(["git", "-C", source, "merge", "-q",
+                                 "--ff-only", "base"])
+        garbage = "{}/garbage.patch".format(self.tmpdir)
+        with open(garbage, 'w') as fileh:
+            fileh.write("not a patch\n")
+
+        ktree = KernelTree(source, wdir="{}/wdir".format(self.tmpdir))
+        results = ktree.check_mergeability([
+            ('patch', bad),
+            ('merge_ref', other + " feature"),
+            ('merge_ref', other + " clash"),
+            ('patch', garbage),
+            ('patch', "{}/missing.patch".format(self.tmpdir)),
+        ], jobs=2)
+
+        self.assertListEqual([
+            ("conflict", ["Makefile"]),
+            ("pass", []),
+            ("conflict", ["Makefile"]),
+            ("fail", []),
+            ("fail", []),
+        ], results)
+        self.assertFalse(os.path.exists(
+            "{}/wdir/Makefile".format(self.tmpdir)
+        ))
+
+        # A patch creating an already existing file conflicts too
+        self.assertListEqual([("conflict", ["good.c"])],
+                             ktree.check_mergeability([('patch', good)]))
+
+    def test_check_mergeability_old_git(self):
+        """Ensure check_mergeability() refuses to run with an old git."""
+        # pylint: disable=W0212,E1101
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        ktree = KernelTree(source, wdir="{}/wdir".format(self.tmpdir))
+        git_cmd = ktree._KernelTree__git_cmd
+
+        def old_git_cmd(*args, **kwargs):
+            """Run git commands as a git without merge-tree --write-tree."""
+            if args[0] == 'version':
+                return "git version 2.30.2\n"
+            return git_cmd(*args, **kwargs)
+
+        with mock.patch('skt.kerneltree.KernelTree._KernelTree__git_cmd',
+                        side_effect=old_git_cmd):
+            with self.assertRaises(GitVersionError):
+                ktree.check_mergeability([('merge_ref', source)])
+
+        # A usage error of an unknown version isn't reported as a failure
+        def usage_git_cmd(*args, **kwargs):
+            """Run git commands as a git rejecting merge-tree options."""
+            if args[0] == 'merge-tree':
+                raise subprocess.CalledProcessError(129, 'git', "usage")
+            return git_cmd(*args, **kwargs)
+
+        with mock.patch('skt.kerneltree.KernelTree._KernelTree__git_cmd',
+                        side_effect=usage_git_cmd):
+            with self.assertRaises(GitVersionError):
+                ktree.check_mergeability([('merge_ref', source)])
+
+    def test_merge_git_ref_deepen(self):
+        """Ensure merge_git_ref() deepens shallow history to a merge base."""
+        # pylint: disable=W0212,E1101
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+
+        def commit(count):
+            """Add empty commits to the source master branch."""
+            for _ in range(count):
+                subprocess.check_output([
+                    "git", "-C", source, "-c", "user.name=skt", "-c",
+                    "user.email=skt", "commit", "-q", "--allow-empty", "-m",
+                    "Empty commit"
+                ])
+
+        # Branch off in the middle of the history
+        commit(4)
+        make_patch(source, "feature.c", "int feature;\n", "feature")
+        commit(8)
+        uri = "file://" + source
+
+        ktree = KernelTree(uri, wdir="{}/wdir".format(self.tmpdir),
+                           fetch_depth='1', fetch_filter='blob:none',
+                           deepen=True)
+        ktree.checkout()
+        with mock.patch('skt.kerneltree.KernelTree._KernelTree__git_cmd',
+                        wraps=ktree._KernelTree__git_cmd) as mock_git_cmd:
+            result = ktree.merge_git_ref(uri, 'feature')
+            fetches = [call[0] for call in mock_git_cmd.call_args_list
+                       if call[0][0] == 'fetch']
+
+        self.assertEqual(0, result[0])
+        self.assertTrue(os.path.isfile("{}/feature.c".format(ktree.wdir)))
+        # The history was deepened, but not completely fetched
+        self.assertIn('--deepen=1', fetches[1])
+        self.assertNotIn('--unshallow', [arg for fetch in fetches
+                                         for arg in fetch])
@@ -0,0 +1,28 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General Public
+# License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Test cases for patchcache module."""
+import unittest
+
+from skt.patchcache import PatchCache
+
+
+class PatchCacheTest(unittest.TestCase):
+    """Test cases for PatchCache class."""
+
+    def test_get_key(self):
+        """Ensure patch cache keys depend on the base and the patch order."""
+        key = PatchCache.get_key('base', ['a', 'b'])
+        self.assertEqual(key, PatchCache.get_key('base', ['a', 'b']))
+        self.assertNotEqual(key, PatchCache.get_key('base', ['b', 'a']))
+        self.assertNotEqual(key, PatchCache.get_key('other', ['a', 'b']))
@@ -0,0 +1,74 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General Public
+# License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Test cases for referencerepo module."""
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import mock
+
+from skt.referencerepo import ReferenceRepository
+from tests.misc import make_patch, make_source_repo
+
+
+class ReferenceRepositoryTest(unittest.TestCase):
+    """Test cases for ReferenceRepository class."""
+
+    def setUp(self):
+        """Create a temporary directory."""
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('skt.accounting.check_output')
+    def test_update(self, mock_check_output):
+        """Ensure ReferenceRepository.update() fetches only when stale."""
+        reference = ReferenceRepository("{}/reference".format(self.tmpdir))
+
+        self.assertFalse(reference.is_fresh('http://example.com', 'master'))
+        reference.update('http://example.com', 'master')
+        fetch_args = mock_check_output.call_args_list[-1][0][0]
+        self.assertIn('fetch', fetch_args)
+        self.assertIn('http://example.com', fetch_args)
+        self.assertTrue(reference.is_fresh('http://example.com', 'master'))
+
+        # A fresh reference must not be fetched again
+        mock_check_output.reset_mock()
+        reference.update('http://example.com', 'master')
+        mock_check_output.assert_not_called()
+
+        # An expired one must
+        reference.refresh_interval = 0
+        reference.update('http://example.com', 'master')
+        mock_check_output.assert_called()
+
+    def test_same_basename(self):
+        """Ensure references sharing the last component are all kept."""
+        source = "{}/source".format(self.tmpdir)
+        make_source_repo(source)
+        for branch in ["a/topic", "b/topic"]:
+            make_patch(source, branch.replace('/', '-'), branch, branch)
+
+        reference = ReferenceRepository("{}/reference".format(self.tmpdir))
+        reference.update(source, "refs/heads/a/topic")
+        reference.update(source, "refs/heads/b/topic")
+
+        refs = subprocess.check_output([
+            "git", "--git-dir", reference.path, "for-each-ref",
+            "--format=%(objectname)", "refs/skt/"
+        ]).split()
+        self.assertEqual(2, len(set(refs)))
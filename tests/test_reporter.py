@@ -258,7 +258,12 @@ class TestStdioReporter(unittest.TestCase):
             body="Subject: Patch #2"
         )
 
-        self.basecfg['buildlog'] = self.make_file('build.log', 'build failed')
+        self.basecfg['buildlog'] = self.make_file(
+            'build.log',
+            "  CC      drivers/foo.o\n"
+            "drivers/foo.c:12:5: error: 'bar' undeclared\n"
+            "build failed\n"
+        )
 
         testprint = StringIO.StringIO()
         rptclass = reporter.StdioReporter(self.basecfg)
@@ -274,12 +279,127 @@ class TestStdioReporter(unittest.TestCase):
             'http://patchwork.example.com/patch/1',
             'http://patchwork.example.com/patch/2',
             'We compiled the kernel for 1 architecture:',
+            "drivers/foo.c:12: 'bar' undeclared",
             self.basecfg['basehead'],
             self.basecfg['baserepo'],
         ]
         for required_string in required_strings:
             self.assertIn(required_string, report)
 
+    @responses.activate
+    def test_build_failure_targets(self):
+        """Verify stdio report finds a failed target of several."""
+        responses.add(
+            responses.GET,
+            "http://patchwork.example.com/patch/1/mbox",
+            body="Subject: Patch #1"
+        )
+        responses.add(
+            responses.GET,
+            "http://patchwork.example.com/patch/2/mbox",
+            body="Subject: Patch #2"
+        )
+
+        del self.basecfg['kernel_arch']
+        self.basecfg.update({
+            'build_targets': 'x86_64 s390x',
+            'target.x86_64.kernel_arch': 'x86_64',
+            'target.s390x.kernel_arch': 's390x',
+            'target.s390x.buildlog': self.make_file(
+                'build-s390x.log',
+                "  CC      drivers/foo.o\n"
+                "drivers/foo.c:12:5: error: 'bar' undeclared\n"
+                "build failed\n"
+            ),
+        })
+
+        testprint = StringIO.StringIO()
+        rptclass = reporter.StdioReporter(self.basecfg)
+        rptclass.report(printer=testprint)
+        report = testprint.getvalue().strip()
+
+        required_strings = [
+            'Subject: FAIL: Build failed',
+            'Compile: FAILED',
+            's390x:   FAILED (build log attached: build_s390x.log.gz)',
+            "drivers/foo.c:12: 'bar' undeclared",
+        ]
+        for required_string in required_strings:
+            self.assertIn(required_string, report)
+
+    @mock.patch('skt.runner.BeakerRunner.getresultstree')
+    @responses.activate
+    def test_run_targets(self, mock_grt):
+        """Verify stdio report lists every target of several."""
+        responses.add(
+            responses.GET,
+            "http://patchwork.example.com/patch/1/mbox",
+            body="Subject: Patch #1"
+        )
+        responses.add(
+            responses.GET,
+            "http://patchwork.example.com/patch/2/mbox",
+            body="Subject: Patch #2"
+        )
+        responses.add(responses.GET,
+                      'http://example.com',
+                      body="Linux version 3.10.0")
+        responses.add(
+            responses.GET,
+            "http://example.com/machinedesc.log",
+            body="Machine information from beaker goes here"
+        )
+
+        mock_grt.return_value = self.beaker_pass_results
+        del self.basecfg['kernel_arch']
+        del self.basecfg['krelease']
+        self.basecfg.update({
+            'retcode': '0',
+            'build_targets': 'x86_64 aarch64 s390x',
+            'target.x86_64.kernel_arch': 'x86_64',
+            'target.x86_64.krelease': '3.10.0',
+            'target.aarch64.kernel_arch': 'arm64',
+            'target.aarch64.cross_compiler_prefix': 'aarch64-linux-gnu-',
+            'target.aarch64.krelease': '3.10.0',
+            'target.s390x.kernel_arch': 's390x',
+            'target.s390x.krelease': '3.10.0',
+        })
+
+        # All targets were built, the first one was tested
+        testprint = StringIO.StringIO()
+        rptclass = reporter.StdioReporter(dict(self.basecfg))
+        rptclass.report(printer=testprint)
+        report = testprint.getvalue().strip()
+
+        required_strings = [
+            'Subject: PASS: Test report for kernel 3.10.0 (kernel)',
+            'Overall result: PASSED',
+            'We compiled the kernel for 3 architectures:',
+            'aarch64:',
+            's390x:',
+        ]
+        for required_string in required_strings:
+            self.assertIn(required_string, report)
+
+        # A target failing to build doesn't hide the others
+        self.basecfg['target.s390x.buildlog'] = self.make_file(
+            'build-s390x.log', "build failed\n"
+        )
+        testprint = StringIO.StringIO()
+        rptclass = reporter.StdioReporter(dict(self.basecfg))
+        rptclass.report(printer=testprint)
+        report = testprint.getvalue().strip()
+
+        required_strings = [
+            'Subject: FAIL: Build failed for kernel 3.10.0 (kernel)',
+            'Compile: FAILED',
+            'x86_64:  PASSED',
+            'aarch64: PASSED',
+            's390x:   FAILED (build log attached: build_s390x.log.gz)',
+        ]
+        for required_string in required_strings:
+            self.assertIn(required_string, report)
+
     @mock.patch('skt.runner.BeakerRunner.getresultstree')
     @responses.activate
     def test_run_failure(self, mock_grt):
@@ -301,7 +301,7 @@ class TestRunner(unittest.TestCase):
         self.assertEqual(result, expected_xml)
 
     @mock.patch('logging.error')
-    @mock.patch('subprocess.call')
+    @mock.patch('skt.accounting.call')
     @mock.patch('skt.runner.BeakerRunner._BeakerRunner__jobsubmit')
     def test_cleanup_called(self, mock_jobsubmit, mock_call, mock_log_err):
         """Ensure BeakerRunner.signal_handler works."""
@@ -329,7 +329,7 @@ class TestRunner(unittest.TestCase):
         self.assertTrue(self.myrunner.cleanup_done)
 
     @mock.patch('logging.error')
-    @mock.patch('subprocess.call')
+    @mock.patch('skt.accounting.call')
     @mock.patch('skt.runner.BeakerRunner._BeakerRunner__jobsubmit')
     def test_cleanup_called2(self, mock_jobsubmit, mock_call, mock_log_err):
         """Ensure BeakerRunner cleanup isn't called twice."""
@@ -89,3 +89,40 @@ class TestStateFile(unittest.TestCase):
         config.read(temp_state)
         self.assertEqual(config.get('state', 'foo'), 'bar')
         self.assertEqual(config.get('state', 'foo2'), 'bar2')
+
+    def test_get_target_states(self):
+        """Ensure get_target_states() splits the state of each target."""
+        state = {'basehead': 'abcdef'}
+        self.assertEqual([state], state_file.get_target_states(state))
+
+        state.update({
+            'build_targets': 'x86_64 arm',
+            'target.x86_64.tarpkg': 'abcdef-x86_64.tar.gz',
+            'target.x86_64.kernel_arch': 'x86_64',
+            'target.arm.buildlog': 'build-arm.log',
+            'target.arm.kernel_arch': 'aarch64',
+        })
+        (x86_64, arm) = state_file.get_target_states(state)
+        self.assertEqual('abcdef', x86_64['basehead'])
+        self.assertEqual('abcdef-x86_64.tar.gz', x86_64['tarpkg'])
+        self.assertEqual('x86_64', x86_64['kernel_arch'])
+        self.assertNotIn('buildlog', x86_64)
+        self.assertNotIn('target.arm.kernel_arch', x86_64)
+        self.assertEqual('abcdef', arm['basehead'])
+        self.assertEqual('build-arm.log', arm['buildlog'])
+        self.assertEqual('aarch64', arm['kernel_arch'])
+        self.assertNotIn('tarpkg', arm)
+
+        # Target names matching the end of a key of the build don't take it
+        state = {
+            'build_targets': 'arch jobs',
+            'make_jobs': '4',
+            'target.arch.kernel_arch': 'x86_64',
+        }
+        (arch, jobs) = state_file.get_target_states(state)
+        self.assertEqual('x86_64', arch['kernel_arch'])
+        self.assertEqual('4', arch['make_jobs'])
+        self.assertNotIn('kernel_arch', jobs)
+        self.assertEqual('4', jobs['make_jobs'])
+        self.assertEqual('target.arch.kernel_arch',
+                         state_file.get_target_key('arch', 'kernel_arch'))
@@ -0,0 +1,157 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General Public
+# License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Test cases for worktreepool module."""
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import mock
+
+from skt.kerneltree import KernelTree
+from skt.worktreepool import WorktreePool, WorktreePoolError
+from tests.misc import make_source_repo
+
+
+class WorktreePoolTest(unittest.TestCase):
+    """Test cases for WorktreePool class."""
+
+    def setUp(self):
+        """Fixtures for testing WorktreePool."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = "{}/source".format(self.tmpdir)
+        make_source_repo(self.source)
+        self.pool = WorktreePool("{}/pool".format(self.tmpdir), max_trees=2,
+                                 wait_timeout=0)
+
+    def tearDown(self):
+        """Teardown steps when testing is complete."""
+        shutil.rmtree(self.tmpdir)
+
+    def lease(self, name):
+        """Lease a worktree for a workdir with the specified name."""
+        return self.pool.lease("{}/{}".format(self.tmpdir, name),
+                               self.source)
+
+    def test_lease(self):
+        """Ensure lease() links a populated worktree to the owner."""
+        tree = self.lease("wdir")
+
+        self.assertTrue(os.path.isfile("{}/Makefile".format(tree)))
+        self.assertEqual(tree, os.path.realpath("{}/wdir".format(self.tmpdir)))
+        # Leasing again for the same owner returns the same worktree
+        self.assertEqual(tree, self.lease("wdir"))
+
+    def test_lease_cap(self):
+        """Ensure lease() doesn't create more worktrees than allowed."""
+        first = self.lease("wdir0")
+        second = self.lease("wdir1")
+        self.assertNotEqual(first, second)
+
+        with self.assertRaises(WorktreePoolError):
+            self.lease("wdir2")
+
+        # A returned worktree is handed out again
+        self.pool.release("{}/wdir0".format(self.tmpdir))
+        self.assertEqual(first, self.lease("wdir2"))
+
+    @mock.patch('logging.warning')
+    def test_lease_stale(self, mock_logging):
+        """Ensure leases abandoned by their owner are recovered."""
+        first = self.lease("wdir0")
+        self.lease("wdir1")
+
+        # Removing the owner link abandons the lease
+        os.unlink("{}/wdir0".format(self.tmpdir))
+        self.assertEqual(first, self.lease("wdir2"))
+        mock_logging.assert_called_once()
+
+    def test_lease_owner_in_the_way(self):
+        """Ensure lease() refuses to replace a real directory."""
+        os.mkdir("{}/wdir".format(self.tmpdir))
+        with self.assertRaises(WorktreePoolError):
+            self.lease("wdir")
+
+    def test_evict(self):
+        """Ensure the least recently used worktrees are evicted."""
+        first = self.lease("wdir0")
+        second = self.lease("wdir1")
+        self.pool.release(first)
+        self.pool.release(second)
+
+        self.pool.max_trees = 1
+        self.pool.release(second)
+
+        self.assertFalse(os.path.isdir(first))
+        self.assertTrue(os.path.isdir(second))
+
+    def test_kerneltree_checkout(self):
+        """Ensure KernelTree can check out in a leased worktree."""
+        self.lease("wdir")
+        ktree = KernelTree(self.source, wdir="{}/wdir".format(self.tmpdir))
+        head = ktree.checkout()
+
+        self.assertEqual(head, ktree.get_commit_hash())
+
+    def test_lease_depth(self):
+        """Ensure new worktrees start with the configured history depth."""
+        subprocess.check_output([
+            "git", "-C", self.source, "-c", "user.name=skt", "-c",
+            "user.email=skt", "commit", "-q", "--allow-empty", "-m", "Second"
+        ])
+        self.pool.fetch_depth = '1'
+        tree = self.pool.lease("{}/wdir".format(self.tmpdir),
+                               "file://" + self.source)
+
+        self.assertEqual("1", subprocess.check_output([
+            "git", "-C", tree, "rev-list", "--count", "HEAD"
+        ]).strip())
+        self.assertIn(
+            "refs/remotes/origin/master-",
+            subprocess.check_output(["git", "--git-dir", self.pool.gdir,
+                                     "for-each-ref"])
+        )
+
+    def test_release_link(self):
+        """Ensure release() of an owner link removes it."""
+        first = self.lease("wdir0")
+        self.pool.release("{}/wdir0".format(self.tmpdir))
+        self.assertFalse(os.path.lexists("{}/wdir0".format(self.tmpdir)))
+
+        # A stale link doesn't return the worktree leased to its new owner
+        self.assertEqual(first, self.lease("wdir1"))
+        os.symlink(first, "{}/wdir0".format(self.tmpdir))
+        self.pool.release("{}/wdir0".format(self.tmpdir))
+        self.assertNotEqual(first, self.lease("wdir2"))
+
+    def test_kerneltree_refs(self):
+        """Ensure KernelTrees in worktrees fetch into their own namespace."""
+        self.lease("wdir0")
+        self.lease("wdir1")
+        for name in ["wdir0", "wdir1"]:
+            KernelTree(self.source,
+                       wdir="{}/{}".format(self.tmpdir, name)).checkout()
+
+        refs = subprocess.check_output([
+            "git", "--git-dir", self.pool.gdir, "for-each-ref",
+            "--format=%(refname)", "refs/remotes/origin/"
+        ]).split()
+        self.assertEqual(2, len([ref for ref in refs
+                                 if ref.startswith("refs/remotes/origin/0/")
+                                 or ref.startswith("refs/remotes/origin/1/")]))
+        # The shared configuration is updated under the repository lock
+        self.assertTrue(os.path.isfile(
+            "{}/skt.lock".format(self.pool.gdir)
+        ))